@@ -0,0 +1,195 @@
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+# Files of a staged anaddb run, relative to its working directory
+INPUT_FILE = "run.abi"
+OUTPUT_FILE = "run.abo"
+FILES_FILE = "run.files"
+LOG_FILE = "run.log"
+DDB_FILE = "in_DDB"
+OUTPUT_ROOT = "out"
+
+
+class AnaddbRunner(object):
+
+    def __init__(self, scratch_dir=None, num_workers=1, timeout=None, anaddb_cmd="anaddb",
+                 expected_outputs=(), poll_interval=0.1):
+        """
+        Runs anaddb on staged DDB files in concurrent subprocesses.
+
+        Every run gets its own working directory inside a scratch directory
+        owned by the runner, which is created in scratch_dir (or in the
+        system temporary directory) and removed by close.  Runs are started
+        from an iterable of staged runs as slots become free, so that staging
+        the next runs and parsing the results of finished ones overlaps with
+        the execution of anaddb.
+
+        Args:
+            scratch_dir (str): directory in which the runner's scratch
+                               directory is created.
+            num_workers (int): number of concurrent anaddb processes.
+            timeout (float): maximum wall-clock time per run in seconds;
+                             runs that take longer are killed.
+            anaddb_cmd (str): command running anaddb, which reads the files
+                              file from stdin.
+            expected_outputs ([str]): files, relative to the working
+                                      directory, that a successful run
+                                      writes.
+            poll_interval (float): seconds between checks of the runs.
+        """
+        self.scratch_dir = scratch_dir
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.anaddb_cmd = anaddb_cmd
+        self.expected_outputs = list(expected_outputs)
+        self.poll_interval = poll_interval
+        self._workdir = None
+
+    @property
+    def workdir(self):
+        """
+        Scratch directory of the runner, created on first use.
+        """
+        if self._workdir is None:
+            if self.scratch_dir:
+                os.makedirs(self.scratch_dir, exist_ok=True)
+            self._workdir = tempfile.mkdtemp(prefix="anaddb_", dir=self.scratch_dir)
+        return self._workdir
+
+    def stage(self, name, ddb, anaddb_input=None):
+        """
+        Stages a run in a new working directory.
+
+        Args:
+            name (str): name of the run, used as prefix of the directory.
+            ddb (bytes or file): contents of the DDB file.
+            anaddb_input (str): the anaddb input; if None, only the DDB
+                                file is staged.
+
+        Returns:
+            str: the working directory of the run.
+        """
+        rundir = tempfile.mkdtemp(prefix="{}_".format(name), dir=self.workdir)
+
+        with open(os.path.join(rundir, DDB_FILE), "wb") as f:
+            if isinstance(ddb, bytes):
+                f.write(ddb)
+            else:
+                shutil.copyfileobj(ddb, f)
+
+        if anaddb_input is None:
+            return rundir
+
+        with open(os.path.join(rundir, INPUT_FILE), "w") as f:
+            f.write(str(anaddb_input))
+
+        # Files file as written by abipy's AnaddbTask: input, output, DDB,
+        # molecular dynamics output, GKK input, output root and DDK files
+        paths = [INPUT_FILE, OUTPUT_FILE, DDB_FILE, "out_MD", "dummy_GKK", OUTPUT_ROOT, "dummy_DDK"]
+        with open(os.path.join(rundir, FILES_FILE), "w") as f:
+            f.write("\n".join(os.path.join(rundir, p) for p in paths) + "\n")
+
+        return rundir
+
+    def run(self, runs):
+        """
+        Runs anaddb for staged runs, keeping up to num_workers runs going.
+
+        Args:
+            runs (iterable): (key, rundir) pairs of staged runs; consumed
+                             lazily as slots become free.
+
+        Returns:
+            generator of (key, rundir, error) in the order the runs finish,
+            where error is None for successful runs.
+        """
+        runs = iter(runs)
+        running = {}
+        exhausted = False
+        finished = []
+        try:
+            while running or not exhausted:
+                # Start new runs before handing out finished ones, so that
+                # anaddb keeps running while their results are parsed
+                while not exhausted and len(running) < self.num_workers:
+                    run = next(runs, None)
+                    if run is None:
+                        exhausted = True
+                    else:
+                        key, rundir = run
+                        running[rundir] = (self._start(rundir), key, time.time())
+
+                for key, rundir, error in finished:
+                    yield key, rundir, error
+                finished = []
+
+                if not running:
+                    continue
+                time.sleep(self.poll_interval)
+
+                for rundir, (proc, key, start) in list(running.items()):
+                    elapsed = time.time() - start
+                    returncode = proc.poll()
+                    if returncode is not None:
+                        error = self._check(rundir, returncode)
+                    elif self.timeout and elapsed > self.timeout:
+                        proc.kill()
+                        proc.wait()
+                        error = "timeout after {:.0f} s".format(elapsed)
+                    else:
+                        continue
+
+                    del running[rundir]
+                    if error:
+                        logger.warning("anaddb run for {} failed: {}".format(key, error))
+                    finished.append((key, rundir, error))
+
+            for key, rundir, error in finished:
+                yield key, rundir, error
+        finally:
+            for proc, key, start in running.values():
+                proc.kill()
+                proc.wait()
+
+    def _start(self, rundir):
+        with open(os.path.join(rundir, FILES_FILE)) as stdin, open(os.path.join(rundir, LOG_FILE), "w") as log:
+            return subprocess.Popen(shlex.split(self.anaddb_cmd), stdin=stdin, stdout=log,
+                                    stderr=subprocess.STDOUT, cwd=rundir)
+
+    def _check(self, rundir, returncode):
+        if returncode != 0:
+            return "exited with code {}: {}".format(returncode, self._log_tail(rundir))
+        missing = [f for f in self.expected_outputs if not os.path.exists(os.path.join(rundir, f))]
+        if missing:
+            return "missing outputs {}: {}".format(", ".join(missing), self._log_tail(rundir))
+        return None
+
+    @staticmethod
+    def _log_tail(rundir, n=5):
+        try:
+            with open(os.path.join(rundir, LOG_FILE)) as f:
+                return " | ".join(l.strip() for l in f.readlines()[-n:])
+        except (IOError, OSError):
+            return ""
+
+    @staticmethod
+    def cleanup(rundir):
+        """
+        Removes the working directory of a run.
+        """
+        shutil.rmtree(rundir, ignore_errors=True)
+
+    def close(self):
+        """
+        Removes the scratch directory with all runs.
+        """
+        if self._workdir is not None:
+            shutil.rmtree(self._workdir, ignore_errors=True)
+            self._workdir = None
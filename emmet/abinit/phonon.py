@@ -3,7 +3,7 @@ import tempfile
 import gridfs
 import os
 
-from abipy.dfpt.phonons import get_dyn_mat_eigenvec, match_eigenvectors
+from abipy.dfpt.phonons import get_dyn_mat_eigenvec, match_eigenvectors, PhbstFile, PhdosFile
 from abipy.dfpt.anaddbnc import AnaddbNcFile
 from monty.json import jsanitize
 from pymatgen.phonon.bandstructure import PhononBandStructureSymmLine
@@ -18,6 +18,16 @@ from abipy.dfpt.ddb import AnaddbError
 from abipy.core.abinit_units import eV_to_THz
 
 from maggma.builders import Builder
+from pydash.objects import get
+
+from emmet.abinit.anaddb import AnaddbRunner, DDB_FILE, OUTPUT_ROOT
+from emmet.common.phonon import get_phonon_thermodynamics, PHONON_TEMPERATURES
+from emmet.common.prefetch import query_in_chunks
+
+# Outputs of anaddb read by the builder, relative to the working directory
+PHBST_FILE = OUTPUT_ROOT + "_PHBST.nc"
+PHDOS_FILE = OUTPUT_ROOT + "_PHDOS.nc"
+ANADDB_NC_FILE = "anaddb.nc"
 
 
 #TODO - handle possible other sources for the anaddb netcdf files?
@@ -28,7 +38,8 @@ from maggma.builders import Builder
 #     - store the PhononBandStructureSymmLine in gridfs
 
 class PhononBuilder(Builder):
-    def __init__(self, materials, phonon, query=None, **kwargs):
+    def __init__(self, materials, phonon, query=None, managed=False, scratch_dir=None, num_workers=1, timeout=None,
+                 anaddb_cmd="anaddb", **kwargs):
         """
         CCreates a phonon collection for materials
 
@@ -36,6 +47,14 @@ class PhononBuilder(Builder):
             materials (Store): Store of materials documents
             phonon (Store): Store of diffraction data such as formation energy and decomposition pathway
             query (dict): dictionary to limit materials to be analyzed
+            managed (bool): run anaddb in the managed execution mode, in which get_items runs anaddb for
+                num_workers materials concurrently and parses the outputs of each run as it finishes,
+                instead of running it through abipy's TaskManager in process_item
+            scratch_dir (str): directory in which the builder creates its scratch directory for the DDB
+                files and anaddb runs (default: the system temporary directory)
+            num_workers (int): number of concurrent anaddb processes in the managed mode
+            timeout (float): maximum time of an anaddb run in seconds in the managed mode
+            anaddb_cmd (str): command running anaddb in the managed mode
         """
 
         self.materials = materials
@@ -45,6 +64,13 @@ class PhononBuilder(Builder):
             query = {}
         self.query = query
 
+        self.managed = managed
+        self.scratch_dir = scratch_dir
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.anaddb_cmd = anaddb_cmd
+        self._runner = None
+
         super().__init__(sources=[materials],
                          targets=[phonon],
                          **kwargs)
@@ -65,29 +91,68 @@ class PhononBuilder(Builder):
         # All relevant materials that have been updated since diffraction props were last calculated
         q = dict(self.query)
         q.update(self.materials.lu_filter(self.phonon))
-        mats = list(self.materials.find(q, {"mp_id": 1}))
+        mats = self.materials.distinct(self.materials.key, criteria=q)
         self.logger.info("Found {} new materials for phonon data".format(len(mats)))
 
         # list of properties queried from the results DB
         # basic informations
-        projection = {"mp_id": 1, "spacegroup.number":1}
+        projection = [self.materials.key, "mp_id", "spacegroup.number"]
         # input data
-        projection.update({"abinit_input.structure": 1, "abinit_input.ngkpt": 1, "abinit_input.shiftk": 1,
-                           "abinit_input.ecut": 1, "abinit_input.ngqpt": 1})
+        projection.extend(["abinit_input.structure", "abinit_input.ngkpt", "abinit_input.shiftk",
+                           "abinit_input.ecut", "abinit_input.ngqpt"])
         # file ids to be fetched
-        projection["abinit_output.ddb_id"] = 1
+        projection.append("abinit_output.ddb_id")
 
         # initialize the gridfs
-        ddbfs = gridfs.GridFS(self.materials().database, "ddb_fs")
-
-        for m in mats:
-            item = self.materials().find_one(m, projection)
-
-            # download the DDB file and add the path to the item
-            with tempfile.NamedTemporaryFile() as f:
-                f.write(ddbfs.get(m["abinit_output.ddb_id"]).read())
-                item["ddb_path"] = f.name
-
+        ddbfs = gridfs.GridFS(self.materials.collection.database, "ddb_fs")
+
+        # the DDB files are staged in the scratch directory of the runner, which is removed in finalize
+        if self._runner is not None:
+            self._runner.close()
+        self._runner = AnaddbRunner(scratch_dir=self.scratch_dir, num_workers=self.num_workers,
+                                    timeout=self.timeout, anaddb_cmd=self.anaddb_cmd,
+                                    expected_outputs=[PHBST_FILE, PHDOS_FILE, ANADDB_NC_FILE])
+
+        items = ({p: get(doc, p) for p in projection}
+                 for doc in query_in_chunks(self.materials, mats, properties=projection, chunk_size=self.chunk_size))
+
+        if not self.managed:
+            for item in items:
+                # download the DDB file and add the path to the item
+                # the run directory only holds the DDB file and is removed once anaddb has run
+                rundir = self._runner.stage(item["mp_id"], ddbfs.get(item["abinit_output.ddb_id"]))
+                item["rundir"] = rundir
+                item["ddb_path"] = os.path.join(rundir, DDB_FILE)
+                yield item
+            return
+
+        # Stage the runs lazily, so that the DDB files are downloaded while anaddb runs for other materials
+        staged = {}
+
+        def stage_runs():
+            for item in items:
+                try:
+                    anaddb_inp, labels_list = self.get_anaddb_input(item)
+                    item["labels_list"] = labels_list
+                    rundir = self._runner.stage(item["mp_id"], ddbfs.get(item["abinit_output.ddb_id"]), anaddb_inp)
+                except Exception as e:
+                    self.logger.warning("Error staging anaddb for {}: {}".format(item["mp_id"], e))
+                    continue
+                staged[rundir] = item
+                yield item["mp_id"], rundir
+
+        # The outputs are parsed as soon as a run finishes, while anaddb runs for the next materials, and
+        # only the parsed properties are passed on. maggma collects chunk_size items before processing them,
+        # so the run directories would otherwise pile up in the scratch directory.
+        for mp_id, rundir, error in self._runner.run(stage_runs()):
+            item = staged.pop(rundir)
+            item["anaddb_error"] = error
+            if not error:
+                try:
+                    item["phonon"] = self.get_properties_from_dir(rundir, item["labels_list"])
+                except Exception as e:
+                    item["phonon_error"] = str(e)
+            AnaddbRunner.cleanup(rundir)
             yield item
 
     def process_item(self, item):
@@ -103,12 +168,22 @@ class PhononBuilder(Builder):
         """
         self.logger.debug("Processing phonon item for {}".format(item['mp_id']))
 
+        if item.get("anaddb_error"):
+            self.logger.warning("Error running anaddb for {}: {}".format(item["mp_id"], item["anaddb_error"]))
+            return None
+
+        if item.get("phonon_error"):
+            self.logger.warning(
+                "Error generating the phonon properties for {}: {}".format(item["mp_id"], item["phonon_error"]))
+            return None
+
         try:
 
             structure = Structure.from_dict(item["abinit_input.structure"])
 
             ph_doc = {"structure": structure.as_dict()}
-            ph_doc["phonon"] = self.get_phonon_properties(item)
+            # the outputs of a managed run have already been parsed in get_items
+            ph_doc["phonon"] = item["phonon"] if self.managed else self.get_phonon_properties(item)
             ph_doc[self.phonon.key] = item[self.materials.key]
 
             return ph_doc
@@ -116,6 +191,9 @@ class PhononBuilder(Builder):
             self.logger.warning(
                 "Error generating the phonon properties for {}: {}".format(item["mp_id"], e))
             return None
+        finally:
+            if "rundir" in item:
+                AnaddbRunner.cleanup(item["rundir"])
 
     def get_phonon_properties(self, item):
         """
@@ -125,7 +203,22 @@ class PhononBuilder(Builder):
         # the temp dir should still exist when using the objects as some readings are done lazily
         with tempfile.TemporaryDirectory() as workdir:
             phbst_file, phdos_file, ananc_file, labels_list = self.run_anaddb(item, workdir=workdir)
+            return self.get_properties_from_files(phbst_file, phdos_file, ananc_file, labels_list)
+
+    def get_properties_from_dir(self, workdir, labels_list):
+        """
+        Extracts the phonon properties from the outputs of a managed anaddb run
+        """
+        phbst_file = PhbstFile(os.path.join(workdir, PHBST_FILE))
+        phdos_file = PhdosFile(os.path.join(workdir, PHDOS_FILE))
+        ananc_file = AnaddbNcFile.from_file(os.path.join(workdir, ANADDB_NC_FILE))
+        return self.get_properties_from_files(phbst_file, phdos_file, ananc_file, labels_list)
 
+    def get_properties_from_files(self, phbst_file, phdos_file, ananc_file, labels_list):
+        """
+        Extracts the phonon properties from the anaddb output files
+        """
+        try:
             phbands = phbst_file.phbands
             phbands.read_non_anal_from_file(phbst_file.filepath)
 
@@ -134,14 +227,9 @@ class PhononBuilder(Builder):
             complete_dos = phdos_file.to_pymatgen()
             phdos = phdos_file.phdos
 
-            tstart, tstop, nt = 5, 800, 160
-            temp = np.linspace(tstart, tstop, nt)
-
-            thermo = {"temperature": temp.tolist(),
-                      "entropy": phdos.get_entropy(tstart, tstop, nt).values.tolist(),
-                      "cv": phdos.get_cv(tstart, tstop, nt).values.tolist(),
-                      "free_energy": phdos.get_free_energy(tstart, tstop, nt).values.tolist(),
-                      }
+            thermo = get_phonon_thermodynamics(phdos.mesh, phdos.values, PHONON_TEMPERATURES)
+            thermo = {k: v.tolist() for k, v in thermo.items()}
+            thermo["temperature"] = PHONON_TEMPERATURES.tolist()
 
             data = {"dos": complete_dos.as_dict(),
                     "bs": symm_line_bands.as_dict(),
@@ -149,6 +237,9 @@ class PhononBuilder(Builder):
                     "becs": ananc_file.becs.values.tolist()}
 
             return jsanitize(data)
+        finally:
+            for f in (phbst_file, phdos_file, ananc_file):
+                f.close()
 
     def run_anaddb(self, item, workdir):
         """
@@ -339,6 +430,11 @@ class PhononBuilder(Builder):
         else:
             self.logger.info("No items to update")
 
+    def finalize(self, cursor=None):
+        if self._runner is not None:
+            self._runner.close()
+            self._runner = None
+        super().finalize(cursor)
 
     def ensure_indexes(self):
         """
@@ -349,4 +445,4 @@ class PhononBuilder(Builder):
         self.materials.ensure_index(self.materials.key, unique=True)
 
         # Search index for materials
-        self.phonon.ensure_index(self.diffraction.key, unique=True)
+        self.phonon.ensure_index(self.phonon.key, unique=True)
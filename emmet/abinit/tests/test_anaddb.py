@@ -0,0 +1,88 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+from emmet.abinit.anaddb import AnaddbRunner, DDB_FILE
+
+# Stub anaddb: reads the files file from stdin like anaddb and writes the
+# outputs, sleeping or failing depending on the input
+STUB_ANADDB = """
+import os, sys, time
+paths = [l.strip() for l in sys.stdin.readlines()]
+inp = open(paths[0]).read()
+assert open(paths[2]).read() == "DDB of " + os.path.basename(os.getcwd()).split("_")[0]
+if "sleep" in inp:
+    time.sleep(float(inp.split()[-1]))
+if "fail" in inp:
+    print("anaddb crashed")
+    sys.exit(3)
+for suffix in ["_PHBST.nc", "_PHDOS.nc"]:
+    open(paths[5] + suffix, "w").close()
+if "partial" not in inp:
+    open("anaddb.nc", "w").close()
+open(paths[1], "w").write("Calculation completed.")
+"""
+
+
+class TestAnaddbRunner(unittest.TestCase):
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        self.stub = os.path.join(self.scratch, "anaddb_stub.py")
+        with open(self.stub, "w") as f:
+            f.write(STUB_ANADDB)
+        self.runner = AnaddbRunner(scratch_dir=self.scratch, num_workers=3, timeout=2, poll_interval=0.01,
+                                   anaddb_cmd="{} {}".format(sys.executable, self.stub),
+                                   expected_outputs=["out_PHBST.nc", "out_PHDOS.nc", "anaddb.nc"])
+
+    def tearDown(self):
+        self.runner.close()
+        self.assertEqual(os.listdir(self.scratch), ["anaddb_stub.py"])
+        os.remove(self.stub)
+        os.rmdir(self.scratch)
+
+    def test_stage(self):
+        rundir = self.runner.stage("mp-1", b"DDB of mp-1", "ifcflag 1")
+        self.assertEqual(os.path.dirname(rundir), self.runner.workdir)
+        with open(os.path.join(rundir, DDB_FILE)) as f:
+            self.assertEqual(f.read(), "DDB of mp-1")
+        with open(os.path.join(rundir, "run.files")) as f:
+            self.assertEqual(len(f.readlines()), 7)
+
+        rundir = self.runner.stage("mp-2", open(os.path.join(rundir, DDB_FILE), "rb"))
+        self.assertEqual(os.listdir(rundir), [DDB_FILE])
+        self.runner.cleanup(rundir)
+        self.assertFalse(os.path.exists(rundir))
+
+    def test_run(self):
+        inputs = {"mp-1": "sleep 0.3", "mp-2": "sleep 0.1", "mp-3": "fail", "mp-4": "partial", "mp-5": "sleep 10",
+                  "mp-6": "ok"}
+        staged = []
+
+        def runs():
+            for mp_id, inp in sorted(inputs.items()):
+                staged.append(mp_id)
+                yield mp_id, self.runner.stage(mp_id, "DDB of {}".format(mp_id).encode(), inp)
+
+        start = time.time()
+        results = {}
+        for mp_id, rundir, error in self.runner.run(runs()):
+            # runs are staged lazily: besides the finished ones at most num_workers are running
+            self.assertLessEqual(len(staged), len(results) + 1 + 3)
+            results[mp_id] = error
+            if error is None:
+                self.assertTrue(os.path.exists(os.path.join(rundir, "anaddb.nc")))
+
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(set(results.keys()), set(inputs.keys()))
+        for mp_id in ["mp-1", "mp-2", "mp-6"]:
+            self.assertIsNone(results[mp_id])
+        self.assertIn("exited with code 3", results["mp-3"])
+        self.assertIn("anaddb crashed", results["mp-3"])
+        self.assertIn("missing outputs anaddb.nc", results["mp-4"])
+        self.assertIn("timeout", results["mp-5"])
+
+
+if __name__ == "__main__":
+    unittest.main()
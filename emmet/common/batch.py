@@ -0,0 +1,307 @@
+import logging
+import multiprocessing
+import os
+import time
+from multiprocessing.connection import wait
+
+from maggma.utils import grouper
+
+logger = logging.getLogger(__name__)
+
+# Builder instance of a batch worker process, set up once per process
+_worker_builder = None
+
+
+def _init_worker(builder, timeout):
+    global _worker_builder
+    _worker_builder = builder
+    if timeout is not None:
+        _worker_builder.timeout = timeout
+
+
+def _process_item(item):
+    return _worker_builder.process_item(item)
+
+
+def _supervised_process_item(builder, item, conn):
+    try:
+        conn.send(("done", builder.process_item(item)))
+    except Exception as e:
+        conn.send(("error", "{}: {}".format(e.__class__.__name__, e)))
+    finally:
+        conn.close()
+
+
+def _get_uss(pid):
+    """
+    Memory of a process in bytes that is not shared with other processes
+    (unique set size), or None if unknown.
+
+    Pages a forked worker still shares copy-on-write with the parent are
+    not counted, so the memory budget applies to what the item costs and
+    not to the size of the parent.  Where /proc/<pid>/smaps_rollup is not
+    available (Linux < 4.14), the resident set size is used instead, which
+    includes those shared pages.
+    """
+    try:
+        with open("/proc/{}/smaps_rollup".format(pid)) as f:
+            return sum(int(line.split()[1]) * 1024 for line in f
+                       if line.startswith(("Private_Clean:", "Private_Dirty:")))
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    try:
+        with open("/proc/{}/statm".format(pid)) as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+class BatchRunner(object):
+
+    def __init__(self, builders, num_workers=None, chunk_size=None,
+                 timeout=None):
+        """
+        Runs MapBuilders with expensive per-item analyses (e.g., matminer
+        featurizers or pymatgen near-neighbor methods) in a process pool.
+
+        Unlike maggma's multiprocessing runner, which serializes the
+        builder (and thereby rebuilds its featurizers) for every item,
+        each worker process receives the builder once when it starts and
+        only items are passed to it afterwards.  Items are streamed from
+        get_items in chunks; while one chunk is processed by the pool,
+        the results of the previous one are written with a single
+        update_targets call.
+
+        Args:
+            builders ([MapBuilder]): builders to run one after the other.
+            num_workers (int): number of worker processes (default: number
+                               of CPUs).
+            chunk_size (int): number of items per chunk (default: the
+                              builder's chunk_size).
+            timeout (int): maximum processing time per item in seconds;
+                           overrides the builder's timeout.  Items that run
+                           longer get the MapBuilder error document.
+        """
+        self.builders = builders
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+
+    def run(self):
+        for builder in self.builders:
+            self.run_builder(builder)
+
+    def run_builder(self, builder):
+        """
+        Runs a single builder.
+
+        Args:
+            builder (MapBuilder): the builder to run.
+        """
+        builder.connect()
+        cursor = builder.get_items()
+        chunk_size = self.chunk_size or builder.chunk_size
+        num_workers = self.num_workers or multiprocessing.cpu_count()
+        logger.info("Running {} with {} worker processes".format(
+            builder.__class__.__name__, num_workers))
+
+        pool = multiprocessing.Pool(num_workers, initializer=_init_worker,
+                                    initargs=(builder, self.timeout))
+        try:
+            pending = None
+            for chunk in grouper(cursor, chunk_size):
+                chunk = [item for item in chunk if item is not None]
+                result = pool.map_async(_process_item, chunk,
+                                        chunksize=max(1, len(chunk) // (4 * num_workers)))
+                if pending is not None:
+                    self.update_targets(builder, pending.get())
+                pending = result
+            if pending is not None:
+                self.update_targets(builder, pending.get())
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        builder.finalize(cursor)
+
+    @staticmethod
+    def update_targets(builder, processed_items):
+        logger.info("Updating {} items of {}".format(
+            len(processed_items), builder.__class__.__name__))
+        builder.update_targets(processed_items)
+
+
+class SupervisedRunner(object):
+
+    def __init__(self, builders, quarantine, num_workers=None, timeout=3600,
+                 memory_limit=None, chunk_size=None, poll_interval=1):
+        """
+        Runs builders whose analyses can run away on single pathological
+        structures (e.g., VoronoiNN, CrystalNN, SubstrateAnalyzer or
+        robocrys) with a wall-clock and memory budget per item.
+
+        Every item is processed in its own forked worker process, which
+        inherits the builder and its featurizers.  Workers that exceed
+        the budget are killed, and their items are recorded in the
+        quarantine store together with the last-updated value of the
+        source document.  Quarantined items are skipped on later runs
+        until their source document changes.  Successful results are
+        written in chunks with update_targets.
+
+        Args:
+            builders ([Builder]): builders to run one after the other;
+                                  items must carry the key (and
+                                  preferably the lu_field) of the
+                                  builder's first source.
+            quarantine (Store): store of quarantined items.
+            num_workers (int): number of concurrent worker processes
+                               (default: number of CPUs).
+            timeout (float): maximum wall-clock time per item in seconds.
+            memory_limit (int): maximum memory per item in bytes, not
+                                counting pages shared with the parent
+                                (only enforced where /proc is available).
+            chunk_size (int): number of results per update_targets call
+                              (default: the builder's chunk_size).
+            poll_interval (float): seconds between checks of the workers.
+        """
+        self.builders = builders
+        self.quarantine = quarantine
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+
+    def run(self):
+        for builder in self.builders:
+            self.run_builder(builder)
+
+    @staticmethod
+    def get_source(builder):
+        return getattr(builder, "source", None) or builder.sources[0]
+
+    def get_quarantined(self, builder):
+        """
+        Returns:
+            dict: key -> source last-updated value of quarantined items
+        """
+        docs = self.quarantine.query(
+            criteria={"builder": builder.__class__.__name__, "quarantined": True},
+            properties=["key", "source_lu"])
+        return {d["key"]: d.get("source_lu") for d in docs}
+
+    def is_quarantined(self, builder, item, quarantined):
+        source = self.get_source(builder)
+        key = item.get(source.key)
+        if key not in quarantined:
+            return False
+        lu = item.get(source.lu_field)
+        return lu is None or quarantined[key] is None or \
+            source.lu_func[0](lu) <= quarantined[key]
+
+    def update_quarantine(self, builder, item, reason, elapsed=None):
+        source = self.get_source(builder)
+        lu = item.get(source.lu_field)
+        doc = {
+            "key": item.get(source.key),
+            "builder": builder.__class__.__name__,
+            "quarantined": reason is not None,
+            "reason": reason,
+            "source_lu": source.lu_func[0](lu) if lu is not None else None,
+            "elapsed": elapsed,
+        }
+        self.quarantine.update([doc], key=["key", "builder"])
+
+    def run_builder(self, builder):
+        """
+        Runs a single builder.
+
+        Args:
+            builder (Builder): the builder to run.
+        """
+        builder.connect()
+        self.quarantine.connect()
+        cursor = builder.get_items()
+        chunk_size = self.chunk_size or builder.chunk_size
+        num_workers = self.num_workers or multiprocessing.cpu_count()
+        name = builder.__class__.__name__
+        source = self.get_source(builder)
+        quarantined = self.get_quarantined(builder)
+        logger.info("Running {} with {} supervised workers, skipping up to {} "
+                    "quarantined items".format(name, num_workers, len(quarantined)))
+
+        ctx = multiprocessing.get_context("fork")
+        running = {}
+        results = []
+        items = iter(cursor)
+        exhausted = False
+        n_skipped = 0
+
+        while running or not exhausted:
+            # Keep all workers busy
+            while not exhausted and len(running) < num_workers:
+                item = next(items, None)
+                if item is None:
+                    exhausted = True
+                elif self.is_quarantined(builder, item, quarantined):
+                    n_skipped += 1
+                else:
+                    recv_conn, send_conn = ctx.Pipe(duplex=False)
+                    proc = ctx.Process(target=_supervised_process_item,
+                                       args=(builder, item, send_conn))
+                    proc.start()
+                    send_conn.close()
+                    running[recv_conn] = (proc, item, time.time())
+
+            if not running:
+                continue
+            wait(list(running.keys()), timeout=self.poll_interval)
+
+            for conn, (proc, item, start) in list(running.items()):
+                elapsed = time.time() - start
+                reason = None
+                # A worker sends its result before exiting, so checking if it
+                # is alive before polling never misses the result of a worker
+                # that exits in between.
+                alive = proc.is_alive()
+                if conn.poll():
+                    try:
+                        status, result = conn.recv()
+                    except EOFError:
+                        status, result = "crashed", None
+                    if status == "done":
+                        results.append(result)
+                        if item.get(source.key) in quarantined:
+                            self.update_quarantine(builder, item, None, elapsed)
+                    else:
+                        reason = result or status
+                elif not alive:
+                    reason = "crashed with exit code {}".format(proc.exitcode)
+                elif self.timeout and elapsed > self.timeout:
+                    reason = "timeout after {:.0f} s".format(elapsed)
+                elif self.memory_limit and (_get_uss(proc.pid) or 0) > self.memory_limit:
+                    reason = "memory limit of {} bytes exceeded".format(self.memory_limit)
+                else:
+                    continue
+
+                if reason is not None:
+                    logger.warning("Quarantining {} in {}: {}".format(
+                        item.get(source.key), name, reason))
+                    self.update_quarantine(builder, item, reason, elapsed)
+                if proc.is_alive():
+                    proc.terminate()
+                proc.join()
+                conn.close()
+                del running[conn]
+
+            if len(results) >= chunk_size:
+                builder.update_targets(results)
+                results = []
+
+        if results:
+            builder.update_targets(results)
+        logger.info("Skipped {} quarantined items in {}".format(n_skipped, name))
+        builder.finalize(cursor)
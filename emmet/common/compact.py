@@ -0,0 +1,98 @@
+"""
+Compact storage of numerical arrays as BSON binary.
+
+Arrays are packed as little-endian float32 (or other fixed-size dtypes)
+behind a small header, which is several times smaller than nested JSON
+lists of doubles.  unpack_doc restores the original nested-list layout, so
+readers can stay agnostic of the storage format.
+"""
+import struct
+
+import numpy as np
+from bson.binary import Binary, USER_DEFINED_SUBTYPE
+
+PACKED_ARRAY_SUBTYPE = USER_DEFINED_SUBTYPE
+PACKED_ARRAY_MAGIC = b"EMA1"
+
+# Header: magic, dtype character, number of dimensions
+_HEADER = struct.Struct("<4scB")
+_DTYPES = {"f": "<f4", "d": "<f8", "i": "<i4", "q": "<i8"}
+
+
+def pack_array(values, dtype="f"):
+    """
+    Packs a numerical array into BSON binary.
+
+    Args:
+        values (array-like): the values; any rectangular shape
+        dtype (str): "f" (float32), "d" (float64), "i" (int32)
+            or "q" (int64)
+
+    Returns:
+        Binary: header followed by the shape and the raw array data
+    """
+    arr = np.ascontiguousarray(values, dtype=_DTYPES[dtype])
+    header = _HEADER.pack(PACKED_ARRAY_MAGIC, dtype.encode(), arr.ndim)
+    shape = struct.pack("<{}I".format(arr.ndim), *arr.shape)
+    return Binary(header + shape + arr.tobytes(), PACKED_ARRAY_SUBTYPE)
+
+
+def is_packed_array(obj):
+    return isinstance(obj, Binary) and obj.subtype == PACKED_ARRAY_SUBTYPE \
+        and bytes(obj[:4]) == PACKED_ARRAY_MAGIC
+
+
+def unpack_array(data):
+    """
+    Unpacks an array packed with pack_array.
+
+    Args:
+        data (Binary): the packed array
+
+    Returns:
+        np.ndarray
+    """
+    data = bytes(data)
+    magic, dtype, ndim = _HEADER.unpack_from(data)
+    if magic != PACKED_ARRAY_MAGIC:
+        raise ValueError("Not a packed array")
+    dtype = dtype.decode()
+    shape = struct.unpack_from("<{}I".format(ndim), data, _HEADER.size)
+    offset = _HEADER.size + 4 * ndim
+    return np.frombuffer(data, dtype=_DTYPES[dtype], offset=offset).reshape(shape)
+
+
+def pack_fields(doc, fields, dtype="f"):
+    """
+    Returns a copy of doc with the given top-level fields packed.
+
+    Args:
+        doc (dict): document with numerical list fields
+        fields ([str]): names of the fields to pack
+        dtype (str): dtype character, see pack_array
+    """
+    doc = dict(doc)
+    for f in fields:
+        if doc.get(f) is not None:
+            doc[f] = pack_array(doc[f], dtype=dtype)
+    return doc
+
+
+def unpack_doc(doc):
+    """
+    Recursively replaces packed arrays in a document by nested lists, so
+    that compact documents read like regular ones.
+
+    Args:
+        doc: a document (or any value inside one)
+
+    Returns:
+        the document with all packed arrays unpacked
+    """
+    if is_packed_array(doc):
+        return unpack_array(doc).tolist()
+    elif isinstance(doc, dict):
+        return {k: unpack_doc(v) for k, v in doc.items()}
+    elif isinstance(doc, list):
+        return [unpack_doc(v) for v in doc]
+    return doc
@@ -0,0 +1,73 @@
+"""
+Harmonic thermodynamic properties from phonon densities of states.
+
+All properties are computed together in one vectorized evaluation over
+temperatures and frequencies, for a single DOS or a batch of them, with the
+same integrals as abipy's PhononDos (get_internal_energy, get_entropy,
+get_cv and get_free_energy).
+"""
+import numpy as np
+
+# Boltzmann constant in eV/K
+KB_EV_K = 8.617333262145e-05
+
+# Default temperature grid of phonon documents in K
+PHONON_TEMPERATURES = np.linspace(5, 800, 160)
+
+
+def get_phonon_thermodynamics(frequencies, densities, temperatures=PHONON_TEMPERATURES):
+    """
+    Computes the vibrational internal energy, entropy, heat capacity and
+    free energy of phonon DOS on a temperature grid.
+
+    Only positive frequencies are integrated, with the trapezoidal rule.
+    A batch of DOS on different meshes can be padded to a common length with
+    frequencies <= 0, which are ignored.  Memory scales with the number of
+    DOS x temperatures x frequencies, so large batches should be chunked.
+
+    Args:
+        frequencies (array): frequency mesh in eV, shape (nw,) or (n, nw)
+        densities (array): DOS on the mesh in states/eV, same shape
+        temperatures (array): temperatures in K, shape (nt,)
+
+    Returns:
+        dict: "internal_energy" (eV), "entropy" (eV/K), "cv" (eV/K) and
+            "free_energy" (eV), each of shape (nt,) or (n, nt)
+    """
+    w = np.asarray(frequencies, dtype=float)
+    gw = np.asarray(densities, dtype=float)
+    temps = np.asarray(temperatures, dtype=float)
+
+    # Trapezoidal weights of the DOS, restricted to segments between positive frequencies
+    positive = w > 1e-12
+    w = np.where(positive, w, 1.0)
+    dw = np.where(positive[..., 1:] & positive[..., :-1], np.diff(w, axis=-1), 0.0)
+    weights = np.zeros_like(w)
+    weights[..., 1:] += dw / 2
+    weights[..., :-1] += dw / 2
+    weights *= np.where(positive, gw, 0.0)
+
+    # x = w / 2kT on the (temperatures x frequencies) grid and the functions of it
+    hot = temps > 0
+    kt = KB_EV_K * np.where(hot, temps, 1.0)
+    x = w[..., None, :] / (2 * kt[:, None])
+    exp_2x = np.exp(-2 * x)
+    one_minus_exp_2x = -np.expm1(-2 * x)
+    coth = (1 + exp_2x) / one_minus_exp_2x
+    log_2sinh = x + np.log1p(-exp_2x)
+    csch2 = 4 * exp_2x / one_minus_exp_2x ** 2
+
+    weights = weights[..., None, :]
+    internal_energy = np.sum(w[..., None, :] * coth * weights, axis=-1) / 2
+    entropy = KB_EV_K * np.sum((x * coth - log_2sinh) * weights, axis=-1)
+    cv = KB_EV_K * np.sum(x ** 2 * csch2 * weights, axis=-1)
+    free_energy = kt * np.sum(log_2sinh * weights, axis=-1)
+
+    # At 0 K only the zero-point energy remains
+    zero_point_energy = np.sum(w[..., None, :] * weights, axis=-1) / 2
+    internal_energy = np.where(hot, internal_energy, zero_point_energy)
+    free_energy = np.where(hot, free_energy, zero_point_energy)
+    entropy = np.where(hot, entropy, 0.0)
+    cv = np.where(hot, cv, 0.0)
+
+    return {"internal_energy": internal_energy, "entropy": entropy, "cv": cv, "free_energy": free_energy}
@@ -0,0 +1,103 @@
+"""
+Prefetching of documents for builders whose items need large related
+documents, such as band structures.
+
+Documents are queried for chunks of keys at a time instead of one query per
+key, and the related documents are fetched by a bounded pool of threads
+ahead of the consumer, so that processing an item never waits on I/O.
+"""
+import json
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from maggma.stores import GridFSStore
+from maggma.utils import grouper
+from pydash.objects import get
+
+
+def query_in_chunks(store, keys, properties=None, chunk_size=1000, field=None):
+    """
+    Queries the documents of a store for chunks of keys at a time
+
+    Args:
+        store (Store): the store
+        keys ([str]): keys of the documents
+        properties ([str]): properties to project the documents to
+        chunk_size (int): number of keys per query
+        field (str): field the keys are values of (default: the key of the store)
+
+    Returns:
+        generator of documents
+    """
+    field = field or store.key
+    for chunk in grouper(sorted(keys), chunk_size):
+        chunk = [k for k in chunk if k is not None]
+        for doc in store.query(criteria={field: {"$in": chunk}}, properties=properties):
+            yield doc
+
+
+def query_by_field(store, field, values, properties=None):
+    """
+    Queries the documents of a store whose field is one of values, keyed by
+    the value of the field. Only the first document for each value is kept.
+
+    GridFS stores keep the fields they are queried by in the metadata of the
+    files, not in the stored documents, so for these the value is read from
+    the metadata; they also return whole documents regardless of properties.
+
+    Args:
+        store (Store): the store
+        field (str): field to query and key the documents by
+        values ([str]): values of the field
+        properties ([str]): properties to project the documents to
+
+    Returns:
+        dict: documents by the value of their field
+    """
+    docs = {}
+    if isinstance(store, GridFSStore):
+        for f in store.collection.find({"metadata.{}".format(field): {"$in": list(values)}}):
+            value = f.metadata[field]
+            if value in docs:
+                continue
+            data = f.read()
+            if f.metadata.get("compression", "") == "zlib":
+                data = zlib.decompress(data)
+            docs[value] = json.loads(data)
+    else:
+        if properties is not None:
+            properties = list(properties) + [field]
+        for d in store.query(criteria={field: {"$in": list(values)}}, properties=properties):
+            docs.setdefault(get(d, field), d)
+    return docs
+
+
+def prefetch_map(func, items, num_threads=4, max_pending=None):
+    """
+    Applies func to items in a pool of threads, keeping at most max_pending
+    calls ahead of the consumer, and yields the results in order
+
+    Args:
+        func (callable): function to apply, e.g. a download
+        items (iterable): the items
+        num_threads (int): number of threads
+        max_pending (int): maximum number of calls submitted but not yet
+            consumed (default: twice the number of threads)
+
+    Returns:
+        generator of func(item) for all items
+    """
+    max_pending = max_pending or 2 * num_threads
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        try:
+            for item in items:
+                pending.append(executor.submit(func, item))
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
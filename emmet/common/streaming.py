@@ -0,0 +1,411 @@
+"""
+Streaming reads of (compressed) JSON documents from GridFS.
+
+Large documents such as uniform band structures are read from GridFS in
+chunks, which pass through an incremental zlib decompressor into an
+incremental JSON parser.  Neither the compressed nor the decompressed file
+is held in memory as a whole, and numerical arrays in selected fields are
+decoded directly into numpy arrays instead of nested lists of floats.
+"""
+import codecs
+import json
+import re
+import zlib
+
+import numpy as np
+
+CHUNK_SIZE = 1 << 20
+
+# Fields of band structure documents decoded into numpy arrays
+BANDSTRUCTURE_ARRAY_FIELDS = ("bands", "projections", "kpoints")
+
+_NUMBER = r"(?:-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][-+]?\d+)?|NaN|-?Infinity)"
+_NUMLIST = r"\[\s*(?:{num}(?:\s*,\s*{num})*)?\s*\]".format(num=_NUMBER)
+# Runs of sibling lists of numbers (rows of a matrix) are a single token
+_TOKEN = re.compile(r"""\s*(?:
+    (?P<numlists>{numlist}(?:\s*,\s*{numlist})*)
+  | (?P<string>"[^"\\]*(?:\\.[^"\\]*)*")
+  | (?P<number>{num})
+  | (?P<punct>[{{}}\[\],:])
+  | (?P<literal>true|false|null)
+)""".format(num=_NUMBER, numlist=_NUMLIST), re.VERBOSE)
+_ROW_SEP = re.compile(r"\]\s*,\s*\[")
+# Maximum nesting depth of lists of numbers decoded in one go
+_MAX_DEPTH = 64
+_EMPTY_LIST = re.compile(br"\[\s*\]")
+_BRACKETS_TO_SPACES = bytes.maketrans(b"[]", b"  ")
+_LITERALS = {"true": True, "false": False, "null": None}
+
+
+def iter_gridfs_chunks(grid_out, chunk_size=CHUNK_SIZE):
+    """
+    Iterates over the contents of a GridFS file in chunks
+
+    Args:
+        grid_out (GridOut): the GridFS file
+        chunk_size (int): maximum number of bytes per chunk
+    """
+    while True:
+        data = grid_out.read(chunk_size)
+        if not data:
+            break
+        yield data
+
+
+def iter_decompressed(chunks, compression=""):
+    """
+    Decompresses a stream of chunks incrementally
+
+    Args:
+        chunks (iterable): chunks of bytes
+        compression (str): compression of the stream; only zlib is supported,
+            anything else passes the chunks through
+    """
+    if "zlib" not in (compression or ""):
+        for chunk in chunks:
+            yield chunk
+        return
+
+    decompressor = zlib.decompressobj()
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+class _Frame(object):
+    __slots__ = ["container", "key", "expect_key", "arrays"]
+
+    def __init__(self, container, arrays):
+        self.container = container
+        self.key = None
+        self.expect_key = isinstance(container, dict)
+        self.arrays = arrays
+
+
+class StreamingJSONParser(object):
+    """
+    Incremental JSON parser, which is fed with chunks of bytes.
+
+    Lists of numbers in the values of array_fields (at any depth) are
+    decoded into numpy arrays, and lists of equally shaped arrays are
+    stacked into one array.  Nested lists of numbers that are buffered
+    completely, such as the eigenvalues of one band, are decoded in a single
+    pass with numpy, which keeps the parser fast for numerical documents.
+    """
+
+    # Minimum amount of buffered text before tokens are parsed, so that
+    # innermost lists of numbers are usually complete
+    lookahead = 1 << 16
+
+    # Maximum size of the text of a list of numbers that is buffered to be
+    # decoded in one go; larger lists are decoded in parts and stacked
+    max_block = 1 << 24
+
+    def __init__(self, array_fields=()):
+        """
+        Args:
+            array_fields ([str]): keys whose values are decoded into arrays
+        """
+        self.array_fields = set(array_fields)
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._stack = []
+        self._done = False
+        self._wait_for = 0
+        self._block_window = 1 << 14
+        self.result = None
+
+    def feed(self, data):
+        """
+        Parses a chunk of the document
+
+        Args:
+            data (bytes): the chunk
+        """
+        self._buffer += self._decoder.decode(data)
+        self._parse(final=False)
+
+    def close(self):
+        """
+        Parses the rest of the document
+
+        Returns:
+            the decoded document
+        """
+        self._buffer += self._decoder.decode(b"", final=True)
+        self._parse(final=True)
+        if self._stack or not self._done:
+            raise ValueError("Incomplete JSON document")
+        return self.result
+
+    def _parse(self, final):
+        if not final and len(self._buffer) < self._wait_for:
+            return
+        self._wait_for = 0
+        buf = self._buffer
+        pos = 0
+        end = len(buf)
+        while True:
+            if not final and end - pos < self.lookahead:
+                break
+            m = _TOKEN.match(buf, pos)
+            if m is None or (not final and m.end() == end):
+                if final and buf[pos:].strip():
+                    raise ValueError("Invalid JSON at: {}".format(buf[pos:pos + 50]))
+                break
+            pos = m.end()
+            kind = m.lastgroup
+            token = m.group(kind)
+            if token == "[" and self._in_arrays():
+                # Decode a nested list of numbers that is buffered completely
+                # in one go, otherwise parse it token by token
+                start = m.start(kind)
+                block, at_end = _match_block(buf, start, self._block_window)
+                if at_end and not final and end - start < self.max_block:
+                    # Wait for the rest of the list, until the buffer has
+                    # doubled so that the list is not rescanned too often
+                    pos = start
+                    self._wait_for = 2 * (end - start)
+                    break
+                if block is not None:
+                    # Sibling lists are usually equally long
+                    self._block_window = max(1 << 14, len(block[0]) + len(block[0]) // 8)
+                    pos = start + len(block[0])
+                    value = _parse_block(*block)
+                    if value is not None:
+                        self._add(value)
+                        continue
+                    pos = m.end()
+            if kind == "punct":
+                self._punct(token)
+            elif kind == "string":
+                s = token[1:-1] if "\\" not in token else json.loads(token)
+                frame = self._stack[-1] if self._stack else None
+                if frame is not None and frame.expect_key:
+                    frame.key = s
+                    frame.expect_key = False
+                else:
+                    self._add(s)
+            elif kind == "number":
+                self._add(json.loads(token))
+            elif kind == "numlists":
+                if self._in_arrays():
+                    self._add(_Rows(_parse_rows(token)))
+                else:
+                    for value in json.loads("[" + token + "]"):
+                        self._add(value)
+            else:
+                self._add(_LITERALS[token])
+        self._buffer = buf[pos:]
+
+    def _punct(self, token):
+        if token in "{[":
+            self._stack.append(_Frame({} if token == "{" else [], self._in_arrays()))
+        elif token in "}]":
+            frame = self._stack.pop()
+            value = frame.container
+            if frame.arrays and isinstance(value, list):
+                value = _to_array(value)
+            elif isinstance(value, list):
+                value = _expand_rows(value)
+            self._add(value)
+        elif token == ",":
+            frame = self._stack[-1]
+            if isinstance(frame.container, dict):
+                frame.expect_key = True
+
+    def _in_arrays(self):
+        # Whether a value added now is (part of) the value of an array field
+        if not self._stack:
+            return False
+        frame = self._stack[-1]
+        return frame.arrays or (isinstance(frame.container, dict) and frame.key in self.array_fields)
+
+    def _add(self, value):
+        if not self._stack:
+            self.result = value[0] if isinstance(value, _Rows) else value
+            self._done = True
+            return
+        frame = self._stack[-1]
+        if isinstance(frame.container, dict):
+            # A dict value is always a single list
+            frame.container[frame.key] = value[0] if isinstance(value, _Rows) else value
+        else:
+            frame.container.append(value)
+
+
+class _Rows(object):
+    # Consecutive list elements parsed from one token, either a 2D array of
+    # equally long rows or a list of 1D arrays
+    __slots__ = ["rows"]
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __getitem__(self, i):
+        return self.rows[i]
+
+
+def _match_block(buf, start, window=1 << 14):
+    # Complete nested list of plain numbers starting at buf[start] as bytes
+    # with the nesting depth after each byte, if any, and whether the list
+    # may continue beyond the end of the buffer.  The text is scanned in
+    # pieces of growing size, so that the scan stops soon after the end of
+    # the list rather than running through its siblings.
+    raws = []
+    depths = []
+    offset = start
+    level = 0
+    while offset < len(buf):
+        raw = buf[offset:offset + window].encode("utf-8")
+        b = np.frombuffer(raw, dtype=np.uint8)
+        n = _numeric_length(b)
+        depth = np.cumsum(_depth_steps(b[:n]), dtype=np.int32) + level
+        closed = np.flatnonzero(depth == 0)
+        if len(closed):
+            n = closed[0] + 1
+        if n and depth[:n].max() > _MAX_DEPTH:
+            return None, False
+        raws.append(raw[:n])
+        depths.append(depth[:n].astype(np.int8))
+        if len(closed):
+            return (b"".join(raws), np.concatenate(depths)), False
+        if n < len(b):
+            return None, False
+        offset += n
+        level = int(depth[-1])
+        window = min(4 * window, 1 << 20)
+    return None, True
+
+
+def _numeric_length(b):
+    # Length of the prefix of b made of brackets, commas, whitespace and
+    # digits, signs, points and exponents of numbers
+    numeric = ((b >= ord("+")) & (b <= ord("9")) & (b != ord("/"))) | (b == ord(" ")) \
+        | (b == ord("[")) | (b == ord("]")) | (b == ord("e")) | (b == ord("E")) \
+        | (b == ord("\n")) | (b == ord("\r")) | (b == ord("\t"))
+    invalid = np.flatnonzero(~numeric)
+    return invalid[0] if len(invalid) else len(b)
+
+
+def _depth_steps(b):
+    # Change of the nesting depth at each byte
+    return (b == ord("[")).view(np.int8) - (b == ord("]")).view(np.int8)
+
+
+def _parse_block(raw, depth):
+    # Decodes a nested list of numbers into an array, or returns None if the
+    # lists are not rectangular
+    if _EMPTY_LIST.search(raw):
+        return None
+    b = np.frombuffer(raw, dtype=np.uint8)
+    opens = b == ord("[")
+    commas = b == ord(",")
+    shape = []
+    n_lists = 1
+    for level in range(1, depth.max() + 1):
+        at_level = depth == level
+        list_pos = np.flatnonzero(opens & at_level)
+        if len(list_pos) != n_lists:
+            return None
+        comma_pos = np.flatnonzero(commas & at_level)
+        children = np.bincount(np.searchsorted(list_pos, comma_pos, side="right") - 1,
+                               minlength=n_lists) + 1
+        if np.any(children != children[0]):
+            return None
+        shape.append(int(children[0]))
+        n_lists *= int(children[0])
+    values = np.fromstring(raw.translate(_BRACKETS_TO_SPACES), dtype=float, sep=",")
+    if values.size != n_lists:
+        return None
+    return values.reshape(shape)
+
+
+def _parse_numbers(text):
+    if not text.strip():
+        return np.array([], dtype=float)
+    if "N" in text or "I" in text:
+        return np.array(text.split(","), dtype=float)
+    return np.fromstring(text, dtype=float, sep=",")
+
+
+def _parse_rows(token):
+    rows = _ROW_SEP.split(token.strip()[1:-1])
+    lengths = set(r.count(",") for r in rows)
+    if len(lengths) == 1 and "N" not in token and "I" not in token and all(r.strip() for r in rows):
+        # All rows equally long: parse them in one go
+        values = np.fromstring(",".join(rows), dtype=float, sep=",")
+        if values.size == len(rows) * (lengths.pop() + 1):
+            return values.reshape(len(rows), -1)
+    return [_parse_numbers(r) for r in rows]
+
+
+def _expand_rows(items):
+    if not any(isinstance(i, _Rows) for i in items):
+        return items
+    expanded = []
+    for i in items:
+        if isinstance(i, _Rows):
+            expanded.extend(i.rows)
+        else:
+            expanded.append(i)
+    return expanded
+
+
+def _to_array(items):
+    # Lists of numbers or of equally shaped arrays become one array
+    if items and all(isinstance(i, _Rows) and isinstance(i.rows, np.ndarray) for i in items) \
+            and len(set(i.rows.shape[1] for i in items)) == 1:
+        return np.concatenate([i.rows for i in items])
+    items = _expand_rows(items)
+    if all(isinstance(i, np.ndarray) for i in items):
+        if len(set(i.shape for i in items)) == 1:
+            return np.stack(items)
+        return items
+    if all(isinstance(i, (int, float)) and not isinstance(i, bool) for i in items):
+        return np.array(items, dtype=float)
+    return items
+
+
+def load_json_stream(chunks, compression="", array_fields=()):
+    """
+    Decodes a JSON document from a stream of (compressed) chunks
+
+    Args:
+        chunks (iterable): chunks of bytes
+        compression (str): compression of the stream, e.g. "zlib"
+        array_fields ([str]): keys whose values are decoded into arrays
+
+    Returns:
+        the decoded document
+    """
+    parser = StreamingJSONParser(array_fields=array_fields)
+    for data in iter_decompressed(chunks, compression):
+        parser.feed(data)
+    return parser.close()
+
+
+def load_gridfs_json(fs, oid, compression="", array_fields=BANDSTRUCTURE_ARRAY_FIELDS,
+                     chunk_size=CHUNK_SIZE):
+    """
+    Streams a (compressed) JSON document from GridFS
+
+    Args:
+        fs (GridFS): the GridFS
+        oid (ObjectId): id of the file
+        compression (str): compression of the file, e.g. "zlib"
+        array_fields ([str]): keys whose values are decoded into arrays
+        chunk_size (int): number of bytes read at a time
+
+    Returns:
+        the decoded document
+    """
+    grid_out = fs.get(oid)
+    try:
+        return load_json_stream(iter_gridfs_chunks(grid_out, chunk_size), compression, array_fields)
+    finally:
+        grid_out.close()
@@ -0,0 +1,100 @@
+import numpy as np
+
+from pymatgen.core.sites import PeriodicSite
+from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+
+# Symmetry precision for finding equivalent sites; tighter than
+# magic_numbers.SYMPREC so that only sites with identical local
+# environments share per-site results
+SITE_SYMPREC = 0.01
+
+
+def get_equivalent_sites(structure, symprec=SITE_SYMPREC):
+    """
+    Finds the symmetry-equivalence classes of the sites in a structure
+
+    Args:
+        structure (Structure): the structure
+        symprec (float): symmetry precision for spglib
+
+    Returns:
+        [int]: for each site, the index of the representative site of its
+            equivalence class (spglib's equivalent_atoms). Every site is its
+            own representative if the symmetry analysis fails.
+    """
+    try:
+        dataset = SpacegroupAnalyzer(structure, symprec=symprec).get_symmetry_dataset()
+        return [int(i) for i in dataset["equivalent_atoms"]]
+    except Exception:
+        return list(range(len(structure)))
+
+
+def get_symmetrized_all_nn_info(structure, strategy, symprec=SITE_SYMPREC):
+    """
+    Equivalent of strategy.get_all_nn_info(structure) that only runs the
+    neighbor search for one representative site per symmetry-equivalence
+    class and maps its neighbors onto the equivalent sites with the
+    symmetry operations of the structure.
+
+    Args:
+        structure (Structure): the structure
+        strategy (NearNeighbors): near neighbor strategy
+        symprec (float): symmetry precision for spglib
+
+    Returns:
+        [[dict]]: for each site, the neighbor info dicts with "site",
+            "image", "weight" and "site_index"
+    """
+    try:
+        dataset = SpacegroupAnalyzer(structure, symprec=symprec).get_symmetry_dataset()
+        equivalent = [int(i) for i in dataset["equivalent_atoms"]]
+        rotations = np.array(dataset["rotations"])
+        translations = np.array(dataset["translations"])
+    except Exception:
+        return strategy.get_all_nn_info(structure)
+
+    lattice = structure.lattice
+    frac_coords = structure.frac_coords
+    tol = max(symprec, 1e-3) * 2
+
+    def find_site(fcoords):
+        # Index of the site at fcoords (modulo lattice translations)
+        diff = fcoords - frac_coords
+        diff -= np.round(diff)
+        dists = np.linalg.norm(lattice.get_cartesian_coords(diff), axis=1)
+        i = int(np.argmin(dists))
+        return i if dists[i] < tol else None
+
+    rep_info = {r: strategy.get_nn_info(structure, r) for r in sorted(set(equivalent))}
+
+    all_nn_info = []
+    for i, r in enumerate(equivalent):
+        if i == r:
+            all_nn_info.append(rep_info[r])
+            continue
+
+        info = None
+        images = np.dot(rotations, frac_coords[r]) + translations
+        for rot, trans, image in zip(rotations, translations, images):
+            shift = np.round(image - frac_coords[i])
+            if find_site(image - shift) != i:
+                continue
+            info = []
+            for nn in rep_info[r]:
+                coords = np.dot(rot, nn["site"].frac_coords) + trans - shift
+                j = find_site(coords)
+                if j is None or structure[j].species_string != nn["site"].species_string:
+                    info = None
+                    break
+                info.append({"site": PeriodicSite(structure[j].species_and_occu, coords, lattice,
+                                                  properties=structure[j].properties),
+                             "image": tuple(int(x) for x in np.round(coords - frac_coords[j])),
+                             "weight": nn["weight"],
+                             "site_index": j})
+            if info is not None:
+                break
+
+        # Fall back to a direct search if no operation maps the neighbors
+        all_nn_info.append(info if info is not None else strategy.get_nn_info(structure, i))
+
+    return all_nn_info
@@ -0,0 +1,139 @@
+import multiprocessing
+import os
+import time
+import unittest
+from datetime import datetime
+from multiprocessing.connection import Connection
+from unittest.mock import patch
+
+from maggma.builders import MapBuilder
+from maggma.stores import MemoryStore
+
+from emmet.common.batch import BatchRunner, SupervisedRunner, _get_uss
+
+
+class SquareBuilder(MapBuilder):
+    # Number of builder instances set up in this process
+    setups = 0
+
+    def __init__(self, source, target, **kwargs):
+        self.pid = None
+        super().__init__(source=source, target=target, ufn=self.calc, store_process_time=False, **kwargs)
+
+    def calc(self, item):
+        # pid of the builder instance, set on first use in each process
+        if self.pid is None:
+            SquareBuilder.setups += 1
+            self.pid = os.getpid()
+        return {"square": item["n"] ** 2, "builder_pid": self.pid, "setups": SquareBuilder.setups}
+
+
+class SlowBuilder(MapBuilder):
+    def __init__(self, source, target, **kwargs):
+        super().__init__(source=source, target=target, ufn=self.calc, store_process_time=False, **kwargs)
+
+    def calc(self, item):
+        if item["n"] == 3:
+            time.sleep(60)
+        return {"square": item["n"] ** 2}
+
+
+class DelayedBuilder(MapBuilder):
+    def __init__(self, source, target, **kwargs):
+        super().__init__(source=source, target=target, ufn=self.calc, store_process_time=False, **kwargs)
+
+    def calc(self, item):
+        time.sleep(0.3)
+        return {"square": item["n"] ** 2}
+
+
+class TestBatchRunner(unittest.TestCase):
+    def setUp(self):
+        self.source = MemoryStore("source")
+        self.target = MemoryStore("target")
+        self.source.connect()
+        self.source.update([{"task_id": "mp-{}".format(n), "n": n} for n in range(20)])
+
+    def test_run(self):
+        builder = SquareBuilder(self.source, self.target, chunk_size=6)
+        BatchRunner([builder], num_workers=2).run()
+
+        docs = list(self.target.query())
+        self.assertEqual(len(docs), 20)
+        for doc in docs:
+            self.assertEqual(doc["square"], int(doc["task_id"].split("-")[1]) ** 2)
+        self.assertLessEqual(len(set(doc["builder_pid"] for doc in docs)), 2)
+        # Each worker sets up its builder once for all its items
+        self.assertEqual({doc["setups"] for doc in docs}, {1})
+
+
+class TestSupervisedRunner(unittest.TestCase):
+    def setUp(self):
+        self.source = MemoryStore("source")
+        self.target = MemoryStore("target")
+        self.quarantine = MemoryStore("quarantine")
+        self.source.connect()
+        self.source.update([{"task_id": "mp-{}".format(n), "n": n} for n in range(6)])
+
+    def test_run(self):
+        builder = SlowBuilder(self.source, self.target, incremental=False)
+        runner = SupervisedRunner([builder], self.quarantine, num_workers=3, timeout=1, poll_interval=0.1)
+        runner.run()
+
+        self.assertEqual(len(list(self.target.query())), 5)
+        self.assertIsNone(self.target.query_one(criteria={"task_id": "mp-3"}))
+        doc = self.quarantine.query_one(criteria={"key": "mp-3"})
+        self.assertEqual(doc["builder"], "SlowBuilder")
+        self.assertTrue(doc["quarantined"])
+        self.assertIn("timeout", doc["reason"])
+
+        # Quarantined items are skipped until their source doc changes
+        self.assertEqual(runner.get_quarantined(builder), {"mp-3": doc["source_lu"]})
+        item = self.source.query_one(criteria={"task_id": "mp-3"})
+        self.assertTrue(runner.is_quarantined(builder, item, runner.get_quarantined(builder)))
+        self.source.collection.update_one({"task_id": "mp-3"},
+                                          {"$set": {"n": 4, "last_updated": datetime.utcnow()}})
+        item = self.source.query_one(criteria={"task_id": "mp-3"})
+        self.assertFalse(runner.is_quarantined(builder, item, runner.get_quarantined(builder)))
+
+        runner.run()
+        self.assertEqual(self.target.query_one(criteria={"task_id": "mp-3"})["square"], 16)
+        docs = self.quarantine.query(criteria={"key": "mp-3"}, sort=[("last_updated", -1)])
+        self.assertFalse(list(docs)[0]["quarantined"])
+
+    def test_worker_exits_after_poll(self):
+        poll = Connection.poll
+        polled = set()
+
+        def late_poll(conn, timeout=0.0):
+            # The first poll finds no result yet, and the worker sends it
+            # and exits right after
+            if not polled:
+                polled.add(id(conn))
+                time.sleep(1)
+                return False
+            return poll(conn, timeout)
+
+        builder = DelayedBuilder(self.source, self.target)
+        with patch.object(Connection, "poll", late_poll):
+            SupervisedRunner([builder], self.quarantine, num_workers=2, poll_interval=0.1).run()
+
+        self.assertEqual(len(list(self.target.query())), 6)
+        self.assertEqual(list(self.quarantine.query()), [])
+
+    def test_memory_of_forked_worker(self):
+        # Pages shared with the parent do not count for the worker
+        data = b"x" * 200 * 2 ** 20
+        self.assertGreater(_get_uss(os.getpid()), len(data))
+        proc = multiprocessing.get_context("fork").Process(target=time.sleep, args=(5,))
+        proc.start()
+        try:
+            time.sleep(0.5)
+            self.assertLess(_get_uss(proc.pid), 100 * 2 ** 20)
+        finally:
+            proc.terminate()
+            proc.join()
+
+
+if __name__ == "__main__":
+    unittest.main()
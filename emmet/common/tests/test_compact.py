@@ -0,0 +1,33 @@
+import unittest
+
+import numpy as np
+
+from emmet.common.compact import pack_array, pack_fields, unpack_array, unpack_doc, is_packed_array
+
+
+class TestCompact(unittest.TestCase):
+
+    def test_pack_array(self):
+        values = np.arange(12, dtype=float).reshape(3, 4) / 7
+        packed = pack_array(values)
+        self.assertTrue(is_packed_array(packed))
+        np.testing.assert_allclose(unpack_array(packed), values, rtol=1e-6)
+        self.assertEqual(unpack_array(packed).dtype, np.float32)
+
+        packed = pack_array([1, 2, 3], dtype="i")
+        self.assertEqual(unpack_array(packed).tolist(), [1, 2, 3])
+        self.assertEqual(unpack_array(pack_array([])).shape, (0,))
+
+        with self.assertRaises(ValueError):
+            unpack_array(b"not an array")
+
+    def test_unpack_doc(self):
+        doc = {"x": [0.5, 1.5], "y": [2.0, 3.0], "hkls": [[{"hkl": (1, 0, 0)}]], "name": "XRD"}
+        compact = pack_fields(doc, ["x", "y"])
+        self.assertTrue(is_packed_array(compact["x"]))
+        self.assertEqual(doc["x"], [0.5, 1.5])
+        self.assertEqual(unpack_doc({"Cu": {"pattern": compact}}), {"Cu": {"pattern": doc}})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+
+import numpy as np
+
+from emmet.common.phonon import get_phonon_thermodynamics, KB_EV_K
+
+trapz = getattr(np, "trapezoid", None) or np.trapz
+
+
+def reference_thermodynamics(mesh, dos, temperatures):
+    # One integration per property and temperature, as in abipy's PhononDos
+    w, gw = mesh[mesh > 1e-12], dos[mesh > 1e-12]
+    props = {"internal_energy": [], "entropy": [], "cv": [], "free_energy": []}
+    for t in temperatures:
+        x = w / (2 * KB_EV_K * t)
+        props["internal_energy"].append(trapz(w / np.tanh(x) * gw, x=w) / 2)
+        props["entropy"].append(KB_EV_K * trapz((x / np.tanh(x) - np.log(2 * np.sinh(x))) * gw, x=w))
+        props["cv"].append(KB_EV_K * trapz(x ** 2 / np.sinh(x) ** 2 * gw, x=w))
+        props["free_energy"].append(KB_EV_K * t * trapz(np.log(2 * np.sinh(x)) * gw, x=w))
+    return props
+
+
+def debye_dos(wmax, n):
+    # Debye-like DOS of 3 modes per cell, with a few imaginary frequencies
+    mesh = np.linspace(-0.002, wmax, n)
+    dos = np.where(mesh > 0, 9 * mesh ** 2 / wmax ** 3, 0.01)
+    return mesh, dos
+
+
+class TestPhononThermodynamics(unittest.TestCase):
+
+    def setUp(self):
+        self.temperatures = np.linspace(5, 800, 160)
+
+    def test_single(self):
+        mesh, dos = debye_dos(0.04, 500)
+        thermo = get_phonon_thermodynamics(mesh, dos, self.temperatures)
+        ref = reference_thermodynamics(mesh, dos, self.temperatures)
+        for k in ref:
+            self.assertEqual(thermo[k].shape, (160, ))
+            np.testing.assert_allclose(thermo[k], ref[k], rtol=1e-9, atol=1e-14)
+
+        # Close to the Dulong-Petit limit of 3 kB per cell at 800 K, and F = U - TS
+        self.assertAlmostEqual(thermo["cv"][-1] / (3 * KB_EV_K), 1, 1)
+        np.testing.assert_allclose(thermo["free_energy"],
+                                   thermo["internal_energy"] - self.temperatures * thermo["entropy"], atol=1e-12)
+
+    def test_zero_temperature(self):
+        mesh, dos = debye_dos(0.04, 500)
+        thermo = get_phonon_thermodynamics(mesh, dos, [0, 5])
+        w, gw = mesh[mesh > 0], dos[mesh > 0]
+        zpe = trapz(w * gw, x=w) / 2
+        self.assertAlmostEqual(thermo["internal_energy"][0], zpe)
+        self.assertAlmostEqual(thermo["free_energy"][0], zpe)
+        self.assertEqual(thermo["entropy"][0], 0)
+        self.assertEqual(thermo["cv"][0], 0)
+        self.assertAlmostEqual(thermo["internal_energy"][1], zpe, 6)
+
+    def test_batch(self):
+        # DOS on meshes of different length, padded with zero frequencies
+        doses = [debye_dos(0.04, 500), debye_dos(0.06, 300), debye_dos(0.02, 400)]
+        frequencies = np.zeros((3, 500))
+        densities = np.zeros((3, 500))
+        for i, (mesh, dos) in enumerate(doses):
+            frequencies[i, :len(mesh)] = mesh
+            densities[i, :len(dos)] = dos
+
+        thermo = get_phonon_thermodynamics(frequencies, densities, self.temperatures)
+        for i, (mesh, dos) in enumerate(doses):
+            ref = reference_thermodynamics(mesh, dos, self.temperatures)
+            for k in ref:
+                self.assertEqual(thermo[k].shape, (3, 160))
+                np.testing.assert_allclose(thermo[k][i], ref[k], rtol=1e-9, atol=1e-14)
+
+
+if __name__ == "__main__":
+    unittest.main()
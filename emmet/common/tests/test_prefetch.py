@@ -0,0 +1,110 @@
+import io
+import json
+import threading
+import time
+import unittest
+import zlib
+
+from maggma.stores import MemoryStore, GridFSStore
+
+from emmet.common.prefetch import query_in_chunks, query_by_field, prefetch_map
+
+
+class MemoryGridFS(object):
+    """
+    Files with metadata, found by id or by the values of metadata fields as GridFS finds them
+    """
+
+    def __init__(self):
+        self.files = []
+
+    def put(self, data, metadata=None):
+        self.files.append((data, metadata or {}))
+        return len(self.files) - 1
+
+    def get(self, oid):
+        data, metadata = self.files[oid]
+        f = io.BytesIO(data)
+        f.metadata = metadata
+        return f
+
+    def find(self, filter):
+        (field, cond), = filter.items()
+        field = field[len("metadata."):]
+        for data, metadata in self.files:
+            if metadata.get(field) in cond["$in"]:
+                f = io.BytesIO(data)
+                f.metadata = metadata
+                yield f
+
+
+class TestPrefetch(unittest.TestCase):
+
+    def test_query_in_chunks(self):
+        store = MemoryStore("materials", key="task_id")
+        store.connect()
+        store.update([{"task_id": "mp-{}".format(i), "value": i, "structure": {}} for i in range(10)])
+
+        docs = list(query_in_chunks(store, ["mp-{}".format(i) for i in range(0, 10, 2)], ["task_id", "value"],
+                                    chunk_size=2))
+        self.assertEqual(sorted(d["value"] for d in docs), [0, 2, 4, 6, 8])
+        self.assertTrue(all("structure" not in d for d in docs))
+
+        # Keys of another field than the key of the store
+        store = MemoryStore("tasks", key="_id")
+        store.connect()
+        store.update([{"_id": i, "task_id": "mp-{}".format(i), "value": i} for i in range(10)])
+        docs = list(query_in_chunks(store, ["mp-1", "mp-5"], chunk_size=1, field="task_id"))
+        self.assertEqual(sorted(d["value"] for d in docs), [1, 5])
+
+    def test_query_by_field(self):
+        store = MemoryStore("bandstructures", key="fs_id")
+        store.connect()
+        store.update([{"fs_id": i, "task_id": "mp-{}".format(i % 3), "bands": [i]} for i in range(5)])
+
+        docs = query_by_field(store, "task_id", ["mp-0", "mp-2", "mp-5"], properties=["bands"])
+        self.assertEqual(set(docs.keys()), {"mp-0", "mp-2"})
+        self.assertEqual(docs["mp-2"]["bands"], [2])
+        self.assertNotIn("fs_id", docs["mp-0"])
+
+    def test_query_by_field_gridfs(self):
+        store = GridFSStore("emmet_test", "bandstructures")
+        store._collection = MemoryGridFS()
+
+        # The stored documents don't contain the task ids
+        store.collection.put(json.dumps({"bands": [0]}).encode(), metadata={"task_id": "mp-0"})
+        store.collection.put(zlib.compress(json.dumps({"bands": [1]}).encode()),
+                             metadata={"task_id": "mp-1", "compression": "zlib"})
+        store.collection.put(json.dumps({"bands": [2]}).encode(), metadata={"task_id": "mp-2"})
+
+        docs = query_by_field(store, "task_id", ["mp-0", "mp-1"])
+        self.assertEqual(docs, {"mp-0": {"bands": [0]}, "mp-1": {"bands": [1]}})
+
+    def test_prefetch_map(self):
+        running = []
+        lock = threading.Lock()
+
+        def fetch(i):
+            with lock:
+                running.append(i)
+            time.sleep(0.01)
+            return i * i
+
+        consumed = []
+        for r in prefetch_map(fetch, range(20), num_threads=3, max_pending=4):
+            consumed.append(r)
+            # never more than max_pending calls ahead of the consumer
+            self.assertLessEqual(len(running), len(consumed) + 4)
+        self.assertEqual(consumed, [i * i for i in range(20)])
+
+        def fail(i):
+            if i == 3:
+                raise ValueError("download failed")
+            return i
+
+        with self.assertRaises(ValueError):
+            list(prefetch_map(fail, range(10), num_threads=2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import io
+import json
+import unittest
+import zlib
+
+import numpy as np
+
+from emmet.common.streaming import StreamingJSONParser, iter_gridfs_chunks, load_json_stream, \
+    BANDSTRUCTURE_ARRAY_FIELDS
+
+
+def split(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestStreaming(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.bs = {
+            "@module": "pymatgen.electronic_structure.bandstructure",
+            "efermi": -1.25,
+            "is_spin_polarized": True,
+            "labels_dict": {"\\Gamma": [0.0, 0.0, 0.0], "X": [0.5, 0.0, 0.0]},
+            "kpoints": rng.rand(20, 3).tolist(),
+            "bands": {"1": rng.randn(6, 20).tolist(), "-1": rng.randn(6, 20).tolist()},
+            "projections": {"1": rng.rand(6, 20, 9, 2).tolist()},
+            "structure": {"lattice": {"matrix": [[3.0, 0, 0], [0, 3.0, 0], [0, 0, 3.0]]},
+                          "sites": [{"abc": [0, 0, 0], "label": "Si Å",
+                                     "species": [{"element": "Si", "occu": 1}]}]},
+            "branches": [],
+            "tags": [[], [1, [2]], None, True],
+        }
+        self.data = json.dumps(self.bs).encode()
+
+    def assertDecoded(self, doc):
+        for spin in ["1", "-1"]:
+            self.assertIsInstance(doc["bands"][spin], np.ndarray)
+            np.testing.assert_array_equal(doc["bands"][spin], self.bs["bands"][spin])
+        self.assertEqual(doc["projections"]["1"].shape, (6, 20, 9, 2))
+        np.testing.assert_array_equal(doc["projections"]["1"], self.bs["projections"]["1"])
+        np.testing.assert_array_equal(doc["kpoints"], self.bs["kpoints"])
+        for k in ["@module", "efermi", "is_spin_polarized", "labels_dict", "structure", "branches", "tags"]:
+            self.assertEqual(doc[k], self.bs[k])
+
+    def test_load_json_stream(self):
+        for size in [1, 7, 1000, len(self.data)]:
+            self.assertDecoded(load_json_stream(split(self.data, size), array_fields=BANDSTRUCTURE_ARRAY_FIELDS))
+
+        compressed = zlib.compress(self.data)
+        self.assertDecoded(load_json_stream(split(compressed, 100), "zlib", BANDSTRUCTURE_ARRAY_FIELDS))
+
+        # Without array fields the document is the same as with json
+        self.assertEqual(load_json_stream(split(self.data, 100)), self.bs)
+
+    def test_parser(self):
+        parser = StreamingJSONParser(array_fields=["bands"])
+        parser.lookahead = 16
+        for chunk in split(b'{"bands": [[1, 2.5e-3, NaN], [-Infinity, 0, 3]], "ragged": [[1], [2, 3]],'
+                           b' "bands2": {"bands": [[1], [2, 3]]}}', 5):
+            parser.feed(chunk)
+        doc = parser.close()
+        np.testing.assert_array_equal(doc["bands"], [[1, 2.5e-3, np.nan], [-np.inf, 0, 3]])
+        self.assertEqual(doc["ragged"], [[1], [2, 3]])
+        self.assertEqual([b.tolist() for b in doc["bands2"]["bands"]], [[1], [2, 3]])
+
+        parser = StreamingJSONParser()
+        parser.feed(b'{"a": [1, 2')
+        with self.assertRaises(ValueError):
+            parser.close()
+
+    def test_iter_gridfs_chunks(self):
+        chunks = list(iter_gridfs_chunks(io.BytesIO(self.data), chunk_size=1000))
+        self.assertEqual(b"".join(chunks), self.data)
+        self.assertTrue(all(len(c) <= 1000 for c in chunks))
+
+
+if __name__ == "__main__":
+    unittest.main()
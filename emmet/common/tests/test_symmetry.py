@@ -0,0 +1,37 @@
+import os
+import unittest
+
+from monty.serialization import loadfn
+from pymatgen import Structure
+from pymatgen.analysis.local_env import CrystalNN, MinimumDistanceNN
+
+from emmet.common.symmetry import get_equivalent_sites, get_symmetrized_all_nn_info
+
+module_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)))
+test_structs = os.path.join(module_dir, "..", "..", "..", "test_files", "simple_structs.json")
+
+
+class TestSymmetry(unittest.TestCase):
+    def setUp(self):
+        self.structures = {d["task_id"]: Structure.from_dict(d["structure"])
+                           for d in loadfn(test_structs, cls=None)}
+
+    def test_get_equivalent_sites(self):
+        diamond = self.structures["mp-66"] * (2, 1, 1)
+        self.assertEqual(len(set(get_equivalent_sites(diamond))), 1)
+        self.assertEqual(get_equivalent_sites(diamond)[0], 0)
+
+    def test_get_symmetrized_all_nn_info(self):
+        for structure in self.structures.values():
+            structure = structure * (2, 1, 1)
+            for strategy in [CrystalNN(), MinimumDistanceNN()]:
+                expected = strategy.get_all_nn_info(structure)
+                found = get_symmetrized_all_nn_info(structure, strategy)
+                for nn_exp, nn_found in zip(expected, found):
+                    self.assertEqual(
+                        sorted((d["site_index"], tuple(d["image"]), round(d["weight"], 6)) for d in nn_found),
+                        sorted((d["site_index"], tuple(d["image"]), round(d["weight"], 6)) for d in nn_exp))
+
+
+if __name__ == "__main__":
+    unittest.main()
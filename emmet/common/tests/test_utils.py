@@ -1,6 +1,6 @@
 from unittest import TestCase
 from copy import copy
-from emmet.common.utils import scrub_class_and_module
+from emmet.common.utils import scrub_class_and_module, LRUCache
 
 
 class TestUtils(TestCase):
@@ -20,3 +20,21 @@ class TestUtils(TestCase):
         self.assertEqual(new['this'], {"that": {"those": 3}})
         for new_doc in new['these']:
             self.assertEqual(new_doc, {"this": 5})
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+
+        # Reading "a" makes "b" the least recently used entry
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertEqual(list(cache), ["a", "c"])
+        self.assertIsNone(cache.get("b"))
+
+        # Updating an entry also refreshes it
+        cache.put("a", 4)
+        cache.put("d", 5)
+        self.assertEqual(list(cache), ["a", "d"])
+        self.assertEqual(cache.get("a"), 4)
+        self.assertEqual(cache.get("e", 0), 0)
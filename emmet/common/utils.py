@@ -1,5 +1,6 @@
 import itertools
 import os.path
+from collections import OrderedDict
 
 from monty.serialization import loadfn
 
@@ -39,3 +40,25 @@ def get_chemsys_space(chemsys):
     elements = chemsys.split("-")
     combos = itertools.chain.from_iterable(itertools.combinations(elements, i) for i in range(1, len(elements) + 1))
     return list("-".join(sorted(combo)) for combo in combos)
+
+
+class LRUCache(OrderedDict):
+    """
+    Minimal size-bounded least-recently-used mapping
+    """
+
+    def __init__(self, maxsize):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key, default=None):
+        if key in self:
+            self.move_to_end(key)
+            return self[key]
+        return default
+
+    def put(self, key, value):
+        self[key] = value
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
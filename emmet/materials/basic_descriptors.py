@@ -6,6 +6,8 @@ from atomate.utils.utils import get_meta_from_structure
 from matminer.featurizers.site import CrystalNNFingerprint, CoordinationNumber
 from matminer.featurizers.composition import ElementProperty
 
+from emmet.common.symmetry import get_equivalent_sites, SITE_SYMPREC
+
 # TODO:
 # 1) Add checking OPs present in current implementation of site fingerprints.
 # 2) Complete documentation!!!
@@ -22,7 +24,8 @@ nn_target_classes = ["MinimumDistanceNN", "VoronoiNN",
 
 class BasicDescriptorsBuilder(MapBuilder):
 
-    def __init__(self, materials, descriptors, **kwargs):
+    def __init__(self, materials, descriptors, symprec=SITE_SYMPREC,
+                 compact=False, **kwargs):
         """
         Calculates site-based descriptors (e.g., coordination numbers
         with different near-neighbor finding approaches) for materials and
@@ -40,19 +43,30 @@ class BasicDescriptorsBuilder(MapBuilder):
                                  as tetrahedral order parameter or
                                  fraction of being 8-fold coordinated.
             mat_query (dict): dictionary to limit materials to be analyzed.
+            symprec (float): symmetry precision used to find equivalent
+                             sites, of which only one representative is
+                             featurized; None featurizes every site.
+            compact (bool): store each type of site descriptors as a
+                            label list and a (sites x labels) value
+                            matrix instead of a list of per-site dicts.
         """
 
         self.materials = materials
         self.descriptors = descriptors
+        self.symprec = symprec
+        self.compact = compact
 
-        # Set up all targeted site descriptors.
+        # Set up all targeted site descriptors.  The unweighted and
+        # weighted coordination numbers of a near-neighbor method share
+        # one near-neighbor object.
         self.sds = {}
+        self.nns = {}
         for nn in nn_target_classes:
-            nn_ = getattr(local_env, nn)
+            self.nns[nn] = getattr(local_env, nn)()
             k = "cn_{}".format(nn)
-            self.sds[k] = CoordinationNumber(nn_(), use_weights="none")
+            self.sds[k] = CoordinationNumber(self.nns[nn], use_weights="none")
             k = "cn_wt_{}".format(nn)
-            self.sds[k] = CoordinationNumber(nn_(), use_weights="sum")
+            self.sds[k] = CoordinationNumber(self.nns[nn], use_weights="sum")
         self.all_output_pieces = {"site_descriptors": [k for k in self.sds.keys()]}
         self.sds["csf"] = CrystalNNFingerprint.from_preset("ops",
                                                            distance_cutoffs=None,
@@ -100,36 +114,92 @@ class BasicDescriptorsBuilder(MapBuilder):
         except Exception as e:
             self.logger.error("Failed getting Magpie descriptors: "
                               "{}".format(e))
-        descr_doc["site_descriptors"] = \
-                self.get_site_descriptors_from_struct(
-                descr_doc["structure"])
-        descr_doc["statistics"] = \
-                self.get_statistics(
-                descr_doc["site_descriptors"])
+        site_descr = self.get_site_descriptor_arrays(descr_doc["structure"])
+        if self.compact:
+            descr_doc["site_descriptors"] = {
+                k: {"labels": v["labels"], "values": v["values"].tolist()}
+                for k, v in site_descr.items()}
+        else:
+            descr_doc["site_descriptors"] = {
+                k: site_descriptors_from_array(v)
+                for k, v in site_descr.items()}
+        descr_doc["statistics"] = self.get_statistics(site_descr)
         descr_doc[self.descriptors.key] = item[self.materials.key]
 
         return descr_doc
 
     def get_site_descriptors_from_struct(self, structure):
+        return {k: site_descriptors_from_array(v) for k, v in
+                self.get_site_descriptor_arrays(structure).items()}
+
+    def get_site_descriptor_arrays(self, structure):
         doc = {}
 
-        # Compute descriptors.
-        for k, sd in self.sds.items():
+        # Only featurize one representative site of each set of
+        # symmetry-equivalent sites and copy its descriptors to the others.
+        if self.symprec is None:
+            equivalent = list(range(len(structure.sites)))
+        else:
+            equivalent = get_equivalent_sites(structure, self.symprec)
+        representatives = sorted(set(equivalent))
+
+        # Compute near-neighbor info once per method and site, and derive
+        # the unweighted (number of neighbors) and weighted (sum of
+        # neighbor weights) coordination numbers from it.
+        for nn, nn_ in self.nns.items():
+            k = "cn_{}".format(nn)
+            k_wt = "cn_wt_{}".format(nn)
+
+            # That is what NearNeighbors.get_cn computes, but methods may
+            # override it (CrystalNN only allows the weighting matching its
+            # weighted_cn setting), so theirs go through the featurizers.
+            if type(nn_).get_cn is not local_env.NearNeighbors.get_cn:
+                self.featurize_sites(doc, k, structure, representatives,
+                                     equivalent, dtype=int)
+                self.featurize_sites(doc, k_wt, structure, representatives,
+                                     equivalent)
+                continue
+
             try:
-                d = []
-                l = sd.feature_labels()
-                for i, s in enumerate(structure.sites):
-                    d.append({"site": i})
-                    for j, desc in enumerate(sd.featurize(structure, i)):
-                        d[i][l[j]] = desc
-                doc[k] = d
+                l = self.sds[k].feature_labels()
+                cn = {}
+                cn_wt = {}
+                for i in representatives:
+                    nn_info = nn_.get_nn_info(structure, i)
+                    cn[i] = len(nn_info)
+                    cn_wt[i] = sum([e["weight"] for e in nn_info])
+                doc[k] = {"labels": l, "values": np.array(
+                    [[cn[r]] for r in equivalent], dtype=int)}
+                doc[k_wt] = {"labels": l, "values": np.array(
+                    [[cn_wt[r]] for r in equivalent], dtype=float)}
 
             except Exception as e:
-                self.logger.error("Failed calculating {} site-descriptors: "
-                                  "{}".format(k, e))
+                self.logger.error("Failed calculating {} and {} site-"
+                                  "descriptors: {}".format(k, k_wt, e))
+
+        # Compute fingerprints.
+        for k in self.all_output_pieces["statistics"]:
+            self.featurize_sites(doc, k, structure, representatives,
+                                 equivalent)
 
         return doc
 
+    def featurize_sites(self, doc, k, structure, representatives,
+                        equivalent, dtype=float):
+        """
+        Adds the site descriptors k of the representative sites to doc,
+        copied to the sites equivalent to them.
+        """
+        sd = self.sds[k]
+        try:
+            fps = {i: sd.featurize(structure, i) for i in representatives}
+            doc[k] = {"labels": sd.feature_labels(), "values": np.array(
+                [fps[r] for r in equivalent], dtype=dtype)}
+
+        except Exception as e:
+            self.logger.error("Failed calculating {} site-descriptors: "
+                              "{}".format(k, e))
+
     def get_statistics(self, site_descr, fps=("csf", )):
         doc = {}
 
@@ -137,19 +207,21 @@ class BasicDescriptorsBuilder(MapBuilder):
         for fp in fps:
             doc[fp] = {}
             try:
-                n_site = len(site_descr[fp])
-                tmp = {}
-                for isite in range(n_site):
-                    for l, v in site_descr[fp][isite].items():
-                        if l not in list(tmp.keys()):
-                            tmp[l] = []
-                        tmp[l].append(v)
+                sd = site_descr[fp]
+                if isinstance(sd, list):
+                    sd = site_descriptors_to_array(sd)
+                values = np.asarray(sd["values"], dtype=float)
                 d = []
-                for k, l in tmp.items():
-                    dtmp = {"name": k}
-                    dtmp["mean"] = np.mean(tmp[k])
-                    dtmp["std"] = np.std(tmp[k])
-                    d.append(dtmp)
+                if len(values) > 0:
+                    # The site index is part of every per-site dict and
+                    # has always been included in the statistics.
+                    sites = np.arange(len(values))
+                    d.append({"name": "site", "mean": np.mean(sites),
+                              "std": np.std(sites)})
+                    means = np.mean(values, axis=0)
+                    stds = np.std(values, axis=0)
+                    for l, mean, std in zip(sd["labels"], means, stds):
+                        d.append({"name": l, "mean": mean, "std": std})
                 doc[fp] = d
 
             except Exception as e:
@@ -157,3 +229,43 @@ class BasicDescriptorsBuilder(MapBuilder):
                                   "descriptors: {}".format(e))
 
         return doc
+
+
+def site_descriptors_to_array(site_descr):
+    """
+    Converts site descriptors from a list of per-site dicts to the
+    compact label list and (sites x labels) value matrix.
+
+    Args:
+        site_descr ([dict]): per-site dicts with the site index in
+                             "site" and one entry per descriptor label.
+
+    Returns:
+        dict: {"labels": [str], "values": np.ndarray}
+    """
+    labels = list(dict.fromkeys(
+        l for d in site_descr for l in d.keys() if l != "site"))
+    values = np.array([[d[l] for l in labels] for d in site_descr])
+    return {"labels": labels, "values": values.reshape(len(site_descr),
+                                                       len(labels))}
+
+
+def site_descriptors_from_array(site_descr):
+    """
+    Converts site descriptors from the compact label list and
+    (sites x labels) value matrix to a list of per-site dicts.
+
+    Args:
+        site_descr (dict): {"labels": [str], "values": matrix}
+
+    Returns:
+        [dict]: per-site dicts with the site index in "site".
+    """
+    labels = site_descr["labels"]
+    values = np.asarray(site_descr["values"]).tolist()
+    out = []
+    for i, row in enumerate(values):
+        d = {"site": i}
+        d.update(zip(labels, row))
+        out.append(d)
+    return out
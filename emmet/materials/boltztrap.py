@@ -1,13 +1,22 @@
 import logging
+import os
+import json
+import zlib
 from datetime import datetime
 
+import gridfs
 from monty.json import jsanitize
+from monty.os import makedirs_p
 from monty.tempfile import ScratchDir
 from pymatgen.core.structure import Structure
-from pymatgen.electronic_structure.boltztrap import BoltztrapRunner
+from pymatgen.electronic_structure.bandstructure import BandStructure
+from pymatgen.electronic_structure.boltztrap import BoltztrapRunner, BoltztrapAnalyzer
 
 from maggma.builders import Builder
 
+from emmet.common.prefetch import query_in_chunks, prefetch_map
+from emmet.common.streaming import load_gridfs_json
+
 __author__ = "Shyam Dwaraknath <shyamd@lbl.gov>"
 
 
@@ -18,6 +27,7 @@ class BoltztrapDosBuilder(Builder):
                  bandstructure_fs="bandstructure_fs",
                  btz_cdos_fs=None,
                  query=None,
+                 num_threads=4,
                  **kwargs):
         """
         Calculates Density of States (DOS) using BoltzTrap
@@ -28,6 +38,7 @@ class BoltztrapDosBuilder(Builder):
             boltztrap (Store): Store of boltztrap
             bandstructure_fs (str): Name of the GridFS where bandstructures are stored
             query (dict): dictionary to limit materials to be analyzed
+            num_threads (int): number of threads downloading bandstructures ahead of processing
 
         """
 
@@ -36,6 +47,7 @@ class BoltztrapDosBuilder(Builder):
         self.bandstructure_fs = bandstructure_fs
         self.btz_cdos_fs = btz_cdos_fs
         self.query = query if query else {}
+        self.num_threads = num_threads
 
         super().__init__(sources=[materials], targets=[boltztrap], **kwargs)
 
@@ -61,20 +73,7 @@ class BoltztrapDosBuilder(Builder):
         bfs = gridfs.GridFS(self.materials.database, self.bandstructure_fs)
 
         self.logger.info("Found {} new materials for calculating boltztrap dos".format(len(mats)))
-        for m in mats:
-            mat = self.materials.query([self.materials.key, "structure", "input.parameters.NELECT", "bandstructure"],
-                                       criteria={self.materials.key: m})
-
-            # If a bandstructure oid exists
-            if "uniform_bs_oid" in mat.get("bandstructure", {}):
-                bs_json = bfs.get(mat["bandstructure"]["uniform_bs_oid"]).read()
-
-                if "zlib" in mat["bandstructure"].get("uniform_bs_compression", ""):
-                    bs_json = zlib.decompress(bs_json)
-
-                bs_dict = json.loads(bs_json.decode())
-                mat["bandstructure"]["uniform_bs"] = bs_dict
-
+        for mat in get_materials_with_uniform_bs(self.materials, mats, bfs, self.chunk_size, self.num_threads):
             yield mat
 
     def process_item(self, item):
@@ -91,7 +90,7 @@ class BoltztrapDosBuilder(Builder):
 
         nelect = item["input"]["parameters"]["NELECT"]
 
-        bs_dict = item["uniform_bandstructure"]["bs"]
+        bs_dict = item["bandstructure"]["uniform_bs"]
         bs_dict['structure'] = item['structure']
         bs = BandStructure.from_dict(bs_dict)
 
@@ -109,7 +108,7 @@ class BoltztrapDosBuilder(Builder):
                 btrap_dir = os.path.join(run_path, "boltztrap")
                 bta_dw = BoltztrapAnalyzer.from_files(btrap_dir)
 
-                cdos = an_up.get_complete_dos(bs.structure, an_dw)
+                cdos = bta_up.get_complete_dos(bs.structure, bta_dw)
 
             else:
                 run_path = os.path.join(os.getcwd(), "dos")
@@ -118,7 +117,7 @@ class BoltztrapDosBuilder(Builder):
                 btrap_dir = os.path.join(run_path, "boltztrap")
                 bta = BoltztrapAnalyzer.from_files(btrap_dir)
 
-                cdos = an.get_complete_dos(bs.structure)
+                cdos = bta.get_complete_dos(bs.structure)
 
         return {'cdos': cdos.as_dict()}
 
@@ -154,7 +153,8 @@ class BoltztrapDosBuilder(Builder):
 
 
 class BoltztrapBuilder(Builder):
-    def __init__(self, materials, boltztrap, bandstructure_fs="bandstructure_fs", bta_fs=None, query=None, **kwargs):
+    def __init__(self, materials, boltztrap, bandstructure_fs="bandstructure_fs", bta_fs=None, query=None,
+                 num_threads=4, **kwargs):
         """
         Calculates conducitivty parameters using BoltzTrap
         Saves the boltztrap analyzer in bta_fs if set otherwise doesn't store it
@@ -165,6 +165,7 @@ class BoltztrapBuilder(Builder):
             boltztrap (Store): Store of boltztrap
             bandstructure_fs (str): Name of the GridFS where bandstructures are stored
             query (dict): dictionary to limit materials to be analyzed
+            num_threads (int): number of threads downloading bandstructures ahead of processing
 
         """
 
@@ -173,6 +174,7 @@ class BoltztrapBuilder(Builder):
         self.bandstructure_fs = bandstructure_fs
         self.bta_fs = bta_fs
         self.query = query if query else {}
+        self.num_threads = num_threads
 
         super().__init__(sources=[materials], targets=[boltztrap], **kwargs)
 
@@ -198,20 +200,7 @@ class BoltztrapBuilder(Builder):
         bfs = gridfs.GridFS(self.materials.database, self.bandstructure_fs)
 
         self.logger.info("Found {} new materials for calculating boltztrap conductivity".format(len(mats)))
-        for m in mats:
-            mat = self.materials.query([self.materials.key, "structure", "input.parameters.NELECT", "bandstructure"],
-                                       criteria={self.materials.key: m})
-
-            # If a bandstructure oid exists
-            if "uniform_bs_oid" in mat.get("bandstructure", {}):
-                bs_json = bfs.get(mat["bandstructure"]["uniform_bs_oid"]).read()
-
-                if "zlib" in mat["bandstructure"].get("uniform_bs_compression", ""):
-                    bs_json = zlib.decompress(bs_json)
-
-                bs_dict = json.loads(bs_json.decode())
-                mat["bandstructure"]["uniform_bs"] = bs_dict
-
+        for mat in get_materials_with_uniform_bs(self.materials, mats, bfs, self.chunk_size, self.num_threads):
             yield mat
 
     def process_item(self, item):
@@ -228,7 +217,7 @@ class BoltztrapBuilder(Builder):
 
         nelect = item["input"]["parameters"]["NELECT"]
 
-        bs_dict = item["uniform_bandstructure"]["bs"]
+        bs_dict = item["bandstructure"]["uniform_bs"]
         bs_dict['structure'] = item['structure']
         bs = BandStructure.from_dict(bs_dict)
 
@@ -278,6 +267,37 @@ class BoltztrapBuilder(Builder):
             self.logger.info("No items to update")
 
 
+def get_materials_with_uniform_bs(materials, mat_ids, bfs, chunk_size=1000, num_threads=4):
+    """
+    Gets materials with their uniform bandstructures.  The materials are
+    queried in chunks, and their bandstructures are streamed from GridFS by a
+    pool of threads ahead of the consumer.
+
+    Args:
+        materials (Store): Store of materials documents
+        mat_ids ([str]): keys of the materials
+        bfs (GridFS): GridFS of the bandstructures
+        chunk_size (int): number of materials per query
+        num_threads (int): number of threads downloading bandstructures
+
+    Returns:
+        generator of materials with the bandstructure in bandstructure.uniform_bs
+    """
+
+    def load_uniform_bs(mat):
+        # If a bandstructure oid exists, stream it with the eigenvalues as arrays
+        bs = mat.get("bandstructure", {})
+        if "uniform_bs_oid" in bs:
+            bs["uniform_bs"] = load_gridfs_json(bfs, bs["uniform_bs_oid"], bs.get("uniform_bs_compression", ""))
+        return mat
+
+    mats = query_in_chunks(materials, mat_ids, chunk_size=chunk_size, properties=[
+        materials.key, "structure", "input.parameters.NELECT", "bandstructure.uniform_bs_oid",
+        "bandstructure.uniform_bs_compression"
+    ])
+    return prefetch_map(load_uniform_bs, mats, num_threads=num_threads)
+
+
 def bt_analysis_thermoelectric(bta):
     """
     Performs analysis for thermoelectrics search
@@ -6,6 +6,8 @@ from maggma.utils import source_keys_updated
 
 import numpy as np
 
+from emmet.common.prefetch import query_in_chunks, prefetch_map
+
 __author__ = "Francesco Ricci <francesco.ricci@uclouvain.be>"
 
 
@@ -17,6 +19,7 @@ class Boltztrap4DosBuilder(Builder):
                  query=None,
                  energy_grid=0.005,
                  avoid_projections=False,
+                 num_threads=4,
                  **kwargs):
         """
         Calculates Density of States (DOS) using BoltzTrap2
@@ -28,6 +31,7 @@ class Boltztrap4DosBuilder(Builder):
             query (dict): dictionary to limit materials to be analyzed
             energy_grid(float): the energy_grid spacing for the DOS in eV
             avoid_projections(bool): Don't interpolate projections even if present
+            num_threads(int): number of threads fetching bandstructures ahead of processing
         """
 
         self.materials = materials
@@ -36,6 +40,7 @@ class Boltztrap4DosBuilder(Builder):
         self.query = query if query else {}
         self.energy_grid = energy_grid
         self.avoid_projections = avoid_projections
+        self.num_threads = num_threads
 
         super().__init__(sources=[materials, bandstructures], targets=[boltztrap_dos], **kwargs)
 
@@ -57,18 +62,22 @@ class Boltztrap4DosBuilder(Builder):
 
         self.logger.info("Found {} new materials for calculating boltztrap dos".format(len(mats)))
 
-        for m in mats:
-            mat = self.materials.query([self.materials.key, "structure", "bandstructure"],
-                                       criteria={self.materials.key: m})
-
-            # If a bandstructure uniform task exists
-            bs_task_id = mat.get("bandstructure", {}).get("uniform_task", None)
-            if bs_task_id:
-                bs_dict = self.bandstructures.query_one({self.bandstructures.key: bs_task_id})
-                mat["bandstructure_uniform"] = bs_dict
+        mats = query_in_chunks(self.materials, mats, chunk_size=self.chunk_size,
+                               properties=[self.materials.key, "structure", "bandstructure.uniform_task"])
 
+        for mat in prefetch_map(self.get_uniform_bs, mats, num_threads=self.num_threads):
             yield mat
 
+    def get_uniform_bs(self, mat):
+        """
+        Adds the uniform bandstructure to a material if a uniform task exists
+        """
+        bs_task_id = mat.get("bandstructure", {}).get("uniform_task", None)
+        if bs_task_id:
+            bs_dict = self.bandstructures.query_one(criteria={self.bandstructures.key: bs_task_id})
+            mat["bandstructure_uniform"] = bs_dict
+        return mat
+
     def process_item(self, item):
         """
         Calculates dos running Boltztrap2
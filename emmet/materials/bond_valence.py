@@ -23,6 +23,7 @@ class BondValenceBuilder(MapBuilder):
         self.materials = materials
         self.bond_valence = bond_valence
         self.bond_valence.validator = JSONSchemaValidator(loadfn(BOND_VALENCE_SCHEMA))
+        self.bva = BVAnalyzer()
         super().__init__(
             source=materials,
             target=bond_valence,
@@ -42,8 +43,7 @@ class BondValenceBuilder(MapBuilder):
         }
 
         try:
-            bva = BVAnalyzer()
-            valences = bva.get_valences(s)
+            valences = self.bva.get_valences(s)
             possible_species = {
                 str(Specie(s[idx].specie, oxidation_state=valence))
                 for idx, valence in enumerate(valences)
@@ -13,6 +13,8 @@ from pymatgen import __version__ as pymatgen_version
 from maggma.builders import MapBuilder
 from maggma.validator import JSONSchemaValidator, msonable_schema
 
+from emmet.common.symmetry import get_symmetrized_all_nn_info, SITE_SYMPREC
+
 __author__ = "Matthew Horton <mkhorton@lbl.gov>"
 
 MODULE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)))
@@ -20,7 +22,7 @@ BOND_SCHEMA = os.path.join(MODULE_DIR, "schema", "bond.json")
 
 
 class BondBuilder(MapBuilder):
-    def __init__(self, materials, bonding, strategies=("CrystalNN", ), **kwargs):
+    def __init__(self, materials, bonding, strategies=("CrystalNN", ), symprec=SITE_SYMPREC, **kwargs):
         """
         Builder to calculate bonding in a crystallographic
         structure via near neighbor strategies, including those
@@ -33,10 +35,15 @@ class BondBuilder(MapBuilder):
             an instance of a NearNeighbor class or its name as a string,
             in which case it will be instantiated with default arguments)
             query (dict): dictionary to limit materials to be analyzed
+            symprec (float): symmetry precision used to find equivalent
+            sites; neighbors are only searched for one site per set of
+            equivalent sites and mapped onto the others by symmetry (None
+            searches neighbors of every site)
         """
 
         self.materials = materials
         self.bonding = bonding
+        self.symprec = symprec
         self.bonding.validator = JSONSchemaValidator(loadfn(BOND_SCHEMA))
 
         available_strategies = {nn.__name__: nn for nn in NearNeighbors.__subclasses__()}
@@ -69,7 +76,7 @@ class BondBuilder(MapBuilder):
             # failure statistics are interesting
             try:
 
-                sg = StructureGraph.with_local_env_strategy(structure, strategy)
+                sg = self.get_structure_graph(structure, strategy)
 
                 # ensure edge weights are specifically bond lengths
                 edge_weights = []
@@ -103,3 +110,27 @@ class BondBuilder(MapBuilder):
             "bonding": {b["strategy"]: b for b in bonding_docs if b["successful"]},
             "failed_bonding": {b["strategy"]: b for b in bonding_docs if not b["successful"]},
         }
+
+    def get_structure_graph(self, structure, strategy):
+        """
+        Equivalent of StructureGraph.with_local_env_strategy that only
+        searches neighbors of symmetry-inequivalent sites
+        """
+
+        if self.symprec is None:
+            return StructureGraph.with_local_env_strategy(structure, strategy)
+
+        sg = StructureGraph.with_empty_graph(structure, name="bonds",
+                                             edge_weight_name="weight",
+                                             edge_weight_units="")
+        for n, neighbors in enumerate(get_symmetrized_all_nn_info(structure, strategy, self.symprec)):
+            for neighbor in neighbors:
+                # every bond is found from both of its sites, so
+                # duplicates are expected
+                sg.add_edge(from_index=n,
+                            from_jimage=(0, 0, 0),
+                            to_index=neighbor['site_index'],
+                            to_jimage=neighbor['image'],
+                            weight=neighbor['weight'],
+                            warn_duplicates=False)
+        return sg
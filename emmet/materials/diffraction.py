@@ -1,13 +1,27 @@
 import logging
 import os
 from datetime import datetime
+from math import sin, radians
+
+import numpy as np
 
 from monty.json import jsanitize
 from monty.serialization import loadfn
 
 from pymatgen.core.structure import Structure
-from pymatgen.analysis.diffraction.xrd import XRDCalculator, WAVELENGTHS
-
+from pymatgen.analysis.diffraction.core import DiffractionPattern, get_unique_families
+try:
+    from pymatgen.analysis.diffraction.core import AbstractDiffractionPatternCalculator as DiffractionPatternCalculator
+    # XRDCalculator lists the hkls of a peak as {"hkl", "multiplicity"} dicts
+    HKLS_AS_LIST = True
+except ImportError:
+    # pymatgen < 2019.2.4 maps the hkls of a peak to their multiplicities
+    from pymatgen.analysis.diffraction.core import DiffractionPatternCalculator
+    HKLS_AS_LIST = False
+from pymatgen.analysis.diffraction.xrd import WAVELENGTHS, ATOMIC_SCATTERING_PARAMS
+from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+
+from emmet.common.compact import pack_fields
 from emmet.common.utils import load_settings
 from maggma.builders import MapBuilder
 
@@ -18,7 +32,7 @@ DEFAULT_XRD_SETTINGS = os.path.join(MODULE_DIR, "settings", "xrd.json")
 
 
 class DiffractionBuilder(MapBuilder):
-    def __init__(self, materials, diffraction, xrd_settings=None, **kwargs):
+    def __init__(self, materials, diffraction, xrd_settings=None, compact=False, **kwargs):
         """
         Calculates diffraction patterns for materials
 
@@ -26,11 +40,14 @@ class DiffractionBuilder(MapBuilder):
             materials (Store): Store of materials documents
             diffraction (Store): Store of diffraction data such as formation energy and decomposition pathway
             xrd_settings (Store): Store of xrd settings
+            compact (bool): store x, y and d_hkls of the patterns as float32
+                BSON binary; use emmet.common.compact.unpack_doc to read them
         """
 
         self.materials = materials
         self.diffraction = diffraction
         self.xrd_settings = xrd_settings
+        self.compact = compact
         self.__settings = load_settings(self.xrd_settings, DEFAULT_XRD_SETTINGS)
 
         super().__init__(
@@ -55,10 +72,23 @@ class DiffractionBuilder(MapBuilder):
     def get_xrd_from_struct(self, structure):
         doc = {}
 
+        # Reciprocal lattice points and structure factors are shared by all
+        # wavelengths with the same symmetry precision
+        calcs = {}
         for xs in self.__settings:
-            xrdcalc = XRDCalculator(wavelength="".join([xs['target'], xs['edge']]), symprec=xs.get('symprec', 0))
-
-            pattern = jsanitize(xrdcalc.get_pattern(structure, two_theta_range=xs['two_theta']).as_dict())
+            symprec = xs.get('symprec', 0)
+            if symprec not in calcs:
+                max_two_theta = {}
+                for s in self.__settings:
+                    if s.get('symprec', 0) == symprec:
+                        wavelength = s['target'] + s['edge']
+                        max_two_theta[wavelength] = max(max_two_theta.get(wavelength, 0), s['two_theta'][1])
+                calcs[symprec] = MultiWavelengthXRDCalculator(structure, max_two_theta, symprec=symprec)
+
+            pattern = jsanitize(calcs[symprec].get_pattern(xs['target'] + xs['edge'], two_theta_range=xs['two_theta'])
+                                .as_dict())
+            if self.compact:
+                pattern = pack_fields(pattern, ["x", "y", "d_hkls"])
             d = {
                 'wavelength': {
                     'element': xs['target'],
@@ -68,3 +98,146 @@ class DiffractionBuilder(MapBuilder):
             }
             doc[xs['target']] = d
         return doc
+
+
+class MultiWavelengthXRDCalculator(object):
+    """
+    Computes XRD patterns of one structure for several wavelengths.
+    Reciprocal lattice points and their structure-factor intensities do
+    not depend on the wavelength, so they are computed once up to the
+    largest reciprocal vector length any of the wavelengths needs.  Each
+    pattern then only applies the Bragg condition and the Lorentz
+    polarization factor.  Patterns match those of pymatgen's
+    XRDCalculator.
+    """
+
+    def __init__(self, structure, max_two_theta, symprec=0, debye_waller_factors=None, block_size=2048):
+        """
+        Args:
+            structure (Structure): input structure
+            max_two_theta (dict): wavelength name (e.g., "CuKa") or value in
+                angstroms -> largest 2-theta in degrees needed for it
+            symprec (float): symmetry precision for structure refinement,
+                as in XRDCalculator (0 to use the structure as is)
+            debye_waller_factors (dict): element symbol -> Debye-Waller factor
+            block_size (int): number of reciprocal lattice points per
+                vectorized structure-factor evaluation
+        """
+        if symprec:
+            structure = SpacegroupAnalyzer(structure, symprec=symprec).get_refined_structure()
+        debye_waller_factors = debye_waller_factors or {}
+
+        latt = structure.lattice
+        self.is_hex = latt.is_hexagonal()
+        max_r = max(2 * sin(radians(min(t, 180) / 2)) / self._wavelength(w) for w, t in max_two_theta.items())
+
+        recip_latt = latt.reciprocal_lattice_crystallographic
+        recip_pts = recip_latt.get_points_in_sphere([[0, 0, 0]], [0, 0, 0], max_r)
+        recip_pts = sorted(((pt[0], pt[1]) for pt in recip_pts if pt[1] != 0),
+                           key=lambda i: (i[1], -i[0][0], -i[0][1], -i[0][2]))
+        self.hkls = np.array([[int(round(i)) for i in pt[0]] for pt in recip_pts], dtype=int).reshape(-1, 3)
+        self.g_hkls = np.array([pt[1] for pt in recip_pts], dtype=float)
+
+        zs = []
+        coeffs = []
+        frac_coords = []
+        occus = []
+        dw_factors = []
+        for site in structure:
+            for sp, occu in site.species_and_occu.items():
+                zs.append(sp.Z)
+                try:
+                    coeffs.append(ATOMIC_SCATTERING_PARAMS[sp.symbol])
+                except KeyError:
+                    raise ValueError("Unable to calculate XRD pattern as there is no scattering coefficients for"
+                                     " %s." % sp.symbol)
+                dw_factors.append(debye_waller_factors.get(sp.symbol, 0))
+                frac_coords.append(site.frac_coords)
+                occus.append(occu)
+        zs = np.array(zs)
+        coeffs = np.array(coeffs)
+        frac_coords = np.array(frac_coords)
+        occus = np.array(occus)
+        dw_factors = np.array(dw_factors)
+
+        # Intensity (squared modulus of the structure factor) of every
+        # reciprocal lattice point, in blocks of points x atoms
+        self.intensities = np.zeros(len(self.g_hkls))
+        for i in range(0, len(self.g_hkls), block_size):
+            s2 = (self.g_hkls[i:i + block_size] / 2) ** 2
+            fs = zs[None, :] - 41.78214 * s2[:, None] * np.sum(
+                coeffs[None, :, :, 0] * np.exp(-coeffs[None, :, :, 1] * s2[:, None, None]), axis=2)
+            dw_correction = np.exp(-dw_factors[None, :] * s2[:, None])
+            g_dot_r = np.dot(self.hkls[i:i + block_size], frac_coords.T)
+            f_hkl = np.sum(fs * occus[None, :] * np.exp(2j * np.pi * g_dot_r) * dw_correction, axis=1)
+            self.intensities[i:i + block_size] = (f_hkl * f_hkl.conjugate()).real
+
+    @staticmethod
+    def _wavelength(wavelength):
+        return WAVELENGTHS[wavelength] if isinstance(wavelength, str) else wavelength
+
+    def get_pattern(self, wavelength, scaled=True, two_theta_range=(0, 90)):
+        """
+        Calculates the diffraction pattern for one wavelength.
+
+        Args:
+            wavelength (str/float): wavelength name (e.g., "CuKa") or value
+                in angstroms; must be covered by max_two_theta
+            scaled (bool): whether to scale intensities to a maximum of 100
+            two_theta_range ([float of length 2]): 2-theta range in degrees
+
+        Returns:
+            DiffractionPattern
+        """
+        wavelength = self._wavelength(wavelength)
+        min_r, max_r = [2 * sin(radians(t / 2)) / wavelength for t in two_theta_range]
+        mask = self.g_hkls <= max_r
+        if min_r:
+            mask &= self.g_hkls >= min_r
+        g_hkls = self.g_hkls[mask]
+        hkls = self.hkls[mask]
+
+        thetas = np.arcsin(np.clip(wavelength * g_hkls / 2, -1, 1))
+        lorentz_factors = (1 + np.cos(2 * thetas) ** 2) / (np.sin(thetas) ** 2 * np.cos(thetas))
+        peak_intensities = self.intensities[mask] * lorentz_factors
+        two_thetas = np.degrees(2 * thetas)
+
+        # Merge points within TWO_THETA_TOL into the first matching peak,
+        # as XRDCalculator does
+        tol = DiffractionPatternCalculator.TWO_THETA_TOL
+        peaks = []
+        for two_theta, intensity, hkl, g_hkl in zip(two_thetas, peak_intensities, hkls.tolist(), g_hkls):
+            if self.is_hex:
+                hkl = (hkl[0], hkl[1], -hkl[0] - hkl[1], hkl[2])
+            match = None
+            for p in reversed(peaks):
+                if abs(two_theta - p[0]) < tol:
+                    match = p
+                elif two_theta - p[0] >= tol:
+                    break
+            if match is not None:
+                match[1] += intensity
+                match[2].append(tuple(hkl))
+            else:
+                peaks.append([two_theta, intensity, [tuple(hkl)], 1 / g_hkl])
+
+        x = []
+        y = []
+        hkls = []
+        d_hkls = []
+        if peaks:
+            max_intensity = max(p[1] for p in peaks)
+            for two_theta, intensity, peak_hkls, d_hkl in sorted(peaks, key=lambda p: p[0]):
+                fam = get_unique_families(peak_hkls)
+                if intensity / max_intensity * 100 > DiffractionPatternCalculator.SCALED_INTENSITY_TOL:
+                    x.append(two_theta)
+                    y.append(intensity)
+                    if HKLS_AS_LIST:
+                        hkls.append([{"hkl": hkl, "multiplicity": mult} for hkl, mult in fam.items()])
+                    else:
+                        hkls.append(fam)
+                    d_hkls.append(d_hkl)
+        xrd = DiffractionPattern(x, y, hkls, d_hkls)
+        if scaled:
+            xrd.normalize(mode="max", value=100)
+        return xrd
@@ -1,17 +1,22 @@
 import os
+import numpy as np
 from pymatgen.core import Structure, Element
 from maggma.builders import Builder
 from pymatgen.entries.compatibility import MaterialsProjectCompatibility
 from pymatgen.analysis.structure_matcher import StructureMatcher, ElementComparator
 from pymatgen.analysis.phase_diagram import PhaseDiagram, PhaseDiagramError
+from pymatgen.analysis.reaction_calculator import Reaction
 from pymatgen.transformations.standard_transformations import \
     PrimitiveCellTransformation
+from collections import defaultdict
 from itertools import chain, combinations
 from itertools import groupby
 from pymatgen.entries.computed_entries import ComputedStructureEntry
 from pymatgen.apps.battery.insertion_battery import InsertionElectrode
 from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 
+from emmet.common.utils import LRUCache
+
 s_hash = lambda el: el.data['comp_delith']
 redox_els = [
     'Ti', 'V', 'Cr', 'Mn', 'Fe', 'Co', 'Ni', 'Cu', 'Nb', 'Mo', 'Sn', 'Sb', 'W',
@@ -31,6 +36,8 @@ class ElectrodesBuilder(Builder):
                  working_ion,
                  query=None,
                  compatibility=MaterialsProjectCompatibility("Advanced"),
+                 pd_cache=None,
+                 entries_cache_size=1000,
                  **kwargs):
         """
         Calculates physical parameters of battery materials the battery entries using
@@ -42,6 +49,12 @@ class ElectrodesBuilder(Builder):
                             the phase diagram is still constructed with the entire set
             compatibility (PymatgenCompatability): Compatability module
                 to ensure energies are compatible
+            pd_cache (Store): optional store of processed phase diagram entries
+                per chemical system, reused as long as the materials in that
+                chemical system are unchanged
+            entries_cache_size (int): number of chemical systems whose
+                processed entries are kept in memory for the phase diagrams
+                of later chemical systems
         """
         self.sm = StructureMatcher(comparator=ElementComparator(),
                                    primitive_cell=False)
@@ -50,9 +63,14 @@ class ElectrodesBuilder(Builder):
         self.working_ion = working_ion
         self.query = query if query else {}
         self.compatibility = compatibility
+        self.pd_cache = pd_cache
         self.completed_tasks = set()
         self.working_ion_entry = None
-        super().__init__(sources=[materials], targets=[electro], **kwargs)
+        self.entries_cache = LRUCache(entries_cache_size)
+        self._profile_pd = None
+        self._profile_cache = {}
+        targets = [electro] if pd_cache is None else [electro, pd_cache]
+        super().__init__(sources=[materials], targets=targets, **kwargs)
 
     def get_items(self):
         """
@@ -89,32 +107,128 @@ class ElectrodesBuilder(Builder):
         chemsys_names = self.materials.distinct('chemsys', q)
         for chemsys in chemsys_names:
             self.logger.debug(f"Calculating the phase diagram for: {chemsys}")
-            # get the phase diagram from using the chemsys
-            pd_q = {
-                'chemsys': {
-                    "$in": list(chemsys_permutations(chemsys))
-                },
-                'deprecated': False
-            }
-            self.logger.debug(f"pd_q: {pd_q}")
-            pd_docs = list(
-                self.materials.query(properties=mat_props, criteria=pd_q))
-            pd_ents = self._mat_doc2comp_entry(pd_docs, store_struct=False)
-            pd_ents = list(filter(None.__ne__, pd_ents))
+            pd_ents = self.get_pd_entries(chemsys)
+            try:
+                phdi = PhaseDiagram(pd_ents)
+            except (PhaseDiagramError, ValueError) as e:
+                self.logger.warning(
+                    f"Could not build the phase diagram for {chemsys}: {e}")
+                continue
+
+            # All framework groups of the chemsys share its phase diagram
             for item in self.get_hashed_entries_from_chemsys(chemsys):
-                item.update({'pd_ents': pd_ents})
+                item.update({'pd': phdi})
 
-                ids_all_ents = {ient.composition.entry_id for ient in item['all_entries']}
-                ids_pd = {ient.composition.entry_id for ient in item['pd_ents']}
+                ids_all_ents = {ient.entry_id for ient in item['all_entries']}
+                ids_pd = {ient.entry_id for ient in phdi.all_entries}
                 assert(ids_all_ents.issubset(ids_pd))
                 self.logger.debug(
                     f"all_ents [{[ient.composition.reduced_formula for ient in item['all_entries']]}]"
                 )
                 self.logger.debug(
-                    f"pd_ents [{[ient.composition.reduced_formula for ient in item['pd_ents']]}]"
+                    f"pd_ents [{[ient.composition.reduced_formula for ient in phdi.all_entries]}]"
                 )
                 yield item
 
+    def get_pd_entries(self, chemsys):
+        """
+        Get the entries of all materials in a chemical system and its
+        subsystems for the phase diagram.  Entries are cached per subsystem,
+        so that chemical systems sharing subsystems (e.g. Li-O) only query
+        and process them once; with a pd_cache store, processed entries are
+        also reused across runs until the materials of a subsystem change.
+
+        Args:
+            chemsys(str): a chemical system represented by string elements seperated by a dash (-)
+
+        Returns:
+            [ComputedStructureEntry]: compatibility-processed entries
+        """
+        all_chemsys = chemsys_permutations(chemsys)
+        entries = {c: self.entries_cache.get(c) for c in all_chemsys}
+        query_chemsys = {c for c, ents in entries.items() if ents is None}
+
+        if query_chemsys and self.pd_cache is not None:
+            loaded = self._load_pd_cache(query_chemsys)
+            entries.update(loaded)
+            query_chemsys -= set(loaded)
+
+        if query_chemsys:
+            pd_q = {
+                'chemsys': {
+                    "$in": list(query_chemsys)
+                },
+                'deprecated': False
+            }
+            self.logger.debug(f"pd_q: {pd_q}")
+            pd_docs = list(
+                self.materials.query(properties=mat_props + ['chemsys', self.materials.lu_field],
+                                     criteria=pd_q))
+            pd_ents = self._mat_doc2comp_entry(pd_docs, store_struct=False)
+            for c in query_chemsys:
+                entries[c] = []
+            for en in filter(None.__ne__, pd_ents):
+                elsyms = sorted(set([el.symbol for el in en.composition.elements]))
+                entries.setdefault("-".join(elsyms), []).append(en)
+
+            if self.pd_cache is not None:
+                self._update_pd_cache(query_chemsys, pd_docs, entries)
+
+        for c in all_chemsys:
+            self.entries_cache.put(c, entries[c])
+
+        return list(chain.from_iterable(entries[c] for c in all_chemsys))
+
+    def _get_materials_state(self, chemsys_list):
+        # task ids and latest update of the materials in each chemical system
+        state = defaultdict(lambda: (set(), None))
+        q = {'chemsys': {"$in": list(chemsys_list)}, 'deprecated': False}
+        lu_field = self.materials.lu_field
+        for d in self.materials.query(
+                criteria=q, properties=['chemsys', 'task_id', lu_field]):
+            ids, lu = state[d['chemsys']]
+            ids.add(d['task_id'])
+            d_lu = self.materials.lu_func[0](d[lu_field]) if d.get(lu_field) else None
+            if lu is None or (d_lu is not None and d_lu > lu):
+                lu = d_lu
+            state[d['chemsys']] = (ids, lu)
+        return state
+
+    def _load_pd_cache(self, chemsys_list):
+        """
+        Loads the entries of chemical systems whose materials are unchanged
+        since they were cached.
+
+        Returns:
+            dict: entries of the chemical systems loaded
+        """
+        state = self._get_materials_state(chemsys_list)
+        loaded = {}
+        for doc in self.pd_cache.query(criteria={'chemsys': {"$in": list(chemsys_list)}}):
+            ids, lu = state[doc['chemsys']]
+            if set(doc['task_ids']) != ids or (lu is not None and (
+                    doc.get('materials_lu') is None or doc['materials_lu'] < lu)):
+                continue
+            loaded[doc['chemsys']] = [
+                ComputedStructureEntry.from_dict(d) for d in doc['entries']
+            ]
+        self.logger.debug(f"Loaded cached entries for {sorted(loaded)}")
+        return loaded
+
+    def _update_pd_cache(self, chemsys_list, docs, entries):
+        lu_field = self.materials.lu_field
+        cache_docs = []
+        for c in chemsys_list:
+            c_docs = [d for d in docs if d['chemsys'] == c]
+            lus = [self.materials.lu_func[0](d[lu_field]) for d in c_docs if d.get(lu_field)]
+            cache_docs.append({
+                'chemsys': c,
+                'task_ids': [d['task_id'] for d in c_docs],
+                'materials_lu': max(lus) if lus else None,
+                'entries': [en.as_dict() for en in entries[c]],
+            })
+        self.pd_cache.update(docs=cache_docs, key='chemsys')
+
     def get_hashed_entries_from_chemsys(self, chemsys):
         """
         Read the entries from the materials database and group them based on the reduced composition
@@ -169,8 +283,8 @@ class ElectrodesBuilder(Builder):
         # sort the entries intro subgroups
         # then perform PD analysis
         all_entries = item['all_entries']
-        pd_ents = item['pd_ents']
-        phdi = PhaseDiagram(pd_ents)
+        phdi = item['pd']
+        pd_ents = phdi.all_entries
 
         # The working ion entries
         ents_wion = list(
@@ -195,7 +309,7 @@ class ElectrodesBuilder(Builder):
                         'reaction': str(itr['reaction']),
                         'chempot': itr['chempot'],
                         'evolution': itr['evolution']
-                    } for itr in phdi.get_element_profile('O', en.composition)]
+                    } for itr in self.get_o_profile(phdi, en.composition)]
                 else:
                     d_muO2 = None
                 en.data['muO2'] = d_muO2
@@ -250,6 +364,40 @@ class ElectrodesBuilder(Builder):
 
         return docs
 
+    def get_o_profile(self, phdi, composition):
+        """
+        Get the O evolution profile of a composition, i.e.
+        phdi.get_element_profile('O', composition).  The profile only depends
+        on the reduced composition up to the amounts of the reactions, so it
+        is computed once per reduced composition and phase diagram and
+        rescaled for each composition.
+
+        Args:
+            phdi (PhaseDiagram): the phase diagram
+            composition (Composition): the composition
+        Returns:
+            [dict]: the profile with the reaction, chempot and evolution
+        """
+        if self._profile_pd is not phdi:
+            self._profile_pd = phdi
+            self._profile_cache = {}
+
+        reduced, factor = composition.get_reduced_composition_and_factor()
+        if reduced.reduced_formula not in self._profile_cache:
+            self._profile_cache[reduced.reduced_formula] = \
+                phdi.get_element_profile('O', reduced)
+
+        profile = []
+        for itr in self._profile_cache[reduced.reduced_formula]:
+            # Rebuild the reaction for the composition as get_element_profile
+            # does: the composition decomposes into the same products
+            rxn = Reaction([composition], itr['reaction'].all_comp[1:])
+            rxn.normalize_to(composition)
+            d = dict(itr)
+            d.update({'reaction': rxn, 'evolution': itr['evolution'] * factor})
+            profile.append(d)
+        return profile
+
     def update_targets(self, items):
         items = list(filter(None, chain.from_iterable(items)))
         if len(items) > 0:
@@ -276,16 +424,89 @@ class ElectrodesBuilder(Builder):
         """
         group the structures together based on similarity of the delithiated primitive cells
 
+        Entries are first bucketed by framework fingerprint, and only entries
+        in the same bucket whose lattices may fit (see may_fit) are compared
+        with the structure matcher.
+
         Args:
             g: a list of entries
         Returns:
             subgroups: subgroups that are grouped together based on structure
         """
+        buckets = defaultdict(list)
+        for en in g:
+            buckets[self.framework_fingerprint(en.data['structure_delith'])].append(en)
+        for bucket in buckets.values():
+            for sg in self._group_bucket(bucket):
+                yield sg
+
+    def framework_fingerprint(self, structure):
+        """
+        Fingerprint of a delithiated host structure that is equal for all
+        structures the structure matcher can fit onto each other.
+
+        Without supercells or subset matching, the matcher only fits
+        structures with the same number of sites.  The spacegroup and volume
+        per atom of the hosts are not used: volumes are rescaled by the
+        matcher, and hosts of different states of charge often differ in
+        symmetry while matching within the tolerances.  Lattices can only be
+        compared within the tolerances, which is done by may_fit.
+
+        Args:
+            structure (Structure): delithiated host structure
+        Returns:
+            tuple: the fingerprint
+        """
+        if self.sm._supercell or self.sm._subset:
+            return ()
+        return (len(structure), )
+
+    def lattice_minima(self, structure):
+        """
+        Lengths of the three shortest non-coplanar lattice vectors of a
+        structure, i.e. of its Niggli-reduced cell, in units of the cube
+        root of the volume per site if the structure matcher rescales
+        volumes.
+
+        Args:
+            structure (Structure): delithiated host structure
+        Returns:
+            np.ndarray: the sorted lengths
+        """
+        abc = np.sort(structure.lattice.get_niggli_reduced_lattice().abc)
+        if self.sm._scale:
+            abc /= (structure.volume / len(structure)) ** (1 / 3)
+        return abc
+
+    def may_fit(self, minima1, minima2):
+        """
+        Whether the structure matcher may fit structures with lattice_minima
+        minima1 and minima2 (in this order) onto each other.
+
+        Without supercells, fit(s1, s2) maps the Niggli-reduced cell of s2
+        (rescaled to the volume of s1) onto lattice vectors of s1 that are
+        less than 1 + ltol times as long.  s1 thus has k non-coplanar lattice
+        vectors shorter than 1 + ltol times the k-th shortest one of s2.
+
+        Args:
+            minima1 (np.ndarray): lattice minima of the first structure
+            minima2 (np.ndarray): lattice minima of the second structure
+        Returns:
+            bool: False if the structures cannot be fit
+        """
+        if self.sm._supercell or self.sm._subset:
+            return True
+        # small margin for the numerical tolerance of the Niggli reduction
+        return bool(np.all(minima1 <= minima2 * (1 + self.sm.ltol) * (1 + 1e-4)))
+
+    def _group_bucket(self, g):
+        minima = [self.lattice_minima(en.data['structure_delith']) for en in g]
 
-        def match_in_group(ref, sub_list):
+        def match_in_group(i, ref, sub_list):
             for el in sub_list:
-                if self.sm.fit(ref.data['structure_delith'],
-                               el[1].data['structure_delith']):
+                if self.may_fit(minima[i], minima[el[0]]) and \
+                        self.sm.fit(ref.data['structure_delith'],
+                                    el[1].data['structure_delith']):
                     return True
             return False
 
@@ -296,7 +517,7 @@ class ElectrodesBuilder(Builder):
             if subgroups == None:
                 subgroups = [[(i, refs)]]
                 continue
-            g_inds = filter(lambda itr: match_in_group(refs, subgroups[itr]),
+            g_inds = filter(lambda itr: match_in_group(i, refs, subgroups[itr]),
                             list(range(len(subgroups))))
             g_inds = list(g_inds)  # list of all matching subgroups
             if not g_inds:
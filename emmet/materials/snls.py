@@ -1,5 +1,7 @@
+import hashlib
+import logging
 from itertools import chain
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 from pydash.objects import get
 
@@ -11,12 +13,20 @@ from pybtex.database import parse_string
 from pybtex.database import BibliographyData
 
 from emmet.magic_numbers import LTOL, STOL, ANGLE_TOL
+from emmet.common.utils import LRUCache
 
 # Silly fix to keep pybtex from spamming warnings
 import os, pybtex
 devnull = open(os.devnull, 'w')
 pybtex.io.stderr = devnull
 
+logger = logging.getLogger(__name__)
+
+# Upper bounds on the number of parsed reference strings and merged
+# bibtex outputs kept in memory by aggregate_snls
+BIBTEX_CACHE_SIZE = 10000
+MERGED_BIBTEX_CACHE_SIZE = 10000
+
 mp_default_snl_fields = {
     "references":
     "@article{Jain2013,\nauthor = {Jain, Anubhav and Ong, Shyue Ping and "
@@ -265,13 +275,12 @@ def aggregate_snls(snls):
     refs = {}
     for snl in snls:
         try:
-            entries = parse_string(snl["about"]["references"], bib_format="bibtex")
-            refs.update(entries.entries)
+            digest, entries = _parse_references(snl["about"]["references"])
+            refs.update((k, (digest, v)) for k, v in entries.items())
         except:
             logger.debug("Failed parsing bibtex: {}".format(snl["about"]["references"]))
 
-    entries = BibliographyData(entries=refs)
-    references = entries.to_string("bibtex")
+    references = _merge_references(refs)
 
     # Keep first SNL remarks since that should assocaited with the base structure
     remarks = list(set([remark for remark in snls[0]["about"]["remarks"]]))
@@ -314,3 +323,47 @@ def aggregate_snls(snls):
     }
 
     return snl_fields
+
+
+_parsed_references = LRUCache(BIBTEX_CACHE_SIZE)
+_merged_references = LRUCache(MERGED_BIBTEX_CACHE_SIZE)
+
+
+def _parse_references(references):
+    """
+    Parses a bibtex string, reusing earlier results for identical strings
+
+    Args:
+        references (str): bibtex string from an SNL
+
+    Returns:
+        (str, OrderedCaseInsensitiveDict): digest of the reference string
+            and the parsed bibtex entries keyed by citation key
+    """
+    digest = hashlib.sha1(references.encode("utf-8")).hexdigest()
+    entries = _parsed_references.get(digest)
+    if entries is None:
+        entries = parse_string(references, bib_format="bibtex").entries
+        _parsed_references.put(digest, entries)
+    return digest, entries
+
+
+def _merge_references(refs):
+    """
+    Serializes a merged set of bibtex entries, reusing earlier results
+    for the same set of entries
+
+    Args:
+        refs (dict): citation key -> (digest of source reference string, entry)
+
+    Returns:
+        str: the merged bibtex string
+    """
+    cache_key = tuple(sorted((k, digest) for k, (digest, _) in refs.items()))
+    references = _merged_references.get(cache_key)
+    if references is None:
+        entries = BibliographyData(entries=OrderedDict(
+            (k, refs[k][1]) for k, _ in cache_key))
+        references = entries.to_string("bibtex")
+        _merged_references.put(cache_key, references)
+    return references
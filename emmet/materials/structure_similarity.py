@@ -5,10 +5,60 @@ from maggma.builders import Builder
 __author__ = "Nils E. R. Zimmermann <nerz@lbl.gov>"
 
 
+def get_statistics_vector(doc, fp_type):
+    """
+    Flattens the site-fingerprint statistics of a site-descriptors
+    document into parallel label and value lists.
+
+    Args:
+        doc (dict): site-descriptors document carrying "statistics".
+        fp_type (str): site fingerprint type ("csf" or "opsf").
+
+    Returns:
+        ([str], [float]): labels ("<name> <stattype>") and values.
+    """
+    labels = []
+    values = []
+    for opdict in doc['statistics'][fp_type]:
+        for stattype, val in opdict.items():
+            if stattype != 'name':
+                values.append(val)
+                labels.append('{} {}'.format(opdict['name'], stattype))
+    return labels, values
+
+
+def align_statistics_vector(labels, values, index):
+    """
+    Orders a statistics vector according to a common label order.
+
+    Args:
+        labels ([str]): labels of the vector as given by
+                        get_statistics_vector.
+        values ([float]): values of the vector.
+        index (dict): label -> column position of the common order.
+
+    Returns:
+        np.ndarray: the aligned vector.
+    """
+    if len(labels) != len(index):
+        raise RuntimeError('Site-fingerprint statistics have {} entries '
+                           'instead of {}'.format(len(labels), len(index)))
+    if set(labels) != set(index):
+        raise RuntimeError('Site-fingerprint statistics labels differ: '
+                           'missing {}, unexpected {}'.format(
+                               sorted(set(index) - set(labels)),
+                               sorted(set(labels) - set(index))))
+    row = np.full(len(index), np.nan)
+    row[[index[k] for k in labels]] = values
+    return row
+
+
 class StructureSimilarityBuilder(Builder):
 
     def __init__(self, site_descriptors, structure_similarity,
-                 fp_type='csf', **kwargs):
+                 fp_type='csf', method='pairwise', block_size=512,
+                 k=10, metric='cos', approximate=False, incremental=False,
+                 **kwargs):
         """
         Calculates similarity metrics between structures on the basis
         of site descriptors.
@@ -25,11 +75,39 @@ class StructureSimilarityBuilder(Builder):
                            CrystalSiteFingerprint class)
                            or "opsf" (based on matminer's
                            OPSiteFingerprint class)).
+            method (str): "pairwise" processes one pair of documents
+                          per item; "matrix" loads all statistics
+                          vectors once into a dense matrix and computes
+                          the similarities of all pairs in blocks;
+                          "topk" only stores the k nearest neighbors
+                          of every material (one document per material).
+            block_size (int): number of materials per block in
+                              "matrix" and "topk" mode.
+            k (int): number of neighbors stored per material in
+                     "topk" mode.
+            metric (str): neighbor ranking in "topk" mode, either
+                          "cos" (largest cosine similarity) or "dist"
+                          (smallest Euclidean distance).
+            approximate (bool): use an approximate (inverted-list)
+                                neighbor index in "topk" mode instead
+                                of exact blocked brute-force search.
+            incremental (bool): in "topk" mode, only search neighbors
+                                for new or updated site descriptors
+                                (by last-updated filtering) and merge
+                                them into the stored neighbor records.
         """
 
         self.site_descriptors = site_descriptors
         self.structure_similarity = structure_similarity
         self.fp_type = fp_type
+        self.method = method
+        self.block_size = block_size
+        self.k = k
+        self.metric = metric
+        self.approximate = approximate
+        self.incremental = incremental
+        self._index = None
+        self._removed = []
 
         super().__init__(sources=[site_descriptors],
                          targets=[structure_similarity],
@@ -47,6 +125,13 @@ class StructureSimilarityBuilder(Builder):
 
         self.logger.info("Setting indexes")
 
+        if self.method == 'matrix':
+            yield from self.get_block_items()
+            return
+        if self.method == 'topk':
+            yield from self.get_topk_items()
+            return
+
         #TODO: re-introduce last-updated filtering.
         task_ids = list(self.site_descriptors.distinct(self.site_descriptors.key))
         n_task_ids = len(task_ids)
@@ -74,6 +159,11 @@ class StructureSimilarityBuilder(Builder):
         Returns:
             dict: similarity measures.
         """
+        if self.method == 'matrix':
+            return self.get_block_similarities(item)
+        if self.method == 'topk':
+            return self.get_topk_neighbors(item)
+
         self.logger.debug("Similarities for {} and {}".format(
             item[0][self.site_descriptors.key],
             item[1][self.site_descriptors.key]))
@@ -94,12 +184,36 @@ class StructureSimilarityBuilder(Builder):
         Args:
             items ([[dict]]): a list of list of site-descriptors dictionaries to update.
         """
+        if self.method in ('matrix', 'topk'):
+            items = [doc for block in items for doc in block]
+        if self.method == 'topk':
+            self.remove_targets()
+
         if len(items) > 0:
             self.logger.info("Updating {} structure-similarity docs".format(len(items)))
             self.structure_similarity.update(docs=items)
         else:
             self.logger.info("No items to update")
 
+    def remove_targets(self):
+        """
+        Deletes the neighbor documents of materials that get_items found
+        to be removed from the site descriptors.
+        """
+        if self._removed:
+            self.logger.info("Removing {} structure-similarity docs".format(
+                len(self._removed)))
+            self.structure_similarity.collection.delete_many(
+                {self.structure_similarity.key: {"$in": self._removed},
+                 "fp_type": self.fp_type})
+            self._removed = []
+
+    def finalize(self, cursor=None):
+        # Removals are pending if get_items yielded no items
+        if self.method == 'topk':
+            self.remove_targets()
+        super().finalize(cursor)
+
     def get_similarities(self, d1, d2):
         doc = {}
 
@@ -108,16 +222,8 @@ class StructureSimilarityBuilder(Builder):
             dout = {}
             l = {}
             v = {}
-            for i, li in enumerate([d1['statistics'][self.fp_type],
-                                  d2['statistics'][self.fp_type]]):
-                v[i] = []
-                l[i] = []
-                #for optype, stats in d.items():
-                for opdict in li:
-                    for stattype, val in opdict.items():
-                        if stattype != 'name':
-                            v[i].append(val)
-                            l[i].append('{} {}'.format(opdict['name'], stattype))
+            for i, d in enumerate([d1, d2]):
+                l[i], v[i] = get_statistics_vector(d, self.fp_type)
             if len(l[0]) != len(l[1]):
                 raise RuntimeError('Site-fingerprint statistics dictionaries'
                                    ' have different sizes ({}, {})'.format(
@@ -139,3 +245,463 @@ class StructureSimilarityBuilder(Builder):
                               "metrics: {}".format(e))
 
         return doc
+
+    def get_statistics_matrix(self, criteria=None, labels=None):
+        """
+        Loads the statistics vectors of site-descriptors documents
+        with a single query.
+
+        Args:
+            criteria (dict): query to limit the site-descriptors documents.
+            labels ([str]): label order to align the vectors to; taken
+                            from the first document if not given.
+
+        Returns:
+            ([str], [str], np.ndarray): material keys, the common label
+                order, and the (materials x labels) statistics matrix
+                whose columns are aligned to that label order.
+        """
+        key = self.site_descriptors.key
+        ids = []
+        rows = []
+        index = {k: n for n, k in enumerate(labels)} if labels else None
+        for d in self.site_descriptors.query(
+                properties=[key, "statistics"], criteria=criteria):
+            try:
+                l, v = get_statistics_vector(d, self.fp_type)
+                if index is None:
+                    labels = l
+                    index = {k: n for n, k in enumerate(labels)}
+                rows.append(align_statistics_vector(l, v, index))
+            except Exception as e:
+                self.logger.error("Skipping statistics of {}: {}".format(
+                    d.get(key), e))
+                continue
+            ids.append(d[key])
+
+        if not rows:
+            return ids, labels or [], np.zeros((0, len(labels or [])))
+        return ids, labels, np.array(rows)
+
+    def get_block_items(self):
+        """
+        Splits the statistics matrix into row blocks and yields every
+        pair of blocks (upper triangle, including the diagonal).
+
+        Returns:
+            generator of (ids_1, matrix_1, ids_2, matrix_2, same_block)
+        """
+        ids, labels, mat = self.get_statistics_matrix()
+        self.logger.info("Loaded {} statistics vectors with {} "
+                         "entries".format(len(ids), len(labels)))
+        starts = list(range(0, len(ids), self.block_size))
+        self.total = len(starts) * (len(starts) + 1) // 2
+        for n, i in enumerate(starts):
+            ids1, mat1 = ids[i:i + self.block_size], mat[i:i + self.block_size]
+            for j in starts[n:]:
+                yield (ids1, mat1,
+                       ids[j:j + self.block_size], mat[j:j + self.block_size],
+                       i == j)
+
+    def get_block_similarities(self, item):
+        """
+        Computes cosine similarity and Euclidean distance for all pairs
+        between two blocks of statistics vectors.
+
+        Args:
+            item (tuple): (ids_1, matrix_1, ids_2, matrix_2, same_block)
+                          as yielded by get_block_items.
+
+        Returns:
+            [dict]: similarity documents, one per pair of materials.
+        """
+        ids1, mat1, ids2, mat2, same_block = item
+        cos, dist = block_similarities(mat1, mat2)
+
+        if same_block:
+            rows, cols = np.triu_indices(len(ids1), k=1)
+        else:
+            rows, cols = np.indices(cos.shape).reshape(2, -1)
+
+        key = self.structure_similarity.key
+        return [{key: tuple(sorted([ids1[r], ids2[c]])),
+                 'cos': float(cos[r, c]), 'dist': float(dist[r, c])}
+                for r, c in zip(rows, cols)]
+
+    def get_index(self):
+        """
+        Builds a nearest-neighbor index over the statistics vectors of
+        all site-descriptors documents.
+
+        Returns:
+            StructureSimilarityIndex
+        """
+        ids, labels, mat = self.get_statistics_matrix()
+        self.logger.info("Indexing {} statistics vectors with {} "
+                         "entries".format(len(ids), len(labels)))
+        return StructureSimilarityIndex(
+            ids, labels, mat, fp_type=self.fp_type,
+            key=self.site_descriptors.key, metric=self.metric,
+            approximate=self.approximate, block_size=self.block_size)
+
+    def get_topk_items(self):
+        """
+        Builds the neighbor index and yields blocks of its materials.
+        Items only carry material keys; the index itself stays with the
+        builder and is built once more by process_item in every process
+        that does not have it yet.
+
+        In incremental mode, new or updated materials and materials
+        whose stored neighbors include one of them are searched against
+        all materials; all other materials are only searched against the
+        new ones and merged with their stored neighbors.
+
+        Neighbor documents of materials that are no longer in the site
+        descriptors are removed by update_targets.
+
+        Returns:
+            generator of (ids, cols, current): keys of the materials to
+                search for, keys of the materials to search among (None
+                for all), and the stored neighbors to merge with by key
+                (or None).
+        """
+        index = self._index = self.get_index()
+        rows = np.arange(len(index.ids))
+        merge_rows = np.zeros(0, dtype=int)
+        new_cols = None
+        current = {}
+        key = self.structure_similarity.key
+
+        if self.incremental:
+            criteria = dict(self.site_descriptors.lu_filter(
+                self.structure_similarity))
+            new_ids = set(self.site_descriptors.distinct(
+                self.site_descriptors.key, criteria))
+            for d in self.structure_similarity.query(
+                    properties=[key, "neighbors"],
+                    criteria={"fp_type": self.fp_type}):
+                current[d[key]] = d.get("neighbors", [])
+            new_ids |= set(index.ids) - set(current.keys())
+            new_cols = np.array(sorted(index.positions[i] for i in new_ids
+                                       if i in index.positions), dtype=int)
+
+            # Stored neighbor lists that mention new, updated or removed
+            # materials cannot be merged and are searched from scratch
+            stale = np.zeros(len(index.ids), dtype=bool)
+            stale[new_cols] = True
+            for n, i in enumerate(index.ids):
+                if not stale[n] and any(
+                        nn[index.key] in new_ids or
+                        nn[index.key] not in index.positions
+                        for nn in current[i]):
+                    stale[n] = True
+            rows = np.flatnonzero(stale)
+            merge_rows = np.flatnonzero(~stale) if len(new_cols) else \
+                np.zeros(0, dtype=int)
+            self.logger.info("Found {} new or updated materials; searching "
+                             "{} materials from scratch and merging {} "
+                             "others".format(len(new_cols), len(rows),
+                                             len(merge_rows)))
+            stored = set(current.keys())
+        else:
+            stored = set(self.structure_similarity.distinct(
+                key, {"fp_type": self.fp_type}))
+        self._removed = sorted(stored - set(index.ids))
+
+        starts = range(0, len(rows), self.block_size)
+        merge_starts = range(0, len(merge_rows), self.block_size)
+        self.total = len(starts) + len(merge_starts)
+        new_keys = None if new_cols is None else \
+            [index.ids[n] for n in new_cols]
+        for i in starts:
+            yield [index.ids[n] for n in rows[i:i + self.block_size]], \
+                None, None
+        for i in merge_starts:
+            block = [index.ids[n] for n in merge_rows[i:i + self.block_size]]
+            yield block, new_keys, {k: current[k] for k in block}
+
+    def get_topk_neighbors(self, item):
+        """
+        Finds the k nearest neighbors of a block of indexed materials.
+
+        Args:
+            item (tuple): (ids, cols, current) as yielded by
+                          get_topk_items.
+
+        Returns:
+            [dict]: one neighbor document per material whose neighbors
+                were computed or changed.
+        """
+        ids, cols, current = item
+        if self._index is None:
+            self._index = self.get_index()
+        index = self._index
+        rows = np.array([index.positions[i] for i in ids
+                         if i in index.positions], dtype=int)
+        if cols is not None:
+            cols = np.array([index.positions[i] for i in cols
+                             if i in index.positions], dtype=int)
+        neighbors = index.search(index.matrix[rows], self.k, exclude=rows,
+                                 cols=cols)
+        docs = []
+        for n, nn in zip(rows, neighbors):
+            if current is not None:
+                found = set(d[index.key] for d in nn)
+                merged = nn + [d for d in current[index.ids[n]]
+                               if d[index.key] not in found]
+                if self.metric == 'cos':
+                    merged.sort(key=lambda d: -d['cos'])
+                else:
+                    merged.sort(key=lambda d: d['dist'])
+                nn = merged[:self.k]
+                if [d[index.key] for d in nn] == \
+                        [d[index.key] for d in current[index.ids[n]]]:
+                    continue
+            docs.append({self.structure_similarity.key: index.ids[n],
+                         "fp_type": self.fp_type,
+                         "neighbors": nn})
+        return docs
+
+
+class StructureSimilarityIndex(object):
+
+    def __init__(self, ids, labels, matrix, fp_type=None, key="task_id",
+                 metric='cos', approximate=False, n_lists=None, n_probe=8,
+                 block_size=512, seed=0):
+        """
+        In-process nearest-neighbor index over site-fingerprint
+        statistics vectors.
+
+        Args:
+            ids ([str]): material keys, one per row of matrix.
+            labels ([str]): statistics labels, one per column of matrix.
+            matrix (np.ndarray): (materials x labels) statistics matrix.
+            fp_type (str): site fingerprint type of the statistics; needed
+                           to query with site-descriptors documents.
+            key (str): name of the material key in returned neighbors.
+            metric (str): "cos" ranks by largest cosine similarity,
+                          "dist" by smallest Euclidean distance.
+            approximate (bool): restrict searches to the n_probe
+                                closest of n_lists coarse clusters
+                                instead of scanning all rows.
+            n_lists (int): number of coarse clusters (default:
+                           square root of the number of rows).
+            n_probe (int): number of clusters scanned per query.
+            block_size (int): number of rows compared at once.
+            seed (int): random seed for the cluster initialization.
+        """
+        if metric not in ('cos', 'dist'):
+            raise ValueError("Unknown metric: {}".format(metric))
+        self.ids = list(ids)
+        self.labels = list(labels)
+        self.matrix = np.asarray(matrix, dtype=float).reshape(
+            len(self.ids), len(self.labels))
+        self.fp_type = fp_type
+        self.key = key
+        self.metric = metric
+        self.block_size = block_size
+        self.positions = {k: n for n, k in enumerate(self.ids)}
+        self.label_index = {k: n for n, k in enumerate(self.labels)}
+        self.sqnorms = np.einsum('ij,ij->i', self.matrix, self.matrix)
+
+        self.approximate = approximate and len(self.ids) > 0
+        if self.approximate:
+            n_lists = min(n_lists or max(1, int(np.sqrt(len(self.ids)))),
+                          len(self.ids))
+            self.n_probe = min(n_probe, n_lists)
+            self._build_lists(n_lists, seed)
+
+    @classmethod
+    def from_docs(cls, docs, fp_type, key="task_id", **kwargs):
+        """
+        Builds an index from site-descriptors documents.
+
+        Args:
+            docs ([dict]): site-descriptors documents.
+            fp_type (str): site fingerprint type ("csf" or "opsf").
+            key (str): material key of the documents.
+            kwargs: passed to the constructor.
+        """
+        ids = []
+        rows = []
+        labels = []
+        index = None
+        for d in docs:
+            l, v = get_statistics_vector(d, fp_type)
+            if index is None:
+                labels = l
+                index = {k: n for n, k in enumerate(labels)}
+            rows.append(align_statistics_vector(l, v, index))
+            ids.append(d[key])
+        return cls(ids, labels, np.array(rows), fp_type=fp_type, key=key,
+                   **kwargs)
+
+    def _cluster_space(self, mat):
+        """
+        Coordinates used for clustering: unit vectors for "cos",
+        the raw vectors for "dist".
+        """
+        if self.metric == 'cos':
+            norms = np.sqrt(np.einsum('ij,ij->i', mat, mat))
+            return mat / np.where(norms > 0, norms, 1)[:, None]
+        return mat
+
+    def _nearest_centroids(self, mat, centroids, n=1):
+        """
+        Positions of the n closest centroids for each row of mat.
+        """
+        out = np.empty((len(mat), n), dtype=int)
+        csq = np.einsum('ij,ij->i', centroids, centroids)
+        for i in range(0, len(mat), self.block_size):
+            d2 = csq[None, :] - 2 * np.dot(mat[i:i + self.block_size],
+                                           centroids.T)
+            out[i:i + self.block_size] = np.argsort(d2, axis=1)[:, :n]
+        return out
+
+    def _build_lists(self, n_lists, seed):
+        """
+        Partitions the indexed rows into coarse clusters with a few
+        Lloyd iterations.
+        """
+        rng = np.random.RandomState(seed)
+        mat = self._cluster_space(self.matrix)
+        centroids = mat[rng.choice(len(mat), n_lists, replace=False)]
+        for _ in range(10):
+            assign = self._nearest_centroids(mat, centroids)[:, 0]
+            for c in range(n_lists):
+                members = mat[assign == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+        assign = self._nearest_centroids(mat, centroids)[:, 0]
+        self.centroids = centroids
+        self.lists = [np.flatnonzero(assign == c) for c in range(n_lists)]
+
+    def search(self, mat, k, exclude=None, cols=None):
+        """
+        Finds the k nearest indexed materials for each row of mat.
+
+        Args:
+            mat (np.ndarray): (n x labels) aligned statistics vectors.
+            k (int): number of neighbors per row.
+            exclude (np.ndarray): optional index position per row to leave
+                                  out (e.g., the row itself).
+            cols (np.ndarray): optional index positions to search among
+                               exactly; all indexed rows if not given.
+
+        Returns:
+            [[dict]]: per row, the neighbors ordered from closest on, each
+                with the material key, "cos" and "dist".
+        """
+        mat = np.atleast_2d(np.asarray(mat, dtype=float))
+        exclude = np.full(len(mat), -1) if exclude is None \
+            else np.asarray(exclude)
+
+        if self.approximate and cols is None:
+            probes = self._nearest_centroids(self._cluster_space(mat),
+                                             self.centroids, self.n_probe)
+            return [self._search_cols(
+                        mat[n:n + 1], k,
+                        np.concatenate([self.lists[c] for c in probes[n]]),
+                        exclude[n:n + 1])[0]
+                    for n in range(len(mat))]
+
+        results = []
+        for i in range(0, len(mat), self.block_size):
+            results.extend(self._search_cols(
+                mat[i:i + self.block_size], k,
+                np.arange(len(self.ids)) if cols is None else cols,
+                exclude[i:i + self.block_size]))
+        return results
+
+    def _search_cols(self, mat, k, cols, exclude):
+        """
+        Exact top-k search of the rows of mat among the indexed rows cols,
+        scanning cols in blocks while keeping a running top-k.
+        """
+        n = len(mat)
+        sqnorms = np.einsum('ij,ij->i', mat, mat)
+        best = np.zeros((n, 0), dtype=int)
+        best_scores = np.zeros((n, 0))
+        best_cos = np.zeros((n, 0))
+        best_dist = np.zeros((n, 0))
+        for j in range(0, len(cols), self.block_size):
+            block = cols[j:j + self.block_size]
+            cos, dist = block_similarities(mat, self.matrix[block],
+                                           sqnorms, self.sqnorms[block])
+            # Larger scores are closer; -inf marks unusable entries
+            scores = np.where(np.isnan(cos), -np.inf, cos) \
+                if self.metric == 'cos' else -dist
+            scores[block[None, :] == exclude[:, None]] = -np.inf
+
+            cand = np.concatenate(
+                [best, np.broadcast_to(block, scores.shape)], axis=1)
+            scores = np.concatenate([best_scores, scores], axis=1)
+            cos = np.concatenate([best_cos, cos], axis=1)
+            dist = np.concatenate([best_dist, dist], axis=1)
+            keep = min(k, scores.shape[1])
+            top = np.argpartition(-scores, keep - 1, axis=1)[:, :keep]
+            best, best_scores, best_cos, best_dist = [
+                np.take_along_axis(a, top, axis=1)
+                for a in (cand, scores, cos, dist)]
+
+        results = []
+        for r in range(n):
+            order = np.argsort(-best_scores[r], kind='stable')
+            results.append([
+                {self.key: self.ids[best[r, o]],
+                 "cos": float(best_cos[r, o]),
+                 "dist": float(best_dist[r, o])}
+                for o in order if best_scores[r, o] > -np.inf])
+        return results
+
+    def query(self, target, k=10):
+        """
+        Finds the k most similar indexed materials.
+
+        Args:
+            target (str or dict): key of an indexed material (which is then
+                                  excluded from its own neighbors) or a
+                                  site-descriptors document.
+            k (int): number of neighbors.
+
+        Returns:
+            [dict]: neighbors ordered from closest on, each with the
+                material key, "cos" and "dist".
+        """
+        if isinstance(target, dict):
+            l, v = get_statistics_vector(target, self.fp_type)
+            return self.search(
+                align_statistics_vector(l, v, self.label_index), k)[0]
+        n = self.positions[target]
+        return self.search(self.matrix[n], k, exclude=[n])[0]
+
+
+def block_similarities(mat1, mat2, sq1=None, sq2=None):
+    """
+    Computes cosine similarities and Euclidean distances between all rows
+    of two statistics matrices.
+
+    Args:
+        mat1 (np.ndarray): (n1 x m) matrix of statistics vectors.
+        mat2 (np.ndarray): (n2 x m) matrix of statistics vectors.
+        sq1 (np.ndarray): precomputed squared row norms of mat1.
+        sq2 (np.ndarray): precomputed squared row norms of mat2.
+
+    Returns:
+        (np.ndarray, np.ndarray): (n1 x n2) cosine similarities and
+            Euclidean distances.
+    """
+    dot = np.dot(mat1, mat2.T)
+    sq1 = np.einsum('ij,ij->i', mat1, mat1) if sq1 is None else sq1
+    sq2 = np.einsum('ij,ij->i', mat2, mat2) if sq2 is None else sq2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cos = np.clip(dot / np.sqrt(np.outer(sq1, sq2)), -1, 1)
+    sqsum = sq1[:, None] + sq2[None, :]
+    sqdist = sqsum - 2 * dot
+    # The expansion loses all precision for (nearly) identical vectors;
+    # recompute those distances from the differences
+    rows, cols = np.nonzero(sqdist <= 1e-6 * sqsum)
+    sqdist[rows, cols] = np.einsum('ij,ij->i', mat1[rows] - mat2[cols],
+                                   mat1[rows] - mat2[cols])
+    dist = np.sqrt(np.maximum(sqdist, 0))
+    return cos, dist
@@ -1,14 +1,16 @@
 import os
 import itertools
+import multiprocessing
 from operator import itemgetter
 
 from pymatgen.core import Structure
+from pymatgen.core.surface import SlabGenerator, get_symmetrically_distinct_miller_indices
 from pymatgen.analysis.elasticity.elastic import ElasticTensor
-from pymatgen.analysis.substrate_analyzer import SubstrateAnalyzer
+from pymatgen.analysis.substrate_analyzer import SubstrateAnalyzer, reduce_vectors
 from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 
 from maggma.builders import Builder
-from maggma.utils import source_keys_updated
+from maggma.utils import grouper, source_keys_updated
 
 from emmet.common.utils import load_settings
 __author__ = "Shyam Dwaraknath <shyamd@lbl.gov>"
@@ -16,9 +18,13 @@ __author__ = "Shyam Dwaraknath <shyamd@lbl.gov>"
 MODULE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)))
 DEFAULT_SUBSTRATES = os.path.join(MODULE_DIR, "settings", "substrates.json")
 
+# Surface vectors of all substrates in a matching worker process
+_worker_substrate_vectors = None
+
 
 class SubstrateBuilder(Builder):
-    def __init__(self, materials, substrates, elasticity=None, substrates_file=None, query=None, **kwargs):
+    def __init__(self, materials, substrates, elasticity=None, substrates_file=None, query=None, num_workers=1,
+                 **kwargs):
         """
         Calculates matching substrates
 
@@ -28,6 +34,8 @@ class SubstrateBuilder(Builder):
             elasticity (Store): Store of elastic tensor documents
             substrates_file (path): file of substrates to consider
             query (dict): dictionary to limit materials to be analyzed
+            num_workers (int): number of processes to match each film against
+                the substrates with; 1 matches in the builder's process
         """
 
         self.materials = materials
@@ -35,7 +43,10 @@ class SubstrateBuilder(Builder):
         self.elasticity = elasticity
         self.substrates_file = substrates_file
         self.query = query if query else {}
+        self.num_workers = num_workers
         self.__settings = load_settings(self.substrates_file, DEFAULT_SUBSTRATES)
+        self._substrate_vectors = None
+        self._pool = None
 
         super().__init__(sources=[materials, elasticity], targets=[substrates], **kwargs)
 
@@ -62,13 +73,22 @@ class SubstrateBuilder(Builder):
 
         self.logger.info("Updating all substrate calculations for {} materials".format(len(mats)))
 
-        for m in mats:
-            e_tensor = self.elasticity.query_one(criteria={self.elasticity.key: m})
-            e_tensor = e_tensor.get("elasticity", {}).get("elastic_tensor", None) if e_tensor else None
-            mat = self.materials.query_one(
-                criteria={self.materials.key: m}, properties=["structure", self.materials.key])
+        # Fetch materials and elastic tensors of a chunk of materials at a time
+        for chunk in grouper(sorted(mats), self.chunk_size):
+            chunk = [m for m in chunk if m is not None]
+
+            e_tensors = {}
+            if self.elasticity:
+                for d in self.elasticity.query(criteria={self.elasticity.key: {"$in": chunk}},
+                                               properties=[self.elasticity.key, "elasticity.elastic_tensor"]):
+                    e_tensors[d[self.elasticity.key]] = d.get("elasticity", {}).get("elastic_tensor", None)
 
-            yield {"structure": mat["structure"], "task_id": mat[self.materials.key], "elastic_tensor": e_tensor}
+            for mat in self.materials.query(
+                    criteria={self.materials.key: {"$in": chunk}},
+                    properties=["structure", self.materials.key, self.materials.lu_field]):
+                yield {"structure": mat["structure"], "task_id": mat[self.materials.key],
+                       "elastic_tensor": e_tensors.get(mat[self.materials.key]),
+                       self.materials.lu_field: mat.get(self.materials.lu_field)}
 
     def process_item(self, item):
         """
@@ -88,22 +108,35 @@ class SubstrateBuilder(Builder):
         self.logger.debug("Calculating substrates for {}".format(item["task_id"]))
 
         film = Structure.from_dict(item["structure"])
+        sa = SubstrateAnalyzer()
+        film_vectors = get_surface_vectors(
+            film, sorted(get_symmetrically_distinct_miller_indices(film, sa.film_max_miller)))
+
+        # Match the film against all substrates, in parallel if requested
+        substrate_vectors = self.get_substrate_vectors()
+        if self.num_workers > 1:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self.num_workers, initializer=_init_matching_worker,
+                                                  initargs=(substrate_vectors, ))
+            try:
+                # Elastic tensors lose their attributes when pickled, so
+                # the workers get the Voigt matrix
+                voigt = item.get("elastic_tensor", None)
+                results = self._pool.map(_match_substrate_worker,
+                                         [(film, film_vectors, voigt, i) for i in range(len(substrates))])
+            except BaseException:
+                # Don't leave the workers behind if the builder stops here
+                self.close_pool(terminate=True)
+                raise
+        else:
+            results = [match_substrate(film, film_vectors, sv, elastic_tensor) for sv in substrate_vectors]
 
         all_matches = []
 
-        sa = SubstrateAnalyzer()
-
-        for s in substrates:
+        for s, lowest_matches in zip(substrates, results):
 
             substrate = s["structure"]
 
-            # Calculate lowest matches and group by substrate orientation
-            matches_by_orient = groupby_itemkey(
-                sa.calculate(film, substrate, elastic_tensor, lowest=True), "sub_miller")
-
-            # Find the lowest area match for each substrate orientation
-            lowest_matches = [min(g, key=itemgetter("match_area")) for k, g in matches_by_orient]
-
             for match in lowest_matches:
                 db_entry = {
                     "sub_id": s["task_id"],
@@ -131,6 +164,23 @@ class SubstrateBuilder(Builder):
 
         return d
 
+    def get_substrate_vectors(self):
+        """
+        Gets the surface vectors of all substrate orientations, which only
+        depend on the substrates and are computed once per builder.
+
+        Returns:
+            [[(miller, vectors)]]: surface vectors for each substrate
+        """
+        if self._substrate_vectors is None:
+            self.logger.info("Calculating surface vectors of {} substrates".format(len(self.__settings)))
+            sa = SubstrateAnalyzer()
+            self._substrate_vectors = [
+                get_surface_vectors(s["structure"], sorted(
+                    get_symmetrically_distinct_miller_indices(s["structure"], sa.substrate_max_miller)))
+                for s in self.__settings]
+        return self._substrate_vectors
+
     def update_targets(self, items):
         """
         Inserts the new substrate matches into the substrates collection
@@ -147,6 +197,28 @@ class SubstrateBuilder(Builder):
         else:
             self.logger.info("No items to update")
 
+    def close_pool(self, terminate=False):
+        """
+        Shuts down the matching worker pool, if one was started
+
+        Args:
+            terminate (bool): stop the workers immediately instead of
+                letting them finish their current tasks
+        """
+        if self._pool is not None:
+            try:
+                if terminate:
+                    self._pool.terminate()
+                else:
+                    self._pool.close()
+                self._pool.join()
+            finally:
+                self._pool = None
+
+    def finalize(self, cursor=None):
+        self.close_pool()
+        super().finalize(cursor)
+
     def get_mats_w_updated_elastic_tensors(self):
         """
         Gets all materials that have had their elastic tensor updated
@@ -204,6 +276,71 @@ class SubstrateBuilder(Builder):
         self.substrates.ensure_index(self.substrates.lu_field)
 
 
+def get_surface_vectors(structure, millers):
+    """
+    Reduced in-plane lattice vectors of the surfaces of a structure, as
+    SubstrateAnalyzer.generate_surface_vectors computes them.
+
+    Args:
+        structure (Structure): the structure
+        millers ([tuple]): miller indices of the surfaces
+
+    Returns:
+        [(miller, vectors)]
+    """
+    vectors = []
+    for miller in millers:
+        slab = SlabGenerator(structure, miller, 20, 15, primitive=False).get_slab()
+        vectors.append((miller, reduce_vectors(slab.lattice.matrix[0], slab.lattice.matrix[1])))
+    return vectors
+
+
+def match_substrate(film, film_vectors, substrate_vectors, elastic_tensor=None):
+    """
+    Finds the lowest area match of a film for each substrate orientation,
+    as SubstrateAnalyzer.calculate with lowest=True but with precomputed
+    surface vectors.
+
+    Args:
+        film (Structure): film structure
+        film_vectors ([(miller, vectors)]): surface vectors of the film
+        substrate_vectors ([(miller, vectors)]): surface vectors of the substrate
+        elastic_tensor (ElasticTensor): elastic tensor of the film
+
+    Returns:
+        [dict]: lowest area match for each substrate orientation
+    """
+    sa = SubstrateAnalyzer()
+    # calculate_3D_elastic_energy reads the film from the analyzer, which
+    # only calculate sets
+    sa.film = film
+    matches = []
+    for film_miller, f_vectors in film_vectors:
+        for sub_miller, s_vectors in substrate_vectors:
+            for match in sa.zsl(f_vectors, s_vectors, True):
+                match["film_miller"] = film_miller
+                match["sub_miller"] = sub_miller
+                if elastic_tensor is not None:
+                    energy, strain = sa.calculate_3D_elastic_energy(film, match, elastic_tensor, include_strain=True)
+                    match["elastic_energy"] = energy
+                    match["strain"] = strain
+                matches.append(match)
+
+    # Find the lowest area match for each substrate orientation
+    return [min(g, key=itemgetter("match_area")) for k, g in groupby_itemkey(matches, "sub_miller")]
+
+
+def _init_matching_worker(substrate_vectors):
+    global _worker_substrate_vectors
+    _worker_substrate_vectors = substrate_vectors
+
+
+def _match_substrate_worker(args):
+    film, film_vectors, voigt, i = args
+    elastic_tensor = ElasticTensor.from_voigt(voigt) if voigt else None
+    return match_substrate(film, film_vectors, _worker_substrate_vectors[i], elastic_tensor)
+
+
 def conventional_standard_structure(doc):
     """Get a conventional standard structure from doc["structure"]."""
     s = Structure.from_dict(doc["structure"])
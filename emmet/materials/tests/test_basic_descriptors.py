@@ -2,7 +2,10 @@ import unittest
 import os
 
 from pymatgen import Structure
-from emmet.materials.basic_descriptors import BasicDescriptorsBuilder
+from pymatgen.analysis import local_env
+from matminer.featurizers.site import CoordinationNumber
+from emmet.materials.basic_descriptors import BasicDescriptorsBuilder, \
+    site_descriptors_from_array, site_descriptors_to_array
 from maggma.stores import MemoryStore
 
 from monty.serialization import loadfn
@@ -130,6 +133,52 @@ class BasicDescriptorsBuilderTest(unittest.TestCase):
             ds['csf'][get_index(ds['csf'], 'body-centered cubic CN_8')]['std'],
             0)
 
+    def test_coordination_numbers(self):
+        test_basic_descriptors = MemoryStore("test_basic_descriptors")
+        sd_builder = BasicDescriptorsBuilder(
+            self.test_materials, test_basic_descriptors)
+
+        for mat in self.test_materials.query():
+            structure = Structure.from_dict(mat["structure"])
+            d = sd_builder.get_site_descriptor_arrays(structure)
+            for nn in sd_builder.nns:
+                for k, use_weights in [("cn_{}", "none"), ("cn_wt_{}", "sum")]:
+                    k = k.format(nn)
+                    cn = CoordinationNumber(getattr(local_env, nn)(),
+                                            use_weights=use_weights)
+                    try:
+                        expected = [cn.featurize(structure, i)
+                                    for i in range(len(structure))]
+                    except ValueError:
+                        # e.g. CrystalNN without weighted_cn
+                        self.assertNotIn(k, d)
+                        continue
+                    self.assertEqual(d[k]["labels"], cn.feature_labels())
+                    for v, e in zip(d[k]["values"], expected):
+                        self.assertAlmostEqual(v[0], e[0])
+            self.assertNotIn("cn_wt_CrystalNN", d)
+
+    def test_compact(self):
+        test_basic_descriptors = MemoryStore("test_basic_descriptors")
+        sd_builder = BasicDescriptorsBuilder(
+            self.test_materials, test_basic_descriptors, compact=True)
+
+        NaCl = self.test_materials.query_one(criteria={"task_id": "mp-22862"})
+        doc = sd_builder.calc(NaCl)
+        csf = doc['site_descriptors']['csf']
+        self.assertEqual(len(csf['values']), 2)
+        self.assertEqual(len(csf['values'][0]), len(csf['labels']))
+        self.assertAlmostEqual(
+            csf['values'][0][csf['labels'].index('octahedral CN_6')], 1)
+
+        d = site_descriptors_from_array(csf)
+        self.assertEqual(d[1]['site'], 1)
+        self.assertAlmostEqual(d[1]['octahedral CN_6'], 1)
+        self.assertEqual(site_descriptors_to_array(d)['labels'],
+                         csf['labels'])
+        self.assertEqual(sd_builder.get_statistics({'csf': d}),
+                         doc['statistics'])
+
 
 if __name__ == "__main__":
     unittest.main()
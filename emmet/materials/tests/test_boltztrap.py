@@ -0,0 +1,83 @@
+import json
+import os
+import unittest
+import zlib
+from unittest.mock import patch
+
+import numpy as np
+from maggma.stores import MemoryStore
+from pymatgen.electronic_structure.bandstructure import BandStructure
+from pymatgen.electronic_structure.core import Spin
+
+from emmet.common.tests.test_prefetch import MemoryGridFS
+from emmet.materials.boltztrap import BoltztrapBuilder, BoltztrapDosBuilder, get_materials_with_uniform_bs
+
+module_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)))
+boltztrap4dos_mat = os.path.join(module_dir, "..", "..", "..", "test_files", "boltztrap4dos_mat.json")
+boltztrap4dos_bs = os.path.join(module_dir, "..", "..", "..", "test_files", "boltztrap4dos_bs.json")
+
+
+class TestBoltztrapBuilders(unittest.TestCase):
+    def setUp(self):
+        with open(boltztrap4dos_mat) as f:
+            mat = json.load(f)
+        with open(boltztrap4dos_bs) as f:
+            self.bs_dict = json.load(f)
+
+        # The uniform band structure is streamed from a zlib compressed GridFS file
+        self.bfs = MemoryGridFS()
+        oid = self.bfs.put(zlib.compress(json.dumps(self.bs_dict).encode()))
+
+        self.materials = MemoryStore("materials")
+        self.materials.connect()
+        self.materials.update([{
+            "task_id": mat["task_id"],
+            "structure": mat["structure"],
+            "input": {"parameters": {"NELECT": 32}},
+            "bandstructure": {"uniform_bs_oid": oid, "uniform_bs_compression": "zlib"}
+        }])
+        self.mat_id = mat["task_id"]
+        self.structure = mat["structure"]
+        self.boltztrap = MemoryStore("boltztrap")
+
+    def get_streamed_item(self):
+        items = list(get_materials_with_uniform_bs(self.materials, [self.mat_id], self.bfs, num_threads=2))
+        self.assertEqual(len(items), 1)
+        # Eigenvalues are streamed into arrays, also when stored as serialized numpy arrays
+        bands = items[0]["bandstructure"]["uniform_bs"]["bands"]["1"]
+        self.assertIsInstance(bands["data"] if isinstance(bands, dict) else bands, np.ndarray)
+        return items[0]
+
+    def check_bs(self, bs):
+        self.bs_dict["structure"] = self.structure
+        expected = BandStructure.from_dict(self.bs_dict)
+        self.assertEqual(bs.structure, expected.structure)
+        self.assertEqual(bs.efermi, expected.efermi)
+        np.testing.assert_array_equal(bs.bands[Spin.up], expected.bands[Spin.up])
+        np.testing.assert_array_equal(bs.projections[Spin.up], expected.projections[Spin.up])
+        np.testing.assert_array_equal([k.frac_coords for k in bs.kpoints],
+                                      [k.frac_coords for k in expected.kpoints])
+
+    @patch("emmet.materials.boltztrap.BoltztrapAnalyzer")
+    @patch("emmet.materials.boltztrap.BoltztrapRunner")
+    def test_process_item(self, runner, analyzer):
+        builder = BoltztrapBuilder(self.materials, self.boltztrap)
+        doc = builder.process_item(self.get_streamed_item())
+
+        self.assertIn("boltztrap", doc)
+        self.assertEqual(runner.call_args[1]["nelec"], 32)
+        self.check_bs(runner.call_args[1]["bs"])
+
+    @patch("emmet.materials.boltztrap.BoltztrapAnalyzer")
+    @patch("emmet.materials.boltztrap.BoltztrapRunner")
+    def test_process_item_dos(self, runner, analyzer):
+        builder = BoltztrapDosBuilder(self.materials, self.boltztrap)
+        doc = builder.process_item(self.get_streamed_item())
+
+        self.assertIn("cdos", doc)
+        self.assertEqual(runner.call_args[1]["run_type"], "DOS")
+        self.check_bs(runner.call_args[1]["bs"])
+
+
+if __name__ == "__main__":
+    unittest.main()
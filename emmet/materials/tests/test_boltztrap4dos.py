@@ -23,6 +23,21 @@ class TestBoltztrap4DosBuilder(unittest.TestCase):
         self.dos = MemoryStore("dos")
         self.dos.connect()
 
+    def test_get_items(self):
+        materials = MemoryStore("materials")
+        materials.connect()
+        mat = self.materials.query_one()
+        mat["bandstructure"] = {"uniform_task": "mp-663338"}
+        materials.update([mat, {"task_id": "mp-1", "structure": mat["structure"]}])
+
+        dosbuilder = Boltztrap4DosBuilder(materials, self.bandstructure, self.dos, num_threads=2)
+        items = {item["task_id"]: item for item in dosbuilder.get_items()}
+
+        self.assertEqual(set(items.keys()), {"mp-12103", "mp-1"})
+        self.assertEqual(items["mp-12103"]["bandstructure_uniform"]["task_id"], "mp-663338")
+        self.assertNotIn("bandstructure_uniform", items["mp-1"])
+        self.assertNotIn("band_structure_uniform", items["mp-12103"])
+
     @unittest.skipIf("TRAVIS" in os.environ and os.environ["TRAVIS"] == "true", "Skipping this test on Travis CI.")
     def test_process_items(self):
         dosbuilder = Boltztrap4DosBuilder(self.materials, self.bandstructure, self.dos, avoid_projections=True)
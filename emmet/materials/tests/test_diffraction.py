@@ -1,10 +1,19 @@
+import os
+import tempfile
+
+import numpy as np
 from maggma.stores import MongoStore
+from monty.serialization import dumpfn
 from pymatgen.util.testing import PymatgenTest
 import unittest
 from unittest import TestCase
+from unittest.mock import patch
 from uuid import uuid4
 
-from emmet.materials.diffraction import DiffractionBuilder
+from pymatgen.analysis.diffraction.xrd import XRDCalculator
+
+from emmet.common.compact import is_packed_array, unpack_doc
+from emmet.materials.diffraction import DiffractionBuilder, MultiWavelengthXRDCalculator
 
 
 class TestDiffractionBuilder(TestCase):
@@ -39,6 +48,40 @@ class TestDiffractionBuilder(TestCase):
         structure = PymatgenTest.get_structure("Si")
         self.assertIn("Cu", builder.get_xrd_from_struct(structure))
 
+    def test_compact(self):
+        structure = PymatgenTest.get_structure("Si")
+        doc = DiffractionBuilder(self.source, self.target).get_xrd_from_struct(structure)
+        compact = DiffractionBuilder(self.source, self.target, compact=True).get_xrd_from_struct(structure)
+        self.assertTrue(is_packed_array(compact["Cu"]["pattern"]["x"]))
+        unpacked = unpack_doc(compact)
+        for el in doc:
+            np.testing.assert_allclose(unpacked[el]["pattern"]["y"], doc[el]["pattern"]["y"], rtol=1e-6)
+            self.assertEqual(unpacked[el]["pattern"]["hkls"], doc[el]["pattern"]["hkls"])
+
+    def test_multi_wavelength(self):
+        structure = PymatgenTest.get_structure("LiFePO4")
+        calc = MultiWavelengthXRDCalculator(structure, {"CuKa": 180, "MoKa": 45}, symprec=0.1)
+        for wavelength, two_theta in [("CuKa", (0, 180)), ("MoKa", (0, 45)), ("CuKa", (10, 60))]:
+            expected = XRDCalculator(wavelength=wavelength, symprec=0.1).get_pattern(
+                structure, two_theta_range=two_theta)
+            pattern = calc.get_pattern(wavelength, two_theta_range=two_theta)
+            np.testing.assert_allclose(pattern.x, expected.x)
+            np.testing.assert_allclose(pattern.y, expected.y, atol=1e-6)
+            self.assertEqual(pattern.hkls, expected.hkls)
+
+    def test_repeated_wavelength(self):
+        settings = [{"target": "Cu", "edge": "Ka", "two_theta": [0, 120]},
+                    {"target": "Cu", "edge": "Ka", "two_theta": [0, 60]}]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            xrd_settings = os.path.join(tmpdir, "xrd.json")
+            dumpfn(settings, xrd_settings)
+            builder = DiffractionBuilder(self.source, self.target, xrd_settings=xrd_settings)
+        with patch("emmet.materials.diffraction.MultiWavelengthXRDCalculator",
+                   wraps=MultiWavelengthXRDCalculator) as calc:
+            builder.get_xrd_from_struct(PymatgenTest.get_structure("Si"))
+        # Reciprocal lattice points are computed up to the largest 2-theta of the wavelength
+        self.assertEqual(calc.call_args[0][1], {"CuKa": 120})
+
     def test_serialization(self):
         builder = DiffractionBuilder(self.source, self.target)
         self.assertIsNone(builder.as_dict()["xrd_settings"])
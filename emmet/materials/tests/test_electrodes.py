@@ -0,0 +1,90 @@
+import unittest
+from unittest.mock import patch
+
+from maggma.stores import MemoryStore
+from pymatgen import Structure, Lattice
+from pymatgen.entries.compatibility import Compatibility
+from pymatgen.entries.computed_entries import ComputedStructureEntry
+
+from emmet.materials.electrodes import ElectrodesBuilder
+
+
+class TestElectrodesBuilder(unittest.TestCase):
+    def setUp(self):
+        self.builder = ElectrodesBuilder(MemoryStore("materials"), MemoryStore("electrodes"), "Li")
+
+        # Delithiated hosts of the same composition and number of sites,
+        # in two families of lattice shapes and a single odd one
+        self.entries = []
+        for i, c_over_a in enumerate([1.0, 2.0, 1.04, 3.0, 2.06, 1.08, 2.1]):
+            host = Structure(Lattice.tetragonal(4.0, 4.0 * c_over_a), ["Mn", "O", "O"],
+                             [[0, 0, 0], [0.3, 0.3, 0.25], [0.7, 0.7, 0.75]])
+            entry = ComputedStructureEntry(host, 0, entry_id="mp-{}".format(i))
+            entry.data["structure_delith"] = host
+            self.entries.append(entry)
+
+    def group_entries(self):
+        with patch.object(self.builder.sm, "fit", wraps=self.builder.sm.fit) as fit:
+            groups = [sorted(en.entry_id for en in g) for g in self.builder.group_entries(self.entries)]
+        return sorted(groups), fit.call_count
+
+    def test_group_entries(self):
+        groups, n_fit = self.group_entries()
+        self.assertEqual(groups, [["mp-0", "mp-2", "mp-5"], ["mp-1", "mp-4", "mp-6"]])
+
+        # The same groups with fewer structure matcher calls than without
+        # comparing the lattices first
+        with patch.object(ElectrodesBuilder, "may_fit", return_value=True):
+            all_groups, n_fit_all = self.group_entries()
+        self.assertEqual(groups, all_groups)
+        self.assertLess(n_fit, n_fit_all)
+
+    def test_get_pd_entries(self):
+        materials = MemoryStore("materials")
+        materials.connect()
+        materials.update([{
+            "task_id": "mp-{}".format(i), "chemsys": "-".join(sorted(els)), "deprecated": False,
+            "structure": Structure(Lattice.cubic(3 + i), els, [[0.5 * j] * 3 for j in range(len(els))]).as_dict(),
+            "thermo": {"energy": -1.0}, "calc_settings": {}
+        } for i, els in enumerate([["Li"], ["Fe"], ["O"], ["Fe", "O"], ["Li", "O"], ["Li", "Fe", "O"],
+                                   ["Mn"], ["Li", "Mn"]])])
+
+        builder = ElectrodesBuilder(materials, MemoryStore("electrodes"), "Li",
+                                    compatibility=Compatibility([]), entries_cache_size=4)
+        with patch.object(materials, "query", wraps=materials.query) as query:
+            entries = builder.get_pd_entries("Fe-Li-O")
+            self.assertEqual(sorted(en.entry_id for en in entries), ["mp-{}".format(i) for i in range(6)])
+            self.assertEqual(query.call_count, 1)
+            self.assertEqual(len(builder.entries_cache), 4)
+
+            # Subsystems still cached are not queried again
+            missing = {"Li", "Mn", "Li-Mn"} - set(builder.entries_cache)
+            entries = builder.get_pd_entries("Li-Mn")
+            self.assertEqual(sorted(en.entry_id for en in entries), ["mp-0", "mp-6", "mp-7"])
+            self.assertEqual(query.call_count, 2)
+            self.assertEqual(set(query.call_args[1]["criteria"]["chemsys"]["$in"]), missing)
+            self.assertEqual(len(builder.entries_cache), 4)
+
+            entries = builder.get_pd_entries("Fe-Li-O")
+            self.assertEqual(sorted(en.entry_id for en in entries), ["mp-{}".format(i) for i in range(6)])
+
+    def test_may_fit(self):
+        sm = self.builder.sm
+        hosts = [en.data["structure_delith"] for en in self.entries]
+        for s1 in hosts:
+            for s2 in hosts:
+                if sm.fit(s1, s2):
+                    self.assertTrue(self.builder.may_fit(self.builder.lattice_minima(s1),
+                                                         self.builder.lattice_minima(s2)))
+
+        # Rescaled volumes and other cell choices of the same lattice
+        s = self.entries[1].data["structure_delith"]
+        scaled = s.copy()
+        scaled.scale_lattice(s.volume * 1.3)
+        scaled.make_supercell([[1, 1, 0], [0, 1, 0], [0, 0, 1]])
+        self.assertTrue(sm.fit(s, scaled))
+        self.assertTrue(self.builder.may_fit(self.builder.lattice_minima(s), self.builder.lattice_minima(scaled)))
+
+
+if __name__ == "__main__":
+    unittest.main()
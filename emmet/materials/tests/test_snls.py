@@ -0,0 +1,69 @@
+import unittest
+from unittest.mock import patch
+
+from pybtex.database import parse_string, BibliographyData
+
+from emmet.materials import snls as snls_module
+from emmet.common.utils import LRUCache
+from emmet.materials.snls import aggregate_snls, mp_default_snl_fields
+
+ICSD_REF = "@article{Smith1999,\nauthor = {Smith, John},\ntitle = {{A structure}},\nyear = {1999}\n}"
+OTHER_REF = "@misc{Doe2005,\ntitle = {{Another structure}},\nyear = {2005}\n}\n\n" + ICSD_REF
+
+
+def make_snl(references, created_at):
+    return {
+        "about": {
+            "created_at": {"string": created_at},
+            "history": [{"name": "ICSD", "url": "", "description": {"id": 1}}],
+            "references": references,
+            "remarks": [],
+            "projects": [],
+            "authors": [{"name": "John Smith", "email": "john@smith.org"}]
+        }
+    }
+
+
+def reference_merge(snls):
+    """
+    Merges the references as aggregate_snls did without caching, in sorted key order
+    """
+    refs = {}
+    for snl in snls:
+        try:
+            refs.update(parse_string(snl["about"]["references"], bib_format="bibtex").entries)
+        except Exception:
+            pass
+    return BibliographyData(entries=sorted(refs.items())).to_string("bibtex")
+
+
+class TestAggregateSNLs(unittest.TestCase):
+    def setUp(self):
+        self.snls = [
+            make_snl(ICSD_REF, "2018-01-01"),
+            make_snl(OTHER_REF, "2017-01-01"),
+            make_snl(mp_default_snl_fields["references"], "2019-01-01"),
+            make_snl("@article{broken", "2019-01-01")
+        ]
+
+    def test_references(self):
+        expected = reference_merge(self.snls)
+        for parsed, merged in [(LRUCache(100), LRUCache(100)), (LRUCache(1), LRUCache(1))]:
+            with patch.object(snls_module, "_parsed_references", parsed), \
+                    patch.object(snls_module, "_merged_references", merged):
+                # Uncached, then served from the caches
+                self.assertEqual(aggregate_snls(self.snls)["references"], expected)
+                self.assertEqual(aggregate_snls(self.snls)["references"], expected)
+                self.assertEqual(aggregate_snls(self.snls[::-1])["references"], expected)
+
+                self.assertEqual(aggregate_snls(self.snls[:1])["references"], reference_merge(self.snls[:1]))
+                self.assertEqual(aggregate_snls(self.snls)["references"], expected)
+                self.assertLessEqual(len(parsed), parsed.maxsize)
+                self.assertLessEqual(len(merged), merged.maxsize)
+
+        merged = parse_string(expected, bib_format="bibtex").entries
+        self.assertEqual(list(merged), ["Doe2005", "Jain2013", "MaterialsProject", "Smith1999"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,8 @@
 import unittest
 import os
 
+import numpy as np
+
 from emmet.materials.structure_similarity import *
 from maggma.stores import MemoryStore, JSONStore
 
@@ -72,6 +74,151 @@ class StructureSimilarityBuilderTest(unittest.TestCase):
         self.assertAlmostEqual(d['cos'], 0.0012729)
         self.assertAlmostEqual(d['dist'], 2.7235044)
 
+    def test_matrix_method(self):
+        test_structure_similarity = MemoryStore("struct_sim")
+        test_structure_similarity.connect()
+        sim_builder = StructureSimilarityBuilder(self.test_site_descriptors,
+                                                 test_structure_similarity,
+                                                 fp_type='opsf')
+        matrix_builder = StructureSimilarityBuilder(self.test_site_descriptors,
+                                                    test_structure_similarity,
+                                                    fp_type='opsf',
+                                                    method='matrix',
+                                                    block_size=2)
+
+        items = list(matrix_builder.get_items())
+        self.assertEqual(len(items), 3)
+        docs = [d for i in items for d in matrix_builder.process_item(i)]
+        self.assertEqual(len(docs), 3)
+        for i in sim_builder.get_items():
+            expected = sim_builder.process_item(i)
+            d = [d for d in docs if d['task_id'] == expected['task_id']][0]
+            self.assertAlmostEqual(d['cos'], expected['cos'])
+            self.assertAlmostEqual(d['dist'], expected['dist'])
+
+        matrix_builder.update_targets(items=[docs[:1], docs[1:]])
+        self.assertEqual(len(list(test_structure_similarity.query())), 3)
+
+    def test_topk_method(self):
+        test_structure_similarity = MemoryStore("struct_sim")
+        test_structure_similarity.connect()
+        sim_builder = StructureSimilarityBuilder(self.test_site_descriptors,
+                                                 test_structure_similarity,
+                                                 fp_type='opsf',
+                                                 method='topk', k=1,
+                                                 block_size=2)
+
+        items = list(sim_builder.get_items())
+        self.assertEqual(len(items), 2)
+        processed = [sim_builder.process_item(i) for i in items]
+        sim_builder.update_targets(processed)
+
+        # Items only carry material keys; a builder that did not run
+        # get_items (as in a worker process) builds its own index
+        self.assertEqual(sorted(k for i in items for k in i[0]),
+                         ['mp-13', 'mp-22862', 'mp-66'])
+        worker = StructureSimilarityBuilder(self.test_site_descriptors,
+                                            test_structure_similarity,
+                                            fp_type='opsf',
+                                            method='topk', k=1,
+                                            block_size=2)
+        self.assertEqual([worker.process_item(i) for i in items], processed)
+
+        docs = {d['task_id']: d for d in test_structure_similarity.query()}
+        self.assertEqual(len(docs), 3)
+        self.assertEqual(len(docs['mp-66']['neighbors']), 1)
+        self.assertEqual(docs['mp-66']['neighbors'][0]['task_id'], 'mp-22862')
+        self.assertAlmostEqual(docs['mp-66']['neighbors'][0]['cos'], 0.0013649)
+        self.assertEqual(docs['mp-13']['neighbors'][0]['task_id'], 'mp-66')
+
+        index = sim_builder.get_index()
+        nn = index.query('mp-22862', k=5)
+        self.assertEqual([d['task_id'] for d in nn], ['mp-66', 'mp-13'])
+        self.assertAlmostEqual(nn[1]['dist'], 2.7235044)
+        Fe = self.test_site_descriptors.query_one(criteria={"task_id": "mp-13"})
+        nn = index.query(Fe, k=1)
+        self.assertEqual(nn[0]['task_id'], 'mp-13')
+        self.assertAlmostEqual(nn[0]['cos'], 1)
+
+    def test_incremental_topk(self):
+        site_descriptors = MemoryStore("site_descr_incr")
+        site_descriptors.connect()
+        docs = list(self.test_site_descriptors.query(
+            criteria={"task_id": {"$in": ["mp-66", "mp-22862"]}}))
+        for d in docs:
+            d.pop("_id", None)
+        site_descriptors.update(docs)
+        test_structure_similarity = MemoryStore("struct_sim")
+        test_structure_similarity.connect()
+        sim_builder = StructureSimilarityBuilder(site_descriptors,
+                                                 test_structure_similarity,
+                                                 fp_type='opsf',
+                                                 method='topk', k=1,
+                                                 incremental=True)
+        sim_builder.run()
+        docs = {d['task_id']: d for d in test_structure_similarity.query()}
+        self.assertEqual(docs['mp-66']['neighbors'][0]['task_id'], 'mp-22862')
+        self.assertEqual(docs['mp-22862']['neighbors'][0]['task_id'], 'mp-66')
+
+        Fe = self.test_site_descriptors.query_one(criteria={"task_id": "mp-13"})
+        Fe.pop("_id", None)
+        site_descriptors.update([Fe])
+        items = list(sim_builder.get_items())
+        # Fe is searched from scratch, C and NaCl only against Fe
+        self.assertEqual([len(i[0]) for i in items], [1, 2])
+        self.assertEqual(items[1][1], ['mp-13'])
+        processed = [sim_builder.process_item(i) for i in items]
+        # Fe is not closer to C or NaCl than their current neighbors
+        self.assertEqual([len(p) for p in processed], [1, 0])
+        sim_builder.update_targets(processed)
+
+        docs = {d['task_id']: d for d in test_structure_similarity.query()}
+        self.assertEqual(len(docs), 3)
+        self.assertEqual(docs['mp-13']['neighbors'][0]['task_id'], 'mp-66')
+        self.assertEqual(len(list(sim_builder.get_items())), 0)
+
+        # Removed materials lose their neighbor documents and are replaced
+        # in the neighbors of others
+        site_descriptors.collection.delete_one({"task_id": "mp-22862"})
+        sim_builder.run()
+        docs = {d['task_id']: d for d in test_structure_similarity.query()}
+        self.assertEqual(sorted(docs), ['mp-13', 'mp-66'])
+        self.assertEqual(docs['mp-66']['neighbors'][0]['task_id'], 'mp-13')
+
+        site_descriptors.collection.delete_one({"task_id": "mp-13"})
+        self.assertEqual(len(list(sim_builder.get_items())), 1)
+        site_descriptors.collection.delete_one({"task_id": "mp-66"})
+        sim_builder.run()
+        self.assertEqual(len(list(test_structure_similarity.query())), 0)
+
+
+class StructureSimilarityFunctionsTest(unittest.TestCase):
+    def test_align_statistics_vector(self):
+        index = {'a mean': 0, 'b mean': 1, 'c mean': 2}
+        row = align_statistics_vector(['c mean', 'a mean', 'b mean'],
+                                      [3., 1., 2.], index)
+        self.assertEqual(list(row), [1., 2., 3.])
+        # Same number of entries, but a duplicate label in place of another
+        with self.assertRaises(RuntimeError):
+            align_statistics_vector(['a mean', 'a mean', 'b mean'],
+                                    [1., 1., 2.], index)
+        with self.assertRaises(RuntimeError):
+            align_statistics_vector(['a mean', 'b mean'], [1., 2.], index)
+
+    def test_block_similarities(self):
+        rng = np.random.RandomState(0)
+        mat = 1e3 + rng.rand(20, 30)
+        cos, dist = block_similarities(mat, mat)
+        self.assertTrue(np.all(np.diag(dist) == 0))
+        self.assertTrue(np.all(cos <= 1))
+        expected = np.linalg.norm(mat[:, None, :] - mat[None, :, :], axis=2)
+        np.testing.assert_allclose(dist, expected, rtol=1e-6)
+        # Nearly identical vectors keep their small distance
+        shifted = mat + 1e-6
+        cos, dist = block_similarities(mat, shifted)
+        np.testing.assert_allclose(np.diag(dist), np.sqrt(30) * 1e-6,
+                                   rtol=1e-3)
+
 
 if __name__ == "__main__":
     unittest.main()
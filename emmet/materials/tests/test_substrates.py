@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import unittest
+from operator import itemgetter
+from unittest.mock import patch
+
+from maggma.stores import MemoryStore
+from monty.serialization import dumpfn
+from pymatgen import Structure, Lattice
+from pymatgen.analysis.elasticity.elastic import ElasticTensor
+from pymatgen.analysis.substrate_analyzer import SubstrateAnalyzer
+
+from emmet.materials.substrates import SubstrateBuilder, groupby_itemkey
+
+
+class TestSubstrateBuilder(unittest.TestCase):
+    def setUp(self):
+        self.materials = MemoryStore("materials")
+        self.elasticity = MemoryStore("elasticity")
+        self.substrates = MemoryStore("substrates", key="task_id")
+
+        self.film = Structure.from_spacegroup("Fm-3m", Lattice.cubic(4.05), ["Al"], [[0, 0, 0]])
+        self.substrate = Structure.from_spacegroup("Fm-3m", Lattice.cubic(4.21), ["Mg", "O"],
+                                                   [[0, 0, 0], [0.5, 0.5, 0.5]])
+        self.tmpdir = tempfile.mkdtemp()
+        self.substrates_file = os.path.join(self.tmpdir, "substrates.json")
+        dumpfn([{"name": "Magnesium Oxide", "task_id": "mp-1265", "structure": self.substrate}], self.substrates_file)
+
+        # Elastic constants of aluminium in GPa
+        c11, c12, c44 = 108, 62, 28
+        self.voigt = [[c11, c12, c12, 0, 0, 0], [c12, c11, c12, 0, 0, 0], [c12, c12, c11, 0, 0, 0],
+                      [0, 0, 0, c44, 0, 0], [0, 0, 0, 0, c44, 0], [0, 0, 0, 0, 0, c44]]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_reference(self, elastic_tensor=None):
+        # Lowest area match for each substrate orientation as the analyzer finds it
+        sa = SubstrateAnalyzer()
+        matches = sa.calculate(self.film, self.substrate, elastic_tensor, lowest=True)
+        lowest = [min(g, key=itemgetter("match_area")) for k, g in groupby_itemkey(matches, "sub_miller")]
+        return sorted((" ".join(map(str, m["sub_miller"])), " ".join(map(str, m["film_miller"])),
+                       m["match_area"], m.get("elastic_energy")) for m in lowest)
+
+    def check_matches(self, doc, reference):
+        matches = sorted((m["orient"], m["film_orient"], m["area"], m.get("energy")) for m in doc["substrates"])
+        self.assertEqual(len(matches), len(reference))
+        for match, ref in zip(matches, reference):
+            self.assertEqual(match[:2], ref[:2])
+            self.assertAlmostEqual(match[2], ref[2])
+            if ref[3] is None:
+                self.assertIsNone(match[3])
+            else:
+                self.assertAlmostEqual(match[3], ref[3])
+
+    def test_process_item(self):
+        builder = SubstrateBuilder(self.materials, self.substrates, self.elasticity,
+                                   substrates_file=self.substrates_file)
+
+        doc = builder.process_item({"task_id": "mp-28", "structure": self.film.as_dict()})
+        self.assertEqual(doc["task_id"], "mp-28")
+        self.assertTrue(all(m["sub_id"] == "mp-1265" and m["sub_form"] == "MgO" for m in doc["substrates"]))
+        self.check_matches(doc, self.get_reference())
+
+        doc = builder.process_item({"task_id": "mp-28", "structure": self.film.as_dict(),
+                                    "elastic_tensor": self.voigt})
+        self.check_matches(doc, self.get_reference(ElasticTensor.from_voigt(self.voigt)))
+        self.assertEqual([m["energy"] for m in doc["substrates"]],
+                         sorted(m["energy"] for m in doc["substrates"]))
+
+    def test_process_item_pool(self):
+        builder = SubstrateBuilder(self.materials, self.substrates, self.elasticity,
+                                   substrates_file=self.substrates_file, num_workers=2)
+        try:
+            doc = builder.process_item({"task_id": "mp-28", "structure": self.film.as_dict(),
+                                        "elastic_tensor": self.voigt})
+            self.check_matches(doc, self.get_reference(ElasticTensor.from_voigt(self.voigt)))
+            self.assertIsNotNone(builder._pool)
+
+            # A failing item shuts down the workers
+            pool = builder._pool
+            with patch.object(pool, "map", side_effect=RuntimeError("worker died")):
+                with self.assertRaises(RuntimeError):
+                    builder.process_item({"task_id": "mp-28", "structure": self.film.as_dict()})
+            self.assertIsNone(builder._pool)
+            with self.assertRaises(ValueError):
+                pool.apply(len, ([], ))
+        finally:
+            builder.close_pool(terminate=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
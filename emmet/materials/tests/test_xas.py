@@ -0,0 +1,70 @@
+import unittest
+
+import numpy as np
+from pymatgen import Structure, Lattice
+
+from emmet.materials.xas import msonify_xas, load_xanes, compact_xanes, get_structure_ref, \
+    site_weighted_spectrum, data_missing
+
+
+class TestCompactXANES(unittest.TestCase):
+    def setUp(self):
+        self.structure = Structure.from_spacegroup("Fm-3m", Lattice.cubic(5.6), ["Na", "Cl"],
+                                                   [[0, 0, 0], [0.5, 0.5, 0.5]])
+        energy = np.linspace(1070, 1100, 100)
+        self.calcs = []
+        for i, site in enumerate(self.structure):
+            if site.species_string == "Na":
+                self.calcs.append({
+                    "xas_id": "xas-{}".format(i), "mp_id": "mp-22862", "absorbing_atom": i,
+                    "structure": self.structure.as_dict(),
+                    "spectrum": [[e, 0, 0, np.exp(-(e - 1080 - i) ** 2 / 10)] for e in energy]
+                })
+
+    def test_site_spectra(self):
+        for calc in self.calcs:
+            full = msonify_xas(calc)
+            compact = msonify_xas(calc, structure_ref=calc["xas_id"])
+            self.assertEqual(compact["mid_and_el"], "mp-22862,Na")
+            self.assertEqual(compact["spectrum"]["structure_ref"], calc["xas_id"])
+            self.assertNotIn("structure", compact["spectrum"])
+
+            expected = load_xanes(full["spectrum"])
+            spectrum = load_xanes(compact["spectrum"], calc["structure"])
+            self.assertEqual(spectrum.structure, expected.structure)
+            self.assertEqual(spectrum.structure.site_properties["absorbing_atom"],
+                             expected.structure.site_properties["absorbing_atom"])
+            np.testing.assert_allclose(spectrum.x, expected.x, rtol=1e-6)
+            np.testing.assert_allclose(spectrum.y, expected.y, rtol=1e-6)
+
+    def test_structure_mismatch(self):
+        compact = msonify_xas(self.calcs[-1], structure_ref="xas-3")["spectrum"]
+        with self.assertRaises(ValueError):
+            load_xanes(compact)
+
+        # A different cell or site order of the same material is rejected
+        with self.assertRaises(ValueError):
+            load_xanes(compact, self.structure.get_primitive_structure())
+        reordered = Structure.from_sites(sorted(self.structure, key=lambda s: s.species_string))
+        with self.assertRaises(ValueError):
+            load_xanes(compact, reordered)
+
+    def test_averaged_spectrum(self):
+        docs = [msonify_xas(calc, structure_ref=calc["xas_id"]) for calc in self.calcs]
+        ref = get_structure_ref(docs)
+        self.assertEqual(ref, "xas-0")
+        self.assertFalse(data_missing(docs, self.structure))
+
+        expected = site_weighted_spectrum([msonify_xas(calc) for calc in self.calcs])
+        spectrum = site_weighted_spectrum(docs, structure=self.structure)
+        self.assertEqual(spectrum.structure.site_properties["absorbing_atom"],
+                         expected.structure.site_properties["absorbing_atom"])
+        np.testing.assert_allclose(spectrum.y, expected.y, atol=1e-4)
+
+        averaged = load_xanes(compact_xanes(spectrum, ref), self.structure)
+        self.assertEqual(averaged.structure.site_properties["absorbing_atom"],
+                         [site.species_string == "Na" for site in self.structure])
+
+
+if __name__ == "__main__":
+    unittest.main()
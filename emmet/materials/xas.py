@@ -1,4 +1,7 @@
 import os
+from itertools import groupby
+from operator import itemgetter
+
 import numpy as np
 from monty.serialization import loadfn
 from pydash import py_
@@ -7,7 +10,11 @@ from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 from pymatgen.analysis.xas.spectrum import XANES
 
 from maggma.builders import MapBuilder, GroupBuilder
-from scipy.interpolate import interp1d
+from maggma.utils import grouper
+from scipy.interpolate import make_interp_spline
+
+from emmet.common.compact import pack_fields, unpack_doc
+from emmet.common.prefetch import query_by_field
 
 # Mapping from MP task ids / deprecated material ids to current material ids
 # Most XAS calculations were done with reference to a past material id.
@@ -15,24 +22,43 @@ tid_mid = loadfn(os.path.join(
     os.path.dirname(os.path.abspath(__file__)), "settings", "tid_mid.json"))
 
 
+def get_material_id(mp_id):
+    """
+    Current material id for the id of an XAS calculation, or the id itself
+    if it is not in the tid_mid mapping.
+    """
+    return tid_mid.get(mp_id, mp_id)
+
+
 class XASBuilder(MapBuilder):
-    def __init__(self, calcs, xas, **kwargs):
+    def __init__(self, calcs, xas, compact=False, **kwargs):
         """MSONable site-specific spectra from calculations.
 
         Args:
             calcs (Store): XAS calculations with raw output
             xas (Store): output serialized pymatgen XANES objects
+            compact (bool): store spectra in compact form (see compact_xanes),
+                with the structure referenced by the key of the calculation
         """
         self.calcs = calcs
         self.xas = xas
+        self.compact = compact
         super().__init__(source=calcs, target=xas, **kwargs)
 
-    @staticmethod
-    def ufn(item):
-        return msonify_xas(item)
+    def ufn(self, item):
+        structure_ref = item[self.calcs.key] if self.compact else None
+        return msonify_xas(item, structure_ref=structure_ref)
 
 
-def msonify_xas(item):
+def msonify_xas(item, structure_ref=None):
+    """
+    Site spectrum doc for an XAS calculation.
+
+    Args:
+        item (dict): XAS calculation doc
+        structure_ref: key of the calculation doc, if the spectrum is to be
+            stored in compact form (see compact_xanes)
+    """
     energy = py_.pluck(item['spectrum'], 0) # (eV)
     intensity = py_.pluck(item['spectrum'], 3) # (mu)
     structure = Structure.from_dict(item['structure'])
@@ -48,11 +74,13 @@ def msonify_xas(item):
         return {"spectrum": None, "mid_and_el": mid_and_el,
                 "error": "Empty spectrum"}
     try:
+        spectrum = XANES(
+            x=energy, y=intensity, structure=structure,
+            absorption_specie=absorption_specie, edge=edge,
+        )
         out = {
-            "spectrum": XANES(
-                x=energy, y=intensity, structure=structure,
-                absorption_specie=absorption_specie, edge=edge,
-            ).as_dict(),
+            "spectrum": (compact_xanes(spectrum, structure_ref) if structure_ref is not None
+                         else spectrum.as_dict()),
             "mid_and_el": mid_and_el,
         }
     except ValueError as e:
@@ -61,10 +89,25 @@ def msonify_xas(item):
 
 
 class XASAverager(GroupBuilder):
-    def __init__(self, spectra_site, spectra_avg, **kwargs):
+    def __init__(self, spectra_site, spectra_avg, calcs=None,
+                 compact=False, **kwargs):
+        """Equivalent-site-weighted spectra per material and element.
+
+        Args:
+            spectra_site (Store): site-specific spectra from XASBuilder
+            spectra_avg (Store): output averaged spectra
+            calcs (Store): XAS calculations whose structures compact site
+                spectra reference by their key
+            compact (bool): store averaged spectra in compact form,
+                referencing the same calculation as the site spectra
+        """
         self.spectra_site = spectra_site
         self.spectra_avg = spectra_avg
+        self.calcs = calcs
+        self.compact = compact
         super().__init__(source=spectra_site, target=spectra_avg, **kwargs)
+        if calcs is not None:
+            self.sources.append(calcs)
         self.n_items_per_group = 1
 
     @staticmethod
@@ -75,56 +118,224 @@ class XASAverager(GroupBuilder):
     def docs_to_groups(docs):
         return {d["mid_and_el"] for d in docs}
 
+    def get_items(self):
+        """
+        Gets groups of site spectra with updated docs.
+
+        Instead of one query per group, the spectra of up to chunk_size
+        groups are fetched with one cursor sorted by mid_and_el, and the
+        structures they reference with one query.
+        """
+        groups = sorted(self.get_updated_groups())
+        self.total = len(groups)
+        self.logger.info("Averaging spectra of {} groups".format(self.total))
+
+        for chunk in grouper(groups, self.chunk_size):
+            chunk = [g for g in chunk if g is not None]
+            docs = self.source.query(criteria={"mid_and_el": {"$in": chunk}},
+                                     sort=[("mid_and_el", 1)])
+            chunk_docs = [list(group_docs) for _, group_docs in
+                          groupby(docs, key=itemgetter("mid_and_el"))]
+            structures = self.get_structures(chunk_docs)
+            for group_docs in chunk_docs:
+                yield self.docs_to_item(group_docs, structures)
+
+    def get_updated_groups(self):
+        """
+        Groups with a site spectrum newer than the corresponding averaged
+        spectrum, found in a single pass over the source.
+        """
+        target_dates = {
+            d[self.target.key]: self.target.lu_func[0](d[self.target.lu_field])
+            for d in self.target.query(
+                properties={self.target.key: 1, self.target.lu_field: 1, "_id": 0})}
+
+        groups = set()
+        props = {self.source.key: 1, self.source.lu_field: 1,
+                 "mid_and_el": 1, "_id": 0}
+        for d in self.source.query(criteria=self.query, properties=props):
+            key = d[self.source.key]
+            lu = self.source.lu_func[0](d[self.source.lu_field])
+            if key not in target_dates or lu > target_dates[key]:
+                groups.add(d["mid_and_el"])
+        return groups
+
     def group_to_items(self, group):
         # XXX a list of docs is the one item yielded by this group.
-        docs = list(self.source.query(criteria={"mid_and_el": group}))
-        key_val = docs[0][self.source.key]
-        lu_field_val = max(d[self.source.lu_field] for d in docs)
+        docs = self.source.query(criteria={"mid_and_el": group})
+        return [self.docs_to_item(docs)]
+
+    def docs_to_item(self, docs, structures=None):
+        """
+        Item for the site spectra docs of a group, with the largest
+        lu_field value of the group computed while collecting them.
+
+        Args:
+            docs (iterable): site spectra docs of the group
+            structures (dict): structures by calculation key, from
+                get_structures; fetched for this group if not given
+        """
+        xas_docs = []
+        lu_field_val = None
+        for d in docs:
+            xas_docs.append(d)
+            if lu_field_val is None or d[self.source.lu_field] > lu_field_val:
+                lu_field_val = d[self.source.lu_field]
+
+        if structures is None:
+            structures = self.get_structures([xas_docs])
 
-        return [{
-            "xas_docs": docs,
-            self.source.key: key_val,
+        return {
+            "xas_docs": xas_docs,
+            "structure": structures.get(get_structure_ref(xas_docs)),
+            self.source.key: xas_docs[0][self.source.key],
             self.source.lu_field: lu_field_val
-        }]
+        }
 
-    @staticmethod
-    def ufn(item):
+    def get_structures(self, groups):
+        """
+        Structures referenced by the compact spectra of groups, fetched
+        with one query.
+
+        Args:
+            groups ([[dict]]): site spectra docs of each group
+
+        Returns:
+            dict: structures by calculation key
+        """
+        refs = {get_structure_ref(xas_docs) for xas_docs in groups} - {None}
+        if not refs:
+            return {}
+        if self.calcs is None:
+            raise ValueError("Compact spectra need the calculations store")
+        docs = query_by_field(self.calcs, self.calcs.key, refs,
+                              properties=["structure"])
+        return {k: d["structure"] for k, d in docs.items()}
+
+    def ufn(self, item):
         xas_docs = item["xas_docs"]
+        structure = item.get("structure")
         mid_and_el = xas_docs[0]["mid_and_el"]
         mp_id, element = xas_docs[0]["mid_and_el"].split(",")
-        msg = data_missing(xas_docs)
+        if mp_id not in tid_mid:
+            self.logger.warning("No current material id for {}".format(mp_id))
+        mp_id = get_material_id(mp_id)
+        symm_sites = get_symm_sites(xas_docs, structure)
+        msg = data_missing(xas_docs, structure, symm_sites=symm_sites)
         if msg:
             out = {
                 "spectrum": None,
                 "mid_and_el": mid_and_el,
                 "error": "Some sites have no spectra recorded: "+str(msg),
                 "valid": False,
-                "mp_id": tid_mid[mp_id],
+                "mp_id": mp_id,
                 "element": element,
             }
         else:
+            spectrum = site_weighted_spectrum(
+                xas_docs, structure=structure, symm_sites=symm_sites)
             out = {
-                "spectrum": site_weighted_spectrum(xas_docs).as_dict(),
+                "spectrum": (compact_xanes(spectrum, get_structure_ref(xas_docs)) if self.compact
+                             else spectrum.as_dict()),
                 "mid_and_el": mid_and_el,
                 "valid": True,
-                "mp_id": tid_mid[mp_id],
+                "mp_id": mp_id,
                 "element": element,
             }
         return out
 
 
-def data_missing(xas_docs):
+def compact_xanes(spectrum, structure_ref):
+    """
+    Compact serialization of a XANES spectrum: energies and intensities are
+    packed as float32 binary and the structure is replaced by a reference,
+    keeping only its number of sites and the indices of the absorbing atoms.
+
+    Args:
+        spectrum (XANES): the spectrum
+        structure_ref: key of the calculation with the structure
+
+    Returns:
+        dict: compact spectrum, readable with load_xanes
+    """
+    d = pack_fields(spectrum.as_dict(), ["x", "y"])
+    absorbing = spectrum.structure.site_properties["absorbing_atom"]
+    d["absorbing_atoms"] = [i for i, yes in enumerate(absorbing) if yes]
+    d["nsites"] = len(spectrum.structure)
+    d["structure_ref"] = structure_ref
+    del d["structure"]
+    return d
+
+
+def get_structure_ref(xas_docs):
+    """
+    Calculation key referenced by the compact spectra of a group, if any.
+    """
+    return next((d["spectrum"]["structure_ref"] for d in xas_docs
+                 if (d.get("spectrum") or {}).get("structure_ref")), None)
+
+
+def load_xanes(d, structure=None):
+    """
+    Reads a XANES spectrum from its regular or compact serialization.
+
+    Args:
+        d (dict): serialized spectrum
+        structure (dict or Structure): the referenced structure; only
+            needed for compact spectra
+
+    Returns:
+        XANES
+    """
+    d = unpack_doc(d)
+    if "structure_ref" in d:
+        structure_ref = d.pop("structure_ref")
+        absorbing_atoms = d.pop("absorbing_atoms")
+        nsites = d.pop("nsites")
+        if structure is None:
+            raise ValueError("Missing structure {}".format(structure_ref))
+        if isinstance(structure, dict):
+            structure = Structure.from_dict(structure)
+        if len(structure) != nsites or any(
+                structure[i].species_string != d["absorption_specie"]
+                for i in absorbing_atoms):
+            raise ValueError("Structure does not match the spectrum of {}".format(structure_ref))
+        structure = structure.copy()
+        structure.add_site_property("absorbing_atom", [
+            i in absorbing_atoms for i, _ in enumerate(structure.sites)])
+        d["structure"] = structure.as_dict()
+    return XANES.from_dict(d)
+
+
+def get_symm_sites(xas_docs, structure=None):
+    """
+    Symmetry analysis of the structure shared by the site spectra of a
+    group, or None if no site has a spectrum.
+    """
+    doc = next((d for d in xas_docs if "error" not in d), None)
+    if doc is None:
+        return None
+    return SymmSites(load_xanes(doc["spectrum"], structure).structure)
+
+
+def data_missing(xas_docs, structure=None, symm_sites=None):
     """
     Do some sites have no spectra recorded?
 
     Checks symmetrically equivalent sites.
+
+    Args:
+        xas_docs (list): site spectra docs of a specie in a structure
+        structure (dict): structure referenced by compact spectra
+        symm_sites (SymmSites): symmetry analysis of the (shared)
+            structure, if already done
     """
     xas_docs = [d for d in xas_docs if "error" not in d]
     if len(xas_docs) == 0:
         return "No docs at all"
-    spectra = [XANES.from_dict(d['spectrum']) for d in xas_docs]
+    spectra = [load_xanes(d['spectrum'], structure) for d in xas_docs]
     absorption_specie = spectra[0].absorption_specie
-    ss = SymmSites(spectra[0].structure)
+    ss = symm_sites or SymmSites(spectra[0].structure)
     absorbing_atoms = set([next(
         i for i, yes in
         enumerate(s.structure.site_properties['absorbing_atom']) if yes)
@@ -149,7 +360,7 @@ class SymmSites:
         symm_data = sa.get_symmetry_dataset()
         # equivalency mapping for the structure
         # i'th site in the input structure equivalent to eq_atoms[i]'th site
-        self.eq_atoms = symm_data["equivalent_atoms"]
+        self.eq_atoms = np.asarray(symm_data["equivalent_atoms"])
 
     def get_equivalent_site_indices(self, i):
         """
@@ -161,7 +372,8 @@ class SymmSites:
         return rv
 
 
-def site_weighted_spectrum(xas_docs, num_samples=200):
+def site_weighted_spectrum(xas_docs, num_samples=200, structure=None,
+                           symm_sites=None):
     """
     Equivalent-site-weighted spectrum for a specie in a structure.
 
@@ -170,50 +382,40 @@ def site_weighted_spectrum(xas_docs, num_samples=200):
             for a specie for a structure.
         num_samples (int): Number of samples for interpolation.
             Original data has 100 data points.
+        structure (dict): structure referenced by compact spectra.
+        symm_sites (SymmSites): symmetry analysis of the (shared)
+            structure, if already done.
 
     Returns:
         tuple: a plottable (x, y) pair for the spectrum
     """
-    maxes, mins = [], []
-    fs = []
-    multiplicities = []
-    absorbing_atoms = set()
+    spectra = [load_xanes(d['spectrum'], structure) for d in xas_docs]
 
-    spectra = [XANES.from_dict(d['spectrum']) for d in xas_docs]
+    # All spectra of a group are for sites of the same structure, so its
+    # symmetry is analyzed only once.
+    ss = symm_sites or SymmSites(spectra[0].structure)
 
+    multiplicities = []
+    absorbing_atoms = set()
     for spectrum in spectra:
-        # Checking the multiplicities of sites
-        structure = spectrum.structure
-        sa = SpacegroupAnalyzer(structure)
-        ss = sa.get_symmetrized_structure()
         absorbing_atom = next(
             i for i, yes in
-            enumerate(structure.site_properties['absorbing_atom']) if yes)
-        multiplicity = len(ss.find_equivalent_sites(structure[absorbing_atom]))
-        multiplicities.append(multiplicity)
-
-        # Getting axis limits for each spectrum for the sites corresponding to
-        # K-edge is a bit tricky, because the x-axis data points don't align
-        # among different spectra for the same structure. So, prepare for
-        # interpolation within the intersection of x-axis ranges.
-        mins.append(spectrum.energy[0])
-        maxes.append(spectrum.energy[-1])
-
-        # 3rd-order spline interpolation
-        f = interp1d(
-            spectrum.energy, spectrum.intensity,
-            kind='cubic', bounds_error=False, fill_value=0)
-        fs.append(f)
-
-        absorbing_atoms |= set(
-            SymmSites(structure).get_equivalent_site_indices(absorbing_atom))
-
-    energy = np.linspace(max(mins), min(maxes), num=num_samples)
-    weighted_intensity = np.zeros(num_samples)
-    sum_multiplicities = sum(multiplicities)
-    for i in range(len(multiplicities)):
-        weighted_intensity += (
-            multiplicities[i] * fs[i](energy)) / sum_multiplicities
+            enumerate(spectrum.structure.site_properties['absorbing_atom'])
+            if yes)
+        equivalent = ss.get_equivalent_site_indices(absorbing_atom)
+        multiplicities.append(len(equivalent))
+        absorbing_atoms |= set(equivalent)
+
+    # Getting axis limits for each spectrum for the sites corresponding to
+    # K-edge is a bit tricky, because the x-axis data points don't align
+    # among different spectra for the same structure. So, interpolate
+    # within the intersection of x-axis ranges.
+    energy = np.linspace(max(s.energy[0] for s in spectra),
+                         min(s.energy[-1] for s in spectra), num=num_samples)
+    intensities = resample_spectra(spectra, energy)
+    weights = np.array(multiplicities, dtype=float) / sum(multiplicities)
+    weighted_intensity = np.dot(weights, intensities)
+
     structure = spectra[0].structure
     structure.remove_site_property('absorbing_atom')
     structure.add_site_property(
@@ -225,3 +427,33 @@ def site_weighted_spectrum(xas_docs, num_samples=200):
         x=energy, y=weighted_intensity, structure=structure,
         absorption_specie=spectra[0].absorption_specie, edge=spectra[0].edge,
     )
+
+
+def resample_spectra(spectra, energy):
+    """
+    Resamples spectra onto a common energy grid with 3rd-order splines
+    (as interp1d with kind='cubic', and 0 outside of each spectrum's range).
+
+    Spectra that share their energy points are interpolated with a single
+    spline of vector-valued data.
+
+    Args:
+        spectra ([XANES]): spectra
+        energy (np.ndarray): common energy grid
+
+    Returns:
+        np.ndarray: (spectra x energies) intensities
+    """
+    intensities = np.zeros((len(spectra), len(energy)))
+    by_grid = {}
+    for i, s in enumerate(spectra):
+        x = np.asarray(s.energy, dtype=float)
+        by_grid.setdefault(x.tobytes(), (x, []))[1].append(i)
+
+    for x, indices in by_grid.values():
+        y = np.array([spectra[i].intensity for i in indices], dtype=float).T
+        order = np.argsort(x, kind="mergesort")
+        spline = make_interp_spline(x[order], y[order], k=3)
+        inside = (energy >= x.min()) & (energy <= x.max())
+        intensities[np.ix_(indices, inside)] = spline(energy[inside]).T
+    return intensities
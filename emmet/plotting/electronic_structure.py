@@ -1,7 +1,18 @@
 import io
+import hashlib
+import json
+import logging
+import multiprocessing
 import traceback
+from collections import deque
+from queue import Queue, Full
+from threading import Event, Thread
+
+import matplotlib
 from maggma.builders import Builder
+from maggma.utils import grouper
 from pydash.objects import get
+from pymatgen import Structure
 from pymatgen.electronic_structure.bandstructure import BandStructureSymmLine, BandStructure
 from pymatgen.symmetry.bandstructure import HighSymmKpath
 from pymatgen.electronic_structure.dos import CompleteDos
@@ -9,11 +20,22 @@ from sumo.plotting.dos_plotter import SDOSPlotter
 from sumo.plotting.bs_plotter import SBSPlotter
 from sumo.electronic_structure.dos import get_pdos
 
+from emmet.common.prefetch import query_by_field
+
+matplotlib.use('agg')
+
 __author__ = "Shyam Dwaraknath <shyamd@lbl.gov>"
 
+logger = logging.getLogger(__name__)
+
+# Fields of DOS documents that CompleteDos.from_dict reads; the element and
+# orbital projected DOS are derived from these
+DOS_PLOT_FIELDS = ["@module", "@class", "task_id", "energies", "densities", "efermi", "structure", "pdos"]
+
 
 class ElectronicStructureImageBuilder(Builder):
-    def __init__(self, materials, electronic_structure, bandstructures, dos, query=None, plot_options=None, **kwargs):
+    def __init__(self, materials, electronic_structure, bandstructures, dos, query=None, plot_options=None,
+                 num_workers=1, prefetch=10, **kwargs):
         """
         Creates an electronic structure from a tasks collection, the associated band structures and density of states, and the materials structure
 
@@ -25,6 +47,11 @@ class ElectronicStructureImageBuilder(Builder):
         dos (Store) : store of DOS
         plot_options (dict): options to pass to the sumo SBSPlotter
         query (dict): dictionary to limit tasks to be analyzed
+        num_workers (int): number of processes to render plots with; 1 renders in process_item
+        prefetch (int): number of materials whose band structures and DOS are fetched together in the background
+
+        Plots are only rendered again if the bs_task, dos_task or plot_options of a material changed since its
+        electronic structure document was built.
         """
 
         self.materials = materials
@@ -33,6 +60,8 @@ class ElectronicStructureImageBuilder(Builder):
         self.dos = dos
         self.query = query if query else {}
         self.plot_options = plot_options if plot_options else {}
+        self.num_workers = num_workers
+        self.prefetch = prefetch
 
         super().__init__(sources=[materials, bandstructures, dos], targets=[electronic_structure], **kwargs)
 
@@ -64,15 +93,129 @@ class ElectronicStructureImageBuilder(Builder):
 
         self.total = len(mats)
 
-        for m in mats:
-            mat = self.materials.query_one([self.materials.key, "structure", "bandstructure", "inputs"],
-                                           {self.materials.key: m})
-            mat["bandstructure"]["bs"] = self.bandstructures.query_one(
-                criteria={"task_id": get(mat, "bandstructure.bs_task")})
+        # Rendered plots are reused if the inputs of the plots are unchanged
+        options_hash = plot_options_hash(self.plot_options)
+        rendered = {
+            d[self.electronic_structure.key]: (d.get("bs_task"), d.get("dos_task"))
+            for d in self.electronic_structure.query(
+                criteria={"plot_options_hash": options_hash},
+                properties=[self.electronic_structure.key, "bs_task", "dos_task"])
+        }
+
+        items = self.get_material_items(mats, rendered)
+        if self.num_workers > 1:
+            items = self.render_in_pool(items)
+        for item in items:
+            yield item
+
+    def get_material_items(self, mats, rendered):
+        """
+        Gets the materials with their band structure and DOS documents.
 
-            mat["bandstructure"]["dos"] = self.dos.query_one(criteria={"task_id": get(mat, "bandstructure.dos_task")})
+        A background thread fetches the documents of prefetch materials at a
+        time with one query per store and puts the joined items into a
+        queue of at most prefetch items, so fetching overlaps with decoding
+        and rendering.
+        """
+        items = Queue(maxsize=self.prefetch)
+        stop = Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    items.put(item, timeout=1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def feed():
+            try:
+                for chunk in grouper(sorted(mats), self.prefetch):
+                    for mat in self.fetch_materials([m for m in chunk if m is not None], rendered):
+                        if not put(mat):
+                            return
+            except Exception as e:
+                put(e)
+            finally:
+                put(None)
+
+        feeder = Thread(target=feed, daemon=True)
+        feeder.start()
+        try:
+            while True:
+                item = items.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            feeder.join()
+
+    def fetch_materials(self, mat_ids, rendered):
+        """
+        Fetches a chunk of materials and joins them with their band structure
+        and DOS documents, or with their existing electronic structure
+        document if its plots can be reused.
+        """
+        mats = list(self.materials.query(criteria={self.materials.key: {"$in": mat_ids}},
+                                         properties=[self.materials.key, "structure", "bandstructure", "inputs"]))
+
+        cached_ids = []
+        bs_tasks = []
+        dos_tasks = []
+        for mat in mats:
+            tasks = (get(mat, "bandstructure.bs_task"), get(mat, "bandstructure.dos_task"))
+            if rendered.get(mat[self.materials.key]) == tasks:
+                cached_ids.append(mat[self.materials.key])
+            else:
+                bs_tasks.append(tasks[0])
+                dos_tasks.append(tasks[1])
+
+        cached = {}
+        if cached_ids:
+            cached = {d[self.electronic_structure.key]: d for d in self.electronic_structure.query(
+                criteria={self.electronic_structure.key: {"$in": cached_ids}})}
+        # Band structures and DOS are joined by the requested task ids, which
+        # GridFS stores only keep in the file metadata
+        bss = query_by_field(self.bandstructures, "task_id", bs_tasks) if bs_tasks else {}
+        doss = query_by_field(self.dos, "task_id", dos_tasks, properties=DOS_PLOT_FIELDS) if dos_tasks else {}
+
+        for mat in mats:
+            if mat[self.materials.key] in cached:
+                mat["cached"] = cached[mat[self.materials.key]]
+            else:
+                mat["bandstructure"]["bs"] = bss.get(get(mat, "bandstructure.bs_task"))
+                mat["bandstructure"]["dos"] = doss.get(get(mat, "bandstructure.dos_task"))
             yield mat
 
+    def render_in_pool(self, items):
+        """
+        Renders the plots of items in a process pool, keeping at most two
+        items per worker in flight, and yields the items in order with the
+        rendered plots in "plots"
+        """
+        pool = multiprocessing.Pool(self.num_workers)
+        try:
+            pending = deque()
+            for mat in items:
+                if "cached" in mat:
+                    pending.append((mat, None))
+                else:
+                    pending.append((mat, pool.apply_async(render_plots, (mat, self.plot_options, self.materials.key))))
+                while len(pending) > 2 * self.num_workers:
+                    yield _collect_rendered(*pending.popleft())
+            while pending:
+                yield _collect_rendered(*pending.popleft())
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
     def process_item(self, mat):
         """
         Process the tasks and materials into just a list of materials
@@ -86,35 +229,20 @@ class ElectronicStructureImageBuilder(Builder):
         d = {self.electronic_structure.key: mat[self.materials.key]}
         self.logger.info("Processing: {}".format(mat[self.materials.key]))
 
-        bs = build_bs(mat["bandstructure"]["bs"], mat)
-        dos = CompleteDos.from_dict(mat["bandstructure"]["dos"])
-
-        if bs and dos:
-            try:
-                pdos = get_pdos(dos)
-                dos_plotter = SDOSPlotter(dos, pdos)
-                bs_plotter = SBSPlotter(bs)
-                plt = bs_plotter.get_plot(dos_plotter=dos_plotter, **self.plot_options)
-                d["plot"] = image_from_plot(plt)
-                plt.close()
-            except Exception:
-                traceback.print_exc()
-                self.logger.warning("Caught error in bandstructure plotting for {}: {}".format(
-                    mat[self.materials.key], traceback.format_exc()))
-
-        # Reduced Band structure plot
-        try:
-            gap = bs.get_band_gap()["energy"]
-            plot_data = bs_plotter.bs_plot_data()
-            d["bs_plot_small"] = get_small_plot(plot_data, gap)
-        except Exception:
-            self.logger.warning("Caught error in generating reduced bandstructure plot for {}: {}".format(
-                mat[self.materials.key], traceback.format_exc()))
+        if mat.get("cached"):
+            self.logger.debug("Reusing plots of {}".format(mat[self.materials.key]))
+            d.update({k: v for k, v in mat["cached"].items()
+                      if k not in ["_id", self.electronic_structure.lu_field]})
+        elif "plots" in mat:
+            d.update(mat["plots"])
+        else:
+            d.update(render_plots(mat, self.plot_options, self.materials.key))
 
         # Store task_ids
         for k in ["bs_task", "dos_task", "uniform_task"]:
             if k in mat["bandstructure"]:
                 d[k] = mat["bandstructure"][k]
+        d["plot_options_hash"] = plot_options_hash(self.plot_options)
 
         return d
 
@@ -134,6 +262,65 @@ class ElectronicStructureImageBuilder(Builder):
             self.logger.info("No electronic structure docs to update")
 
 
+def render_plots(mat, plot_options, key="task_id"):
+    """
+    Renders the band structure and DOS plot and the reduced band structure
+    plot data of a material
+
+    Args:
+        mat (dict): material document with the bandstructure and dos docs
+            in "bandstructure"
+        plot_options (dict): options to pass to the sumo SBSPlotter
+        key (str): key of the material document, for logging
+
+    Returns:
+        dict: "plot" and "bs_plot_small", where successful
+    """
+    d = {}
+    bs = build_bs(mat["bandstructure"]["bs"], mat)
+    dos = CompleteDos.from_dict(mat["bandstructure"]["dos"])
+
+    if bs and dos:
+        try:
+            pdos = get_pdos(dos)
+            dos_plotter = SDOSPlotter(dos, pdos)
+            bs_plotter = SBSPlotter(bs)
+            plt = bs_plotter.get_plot(dos_plotter=dos_plotter, **plot_options)
+            d["plot"] = image_from_plot(plt)
+            plt.close()
+        except Exception:
+            traceback.print_exc()
+            logger.warning("Caught error in bandstructure plotting for {}: {}".format(
+                mat.get(key), traceback.format_exc()))
+
+    # Reduced Band structure plot
+    try:
+        gap = bs.get_band_gap()["energy"]
+        plot_data = bs_plotter.bs_plot_data()
+        d["bs_plot_small"] = get_small_plot(plot_data, gap)
+    except Exception:
+        logger.warning("Caught error in generating reduced bandstructure plot for {}: {}".format(
+            mat.get(key), traceback.format_exc()))
+
+    return d
+
+
+def _collect_rendered(mat, result):
+    if result is not None:
+        mat["plots"] = result.get()
+        # The bandstructure and DOS are no longer needed
+        mat["bandstructure"].pop("bs", None)
+        mat["bandstructure"].pop("dos", None)
+    return mat
+
+
+def plot_options_hash(plot_options):
+    """
+    Hash of plot options to identify plots rendered with them
+    """
+    return hashlib.sha1(json.dumps(plot_options, sort_keys=True, default=str).encode()).hexdigest()
+
+
 def get_small_plot(plot_data, gap):
     for branch in plot_data['energy']:
         for spin, v in branch.items():
@@ -1,9 +1,13 @@
+import json
+import threading
+import time
 import unittest
 from unittest.mock import patch, MagicMock
-from maggma.stores import MemoryStore
+from maggma.stores import MemoryStore, GridFSStore
 from pymatgen.core.structure import Structure
 from pymatgen.core.lattice import Lattice
-from emmet.plotting.electronic_structure import ElectronicStructureImageBuilder
+from emmet.common.tests.test_prefetch import MemoryGridFS
+from emmet.plotting.electronic_structure import ElectronicStructureImageBuilder, plot_options_hash
 
 __author__ = "Shyam Dwaraknath"
 __email__ = "shyamd@lbl.gov"
@@ -18,11 +22,74 @@ class TestElectronicStructureImageBuilder(unittest.TestCase):
                            [0.00, -2.2171384943, 3.1355090603]])
         self.structure = Structure(lattice, ["Si", "Si"], coords)
 
-        materials = MemoryStore("materials")
-        electronic_structure = MemoryStore("electronic_structure")
-        bandstructures = MemoryStore("bandstructure")
-        dos = MemoryStore("dos")
-        self.builder = ElectronicStructureImageBuilder(materials, electronic_structure,bandstructures,dos)
+        self.materials = MemoryStore("materials")
+        self.electronic_structure = MemoryStore("electronic_structure")
+        self.bandstructures = MemoryStore("bandstructure")
+        self.dos = MemoryStore("dos")
+        self.builder = ElectronicStructureImageBuilder(self.materials, self.electronic_structure,
+                                                       self.bandstructures, self.dos)
+
+    def test_render_cache(self):
+        self.builder.connect()
+        self.electronic_structure.update([{"task_id": "mp-1", "bs_task": "mp-2", "dos_task": "mp-3",
+                                           "plot": b"png", "plot_options_hash": plot_options_hash({})}])
+        time.sleep(0.01)
+        self.materials.update([{"task_id": "mp-1", "structure": self.structure.as_dict(),
+                                "bandstructure": {"bs_task": "mp-2", "dos_task": "mp-3"}}])
+
+        items = list(self.builder.get_items())
+        self.assertEqual(len(items), 1)
+        self.assertNotIn("bs", items[0]["bandstructure"])
+        doc = self.builder.process_item(items[0])
+        self.assertEqual(doc["plot"], b"png")
+
+        self.assertNotEqual(plot_options_hash({"ymin": -4}), plot_options_hash({}))
+
+    def test_get_items_batched(self):
+        # Band structures in GridFS keep their task ids only in the file metadata
+        bandstructures = GridFSStore("emmet_test", "bandstructures")
+        bandstructures._collection = MemoryGridFS()
+        builder = ElectronicStructureImageBuilder(self.materials, self.electronic_structure,
+                                                  bandstructures, self.dos, prefetch=2)
+        self.materials.connect()
+        self.electronic_structure.connect()
+        self.dos.connect()
+
+        self.materials.update([{"task_id": "mp-{}".format(i), "structure": self.structure.as_dict(),
+                                "bandstructure": {"bs_task": "bs-{}".format(i), "dos_task": "dos-{}".format(i)}}
+                               for i in range(5)])
+        for i in range(5):
+            bandstructures.collection.put(json.dumps({"bands": {"1": [[i]]}}).encode(),
+                                          metadata={"task_id": "bs-{}".format(i)})
+        self.dos.update([{"task_id": "dos-{}".format(i), "energies": [i], "pdos": [], "spd_dos": {}}
+                         for i in range(5)])
+
+        with patch.object(self.dos, "query", wraps=self.dos.query) as dos_query, \
+                patch.object(bandstructures.collection, "find", wraps=bandstructures.collection.find) as bs_find:
+            items = list(builder.get_items())
+
+        # One query per store for each chunk of prefetch materials
+        self.assertEqual(dos_query.call_count, 3)
+        self.assertEqual(bs_find.call_count, 3)
+
+        self.assertEqual(sorted(item["task_id"] for item in items), ["mp-{}".format(i) for i in range(5)])
+        for item in items:
+            i = int(item["task_id"][3:])
+            self.assertEqual(item["bandstructure"]["bs"], {"bands": {"1": [[i]]}})
+            self.assertEqual(item["bandstructure"]["dos"]["energies"], [i])
+            self.assertNotIn("spd_dos", item["bandstructure"]["dos"])
+
+        # Errors while fetching reach the consumer
+        with patch.object(self.dos, "query", side_effect=RuntimeError("connection lost")):
+            with self.assertRaises(RuntimeError):
+                list(builder.get_items())
+
+        # Closing the items stops fetching
+        threads = threading.active_count()
+        items = builder.get_items()
+        next(items)
+        items.close()
+        self.assertEqual(threading.active_count(), threads)
 
     def test_serialization(self):
 
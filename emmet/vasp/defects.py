@@ -24,6 +24,8 @@ from pymatgen.analysis.defects.defect_compatibility import DefectCompatibility
 
 from maggma.builder import Builder
 
+from emmet.common.prefetch import query_in_chunks
+
 
 __author__ = "Danny Broberg, Shyam Dwaraknath"
 
@@ -83,29 +85,22 @@ class DefectBuilder(Builder):
         # Save timestamp for update operation
         self.time_stamp = datetime.utcnow()
 
-        # Get all successful defect tasks that have been updated since
-        # defect_store was last updated
+        # Get all successful defect tasks which have not been processed into
+        # the defect store yet. The set difference is computed client-side on
+        # the distinct task ids, instead of sending every processed id back
+        # to the server in a $nin query
         q = dict(self.query)
         q["state"] = "successful"
-        if not self.update_all:
-            if 'task_id' in q:
-                if isinstance(q['task_id'], int) or isinstance(q['task_id'], float):
-                    q['task_id'] = {'$nin': [], '$in': [q['task_id']]}
-                if '$nin' in q['task_id']:
-                    q['task_id']['$nin'].extend( self.defects.distinct('entry_id'))
-                else:
-                    q['task_id'].update( {'$nin': self.defects.distinct('entry_id')})
-            else:
-                q.update({'task_id': {'$nin': self.defects.distinct('entry_id')}})
-
         q.update({'transformations.history.@module':
                       {'$in': ['pymatgen.transformations.defect_transformations']}})
-        defect_tasks = list(self.tasks.query(criteria=q,
-                                             properties=['task_id', 'transformations.history.0.defect.structure']))
-        if self.max_items_size and len(defect_tasks) > self.max_items_size:
-            defect_tasks = [dtask for dind, dtask in enumerate(defect_tasks) if dind < self.max_items_size]
-        task_ids = [dtask['task_id'] for dtask in defect_tasks]
-        self.logger.info("Found {} new defect tasks to consider:\n{}".format( len(defect_tasks), task_ids))
+        task_ids = set(self.tasks.distinct('task_id', criteria=q))
+        if not self.update_all:
+            task_ids -= set(self.defects.distinct('entry_id'))
+        task_ids = sorted(task_ids)
+
+        if self.max_items_size and len(task_ids) > self.max_items_size:
+            task_ids = task_ids[:self.max_items_size]
+        self.logger.info("Found {} new defect tasks to consider:\n{}".format( len(task_ids), task_ids))
 
         # get a few other tasks which are needed for defect entries (regardless of when they were last updated):
         # bulk_supercell, dielectric calc, BS calc, HSE-BS calc
@@ -129,9 +124,8 @@ class DefectBuilder(Builder):
         needed_bulk_properties = ['task_id', 'chemsys', 'task_label',
                                   'last_updated', 'transformations',
                                   'input', 'output', 'calcs_reversed']
-        for d_task_id in task_ids:
-            d_task = list(self.tasks.query(criteria={"task_id": d_task_id},
-                                           properties=needed_defect_properties))[0]
+        for d_task in query_in_chunks(self.tasks, task_ids, needed_defect_properties,
+                                      chunk_size=self.chunk_size, field='task_id'):
             chemsys = "-".join(sorted((Structure.from_dict(
                 d_task['transformations']['history'][0]['defect']['structure']).symbol_set)))
 
@@ -268,6 +262,7 @@ class DefectBuilder(Builder):
 
         # Search indicies for defects
         self.defects.ensure_index(self.defects.key, unique=True)
+        self.defects.ensure_index("entry_id")
         self.defects.ensure_index("chemsys")
 
     def find_and_load_bulk_tasks(self, defect_task, additional_tasks):